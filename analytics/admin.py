@@ -1,6 +1,200 @@
-from django.contrib import admin
+# analytics/admin.py
+"""
+Admin for tables with millions of rows.
+
+Changelists do not run an exact COUNT(*) over a whole large table: EstimatedCountPaginator
+reads the database's own row estimate for unfiltered lists. Each line's related objects
+are joined in (list_select_related) instead of fetched one query per row, foreign keys
+are edited through autocomplete or raw id inputs instead of a <select> of every row, and
+the region / year filters read their choices through indexes (0011_admin_filter_indexes).
+
+Bulk actions write whole selections with one UPDATE or DELETE per chunk of ids, and keep
+area rollups, forecast actuals, the change log and (once they commit) the snapshot in step
+as the bulk API endpoints do.
+"""
+from django.contrib import admin, messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.db.models import Max, Min
+from django.utils.functional import cached_property
+
+from .areas import apply_changes
+from .changes import record_changes
+from .city_cache import bump_city_version
+from .forecast_archive import record_actuals
 from .models import User, City, PopulationData
+from .signals import bulk_write, dataset_changed
+
+# Ids per statement, keeping the id lists under 2100 parameters on SQL Server
+ADMIN_CHUNK_SIZE = 1000
+
+# Unfiltered changelists of tables estimated at least this large show the estimate
+ESTIMATED_COUNT_THRESHOLD = 100000
+
+# Row estimate of a table, by database vendor; SQLite keeps none
+ROW_ESTIMATE_SQL = {
+    'postgresql': 'SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)',
+    'microsoft': 'SELECT SUM(rows) FROM sys.partitions WHERE object_id = OBJECT_ID(%s) AND index_id IN (0, 1)',
+    'mysql': 'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s',
+}
+
+
+def _chunks(items, size=ADMIN_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def estimated_row_count(queryset):
+    """The database's row estimate for the queryset's table, or None where it has none."""
+    connection = connections[queryset.db]
+    sql = ROW_ESTIMATE_SQL.get(connection.vendor)
+    if sql is None:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+    # PostgreSQL reports -1 for a table that was never analyzed
+    return int(row[0]) if row and row[0] is not None and row[0] >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Pages an unfiltered changelist of a large table by the table's row estimate; filtered
+    lists and small tables are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset)
+            if estimate is not None and estimate >= ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super().count
+
+
+class RegionListFilter(admin.SimpleListFilter):
+    """Filters by city region, with the regions read from City's region index."""
+    title = 'region'
+    parameter_name = 'region'
+    # Lookup from the changelist's model to City.region
+    field_path = 'region'
+
+    def lookups(self, request, model_admin):
+        regions = City.objects.order_by('region').values_list('region', flat=True).distinct()
+        return [(region, region or '(none)') for region in regions]
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        return queryset.filter(**{self.field_path: self.value()})
+
+
+class CityRegionListFilter(RegionListFilter):
+    field_path = 'city__region'
+
+
+class YearListFilter(admin.SimpleListFilter):
+    """
+    Filters population rows by year. The choices span the first to the last stored year,
+    two seeks on the year index, instead of a DISTINCT over every row.
+    """
+    title = 'year'
+    parameter_name = 'year'
+
+    def lookups(self, request, model_admin):
+        bounds = PopulationData.objects.aggregate(first=Min('year'), last=Max('year'))
+        if bounds['first'] is None:
+            return []
+        return [(str(year), str(year)) for year in range(bounds['last'], bounds['first'] - 1, -1)]
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        try:
+            return queryset.filter(year=int(self.value()))
+        except ValueError:
+            raise IncorrectLookupParameters('year must be an integer.')
+
+
+class ScalableModelAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # The "N of M selected" total would be a second exact count of the whole table
+    show_full_result_count = False
+
+
+@admin.register(User)
+class UserAdmin(ScalableModelAdmin):
+    list_display = ('username', 'email', 'role', 'is_active', 'last_login')
+    list_filter = ('role', 'is_active')
+    search_fields = ('username', 'email')
+    ordering = ('username',)
+    filter_horizontal = ('groups', 'user_permissions')
+    actions = ('deactivate_users',)
+
+    @admin.action(description='Deactivate selected users')
+    def deactivate_users(self, request, queryset):
+        # Never lock out the admin doing it
+        updated = queryset.exclude(pk=request.user.pk).update(is_active=False)
+        self.message_user(request, f'Deactivated {updated} users.', messages.SUCCESS)
+
+
+@admin.register(City)
+class CityAdmin(ScalableModelAdmin):
+    list_display = ('city_name', 'region', 'area', 'latitude', 'longitude')
+    list_select_related = ('area',)
+    list_filter = (RegionListFilter,)
+    # Prefix search; also serves the city autocomplete of the population row form
+    search_fields = ('^city_name',)
+    ordering = ('city_name',)
+    raw_id_fields = ('area',)
+    actions = ('clear_locations',)
+
+    @admin.action(description='Clear the location of selected cities')
+    def clear_locations(self, request, queryset):
+        with transaction.atomic():
+            ids = list(queryset.values_list('id', flat=True))
+            for chunk in _chunks(ids):
+                City.objects.filter(id__in=chunk).update(latitude=None, longitude=None)
+            if ids:
+                record_changes('city', [(city_id, city_id) for city_id in ids], 'upsert')
+                transaction.on_commit(bump_city_version)
+                transaction.on_commit(dataset_changed)
+        self.message_user(request, f'Cleared the location of {len(ids)} cities.', messages.SUCCESS)
+
+
+@admin.register(PopulationData)
+class PopulationDataAdmin(ScalableModelAdmin):
+    list_display = ('id', 'city', 'area', 'year', 'population_count', 'source', 'created_by', 'anomaly_score')
+    # __str__ and the city / area / created_by columns would otherwise query once per row
+    list_select_related = ('city', 'area', 'created_by')
+    list_filter = (CityRegionListFilter, YearListFilter)
+    ordering = ('-id',)
+    autocomplete_fields = ('city',)
+    raw_id_fields = ('area', 'created_by')
+    actions = ('delete_rows', 'clear_anomaly_scores')
+
+    def get_actions(self, request):
+        # Replaced by delete_rows: the stock action's confirmation page collects and lists every row
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    @admin.action(description='Delete selected population rows', permissions=['delete'])
+    def delete_rows(self, request, queryset):
+        with transaction.atomic(), bulk_write():
+            rows = list(queryset.values_list('id', 'city_id', 'area_id', 'year', 'population_count'))
+            for chunk in _chunks(rows):
+                PopulationData.objects.filter(id__in=[row_id for row_id, *_ in chunk]).delete()
+            if rows:
+                apply_changes(removed=[(area_id, year, population) for _, _, area_id, year, population in rows])
+                record_actuals([(city_id, year) for _, city_id, _, year, _ in rows])
+                record_changes('population', [(row_id, city_id) for row_id, city_id, *_ in rows], 'delete')
+                transaction.on_commit(dataset_changed)
+        self.message_user(request, f'Deleted {len(rows)} population rows.', messages.SUCCESS)
 
-admin.site.register(User)
-admin.site.register(City)
-admin.site.register(PopulationData)
+    @admin.action(description='Mark selected rows as reviewed (clear anomaly score)', permissions=['change'])
+    def clear_anomaly_scores(self, request, queryset):
+        updated = queryset.exclude(anomaly_score=None).update(anomaly_score=None)
+        self.message_user(request, f'Cleared the anomaly score of {updated} rows.', messages.SUCCESS)
@@ -1,31 +1,87 @@
 # analytics/api_views.py
-from django.http import HttpResponse, JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.views.decorators.csrf import csrf_exempt
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, renderer_classes, throttle_classes
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework import status
 from django.contrib.auth import authenticate
 from rest_framework.authtoken.models import Token
 from django.shortcuts import get_object_or_404
+from django.db import IntegrityError, transaction
+from django.db.models import Value
+from django.db.models.functions import Lower
+from django.utils import timezone
+from collections import Counter
 from datetime import datetime
 from io import BytesIO
 import base64
 import numpy as np
-
-
- # Use non-interactive backend BEFORE importing pyplot
-
-from sklearn.linear_model import LinearRegression
+import pyarrow as pa
 import csv
 import json
 
-from .models import City, PopulationData, User
+from . import city_cache
+from .areas import apply_changes, area_total, create_area, move_area
+from .changes import changes_since, record_changes
+from .events import broadcaster, event_stream
+from .forecast_archive import ACCURACY_GROUPS, accuracy, record_actuals
+from .gapfill import METHODS as GAP_FILL_METHODS
+from .geo import valid_location
+from .models import Area, City, ForecastArchive, PopulationData, PopulationObservation, QuarantinedPopulation, User
+from .resampling import FREQUENCIES, GRANULARITY_PERIODS, bucket_period, lttb, period_growth
+from .renderers import READ_RENDERER_CLASSES, binary_renderer, cities_table, wants_arrow
+from .signals import bulk_write, dataset_changed
+from .screening import FLAG, QUARANTINE, REJECT, hold_for_review, release, screen_rows
+from .similarity import STORED_NEIGHBOURS, WINDOW_YEARS as SIMILARITY_WINDOW_YEARS
+from .simulation import Simulation
+from .snapshot import get_snapshot
+from .streaming import iter_cities_json, iter_object_json, streaming_json_response, wants_stream
+from .rankings import METRICS as RANKING_METRICS
+from .throttles import (
+    AllCitiesThrottle, BatchThrottle, ClustersThrottle, NearbyThrottle, RankingsThrottle, SimilarThrottle,
+    SimulationThrottle, SingleCityThrottle,
+)
 
 
 # ------------------ Helpers & Base Classes ------------------
 
+# Largest id list accepted by the batch city endpoint
+MAX_BATCH_IDS = 1000
+
+# Most results the city search endpoint returns
+MAX_SEARCH_RESULTS = 50
+
+# Smallest ?max_points of the history endpoints: the first and last point plus one chosen by LTTB
+MIN_HISTORY_POINTS = 3
+
+# Most neighbours the nearby-cities endpoint returns, and the default
+MAX_NEARBY_RESULTS = 100
+DEFAULT_NEARBY_RESULTS = 10
+
+# Most cities a leaderboard returns, and the default
+MAX_RANKING_RESULTS = 1000
+DEFAULT_RANKING_RESULTS = 10
+
+# Members shown per cluster in the cluster listing (?cluster=n lists them all)
+CLUSTER_SAMPLE_SIZE = 5
+
+# Page size of the quarantine review list, and its default
+MAX_QUARANTINE_PAGE = 1000
+DEFAULT_QUARANTINE_PAGE = 100
+
+# Limits and defaults of the Monte Carlo simulation endpoint
+MAX_SIMULATION_HORIZON = 50
+MAX_SIMULATION_PATHS = 10000
+DEFAULT_SIMULATION_HORIZON = 10
+DEFAULT_SIMULATION_PATHS = 1000
+
+# Fields the bulk population endpoints may change, and rows written per statement
+BULK_FIELDS = ('year', 'population_count', 'source')
+BULK_CHUNK_SIZE = 1000
+
 # Superadmin check decorator
 def superadmin_required(view_func):
     return user_passes_test(lambda u: u.is_authenticated and u.role == 'superadmin')(view_func)
@@ -47,10 +103,7 @@ class BasePopulationView:
         return True
 
     def get_city(self, city_id):
-        try:
-            return City.objects.get(id=city_id)
-        except City.DoesNotExist:
-            return None
+        return city_cache.get_city(city_id)
 
     def get_population_data(self, population_id):
         try:
@@ -58,26 +111,6 @@ class BasePopulationView:
         except PopulationData.DoesNotExist:
             return None
 
-    def calculate_growth(self, population_history):
-        """
-        Calculates year-over-year growth for a list of PopulationData objects
-        """
-        history = []
-        prev_pop = None
-        for data in population_history:
-            growth = None
-            if prev_pop is not None and prev_pop > 0:
-                growth = round((data.population_count - prev_pop) / prev_pop * 100, 2)
-            prev_pop = data.population_count
-            history.append({
-                'Historyid': data.id,
-                'year': data.year,
-                'population': data.population_count,
-                'source': data.source,
-                'growth': growth
-            })
-        return history
-
     # def _get_or_create_tf_model(self):
     #     """Create TensorFlow model once and reuse it"""
     #     if self._tf_model is None:
@@ -87,65 +120,10 @@ class BasePopulationView:
     #         self._tf_model.compile(optimizer='adam', loss='mean_squared_error')
     #     return self._tf_model
 
-    def predict_next_year_population(self, population_history):
-        """
-        Predict next year's population using Linear Regression (scikit-learn),
-        starting from the current year, not the last year in the data.
-        """
-        data = list(population_history.order_by('year'))
-
-        if len(data) < 2:
-            if data:
-                # If less than 2 data points, return current year + 1 with last known population
-                current_year = datetime.now().year
-                return current_year + 1, int(data[-1].population_count)
-            return None, 0
-
-        # Prepare training data
-        years = np.array([d.year for d in data]).reshape(-1, 1)
-        populations = np.array([d.population_count for d in data])
-
-        # Train the linear regression model
-        model = LinearRegression()
-        model.fit(years, populations)
-
-        # Predict for next year starting from current year
-        current_year = datetime.now().year
-        next_year = current_year + 1
-        predicted_population = model.predict([[next_year]])[0]
-
-        return int(next_year), int(predicted_population)
-
 
 # ------------------ API Views ------------------
 
 # --- City APIs ---
-@login_required
-def cities_api(request):
-    cities_data = []
-    cities = City.objects.all()
-    base = BasePopulationView()
-
-    for city in cities:
-        data = PopulationData.objects.filter(city=city).order_by('year')
-        predicted_year, predicted_population = base.predict_next_year_population(data)
-        chart = base.generate_chart_base64(city.city_name, data)
-
-        history = base.calculate_growth(data)
-
-        cities_data.append({
-            'id': city.id,
-            'name': city.city_name,
-            'region': city.region,
-            'predicted_year': predicted_year,
-            'predicted_population': predicted_population,
-            'chart': chart,
-            'history': history
-        })
-
-    return JsonResponse({'cities': cities_data})
-
-
 @login_required
 def export_city_csv_api(request, city_id):
     base = BasePopulationView()
@@ -153,6 +131,18 @@ def export_city_csv_api(request, city_id):
     if not city:
         return JsonResponse({'status': 'error', 'message': 'City not found'}, status=404)
 
+    # Accept: application/msgpack or application/vnd.apache.arrow.stream get the same columns, columnar
+    renderer = binary_renderer(request)
+    if renderer is not None:
+        rows = PopulationData.objects.filter(city=city).order_by('year').values_list('year', 'population_count', 'source')
+        columns = dict(zip(('year', 'population', 'source'), map(list, zip(*rows)))) or {
+            'year': [], 'population': [], 'source': [],
+        }
+        data = pa.table(columns) if renderer.format == 'arrow' else columns
+        response = HttpResponse(renderer.render(data), content_type=renderer.media_type)
+        response['Content-Disposition'] = f'attachment; filename="{city.city_name}_population.{renderer.format}"'
+        return response
+
     data = PopulationData.objects.filter(city=city).order_by('year')
     response = HttpResponse(content_type='text/csv')
     response['Content-Disposition'] = f'attachment; filename="{city.city_name}_population.csv"'
@@ -165,17 +155,15 @@ def export_city_csv_api(request, city_id):
 
 @login_required
 def stats_api(request):
-    base = BasePopulationView()
+    snapshot = get_snapshot()
     total_population = 0
-    cities = City.objects.all()
 
-    for city in cities:
-        data = PopulationData.objects.filter(city=city).order_by('year')
-        _, predicted_population = base.predict_next_year_population(data)
+    for record in snapshot.cities:
+        _, predicted_population = snapshot.forecast(record)
         total_population += predicted_population
 
     return JsonResponse({
-        'total_cities': cities.count(),
+        'total_cities': len(snapshot.cities),
         'predicted_total_population': total_population
     })
 
@@ -210,23 +198,64 @@ def api_login(request):
         return JsonResponse({"status": "error", "message": "Invalid JSON"}, status=400)
 
 
+def _parse_max_points(params):
+    """
+    ?max_points=N on the history endpoints: histories longer than N are downsampled with
+    Largest-Triangle-Three-Buckets, keeping the first and last year. Returns (value, error).
+    """
+    value = params.get('max_points')
+    if value in (None, ''):
+        return None, None
+    try:
+        value = int(value)
+    except ValueError:
+        return None, 'max_points must be an integer.'
+    if value < MIN_HISTORY_POINTS:
+        return None, f'max_points must be at least {MIN_HISTORY_POINTS}.'
+    return value, None
+
+
+def _history_snapshot(params):
+    """
+    The snapshot a history endpoint reads, and its ?max_points: with ?fill=linear|log,
+    the gap-filled one, whose histories include interpolated years (flagged "imputed")
+    and whose growth and forecasts use them. Returns (snapshot, max_points, error).
+    """
+    max_points, error = _parse_max_points(params)
+    if error:
+        return None, None, error
+    fill = params.get('fill')
+    if fill in (None, ''):
+        return get_snapshot(), max_points, None
+    if fill not in GAP_FILL_METHODS:
+        return None, None, f'fill must be one of {", ".join(GAP_FILL_METHODS)}.'
+    return get_snapshot().filled(fill), max_points, None
+
+
 # --- City Details ---
 @api_view(['GET'])
 @permission_classes([AllowAny])
+@throttle_classes([AllCitiesThrottle])
+@renderer_classes(READ_RENDERER_CLASSES)
 def get_cities_with_population(request):
-    base = BasePopulationView()
-    cities = City.objects.all()
+    snapshot, max_points, error = _history_snapshot(request.query_params)
+    if error:
+        return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+    if wants_stream(request):
+        return streaming_json_response(iter_cities_json(snapshot, max_points))
+    if wants_arrow(request):
+        return Response(cities_table(snapshot, snapshot.cities, max_points=max_points), status=status.HTTP_200_OK)
+
     result = []
 
-    for city in cities:
-        population_data = PopulationData.objects.filter(city=city).order_by('year')
-        history = base.calculate_growth(population_data)
-        predicted_year, predicted_population = base.predict_next_year_population(population_data)
+    for record in snapshot.cities:
+        history = snapshot.history(record, max_points)
+        predicted_year, predicted_population = snapshot.forecast(record)
 
         city_data = {
-            'id': city.id,
-            'name': city.city_name,
-            'region': city.region,
+            'id': record.id,
+            'name': record.name,
+            'region': record.region,
             'predicted_year': predicted_year,
             'predicted_population': predicted_population,
             'history': history
@@ -238,20 +267,25 @@ def get_cities_with_population(request):
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
+@throttle_classes([SingleCityThrottle])
+@renderer_classes(READ_RENDERER_CLASSES)
 def get_city_by_id(request, city_id):
-    base = BasePopulationView()
-    city = base.get_city(city_id)
-    if not city:
+    snapshot, max_points, error = _history_snapshot(request.query_params)
+    if error:
+        return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+    record = snapshot.get_city(city_id)
+    if not record:
         return Response({'error': 'City not found'}, status=status.HTTP_404_NOT_FOUND)
+    if wants_arrow(request):
+        return Response(cities_table(snapshot, [record], max_points=max_points), status=status.HTTP_200_OK)
 
-    population_data = PopulationData.objects.filter(city=city).order_by('year')
-    history = base.calculate_growth(population_data)
-    predicted_year, predicted_population = base.predict_next_year_population(population_data)
+    history = snapshot.history(record, max_points)
+    predicted_year, predicted_population = snapshot.forecast(record)
 
     city_data = {
-        'id': city.id,
-        'name': city.city_name,
-        'region': city.region,
+        'id': record.id,
+        'name': record.name,
+        'region': record.region,
         'predicted_year': predicted_year,
         'predicted_population': predicted_population,
         'history': history
@@ -259,6 +293,138 @@ def get_city_by_id(request, city_id):
     return Response(city_data, status=status.HTTP_200_OK)
 
 
+@api_view(['GET', 'POST'])
+@permission_classes([AllowAny])
+@throttle_classes([BatchThrottle])
+@renderer_classes(READ_RENDERER_CLASSES)
+def get_cities_batch(request):
+    """
+    Fetch several cities at once: GET ?ids=1,2,3 or POST {"ids": [1, 2, 3]} for long lists.
+    Served from the snapshot, so the query count does not depend on the number of ids.
+    Results keep the requested order; unknown or invalid ids get a per-id error entry.
+    ?max_points and ?fill apply to every history (see _history_snapshot).
+    """
+    snapshot, max_points, error = _history_snapshot(request.query_params)
+    if error:
+        return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+    if request.method == 'POST':
+        raw_ids = request.data.get('ids', [])
+        if not isinstance(raw_ids, list):
+            return Response({'error': 'ids must be a list.'}, status=status.HTTP_400_BAD_REQUEST)
+    else:
+        raw_ids = [value for value in request.query_params.get('ids', '').split(',') if value.strip()]
+
+    if not raw_ids:
+        return Response({'error': 'At least one city id is required.'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(raw_ids) > MAX_BATCH_IDS:
+        return Response({'error': f'At most {MAX_BATCH_IDS} ids per request.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    requested = []
+    for raw_id in raw_ids:
+        try:
+            city_id = int(str(raw_id).strip())
+        except ValueError:
+            requested.append((raw_id, None))
+            continue
+        requested.append((city_id, snapshot.get_city(city_id)))
+
+    found = [record for _, record in requested if record is not None]
+    if wants_arrow(request):
+        # One row per city found; the per-id errors go with "missing" to the metadata
+        return Response({
+            'cities': cities_table(snapshot, found, max_points=max_points),
+            'errors': [
+                {'id': city_id, 'error': 'City not found' if isinstance(city_id, int) else 'Invalid city id'}
+                for city_id, record in requested if record is None
+            ],
+            'missing': [city_id for city_id, record in requested if record is None],
+        }, status=status.HTTP_200_OK)
+    forecasts = dict(zip((record.index for record in found), snapshot.forecast_many(found)))
+
+    result = []
+    for city_id, record in requested:
+        if record is None:
+            error = 'City not found' if isinstance(city_id, int) else 'Invalid city id'
+            result.append({'id': city_id, 'error': error})
+            continue
+        predicted_year, predicted_population = forecasts[record.index]
+        result.append({
+            'id': record.id,
+            'name': record.name,
+            'region': record.region,
+            'predicted_year': predicted_year,
+            'predicted_population': predicted_population,
+            'history': snapshot.history(record, max_points)
+        })
+
+    return Response({
+        'cities': result,
+        'missing': [city_id for city_id, record in requested if record is None],
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def search_cities(request):
+    """
+    Autocomplete: GET ?q=cag[&region=Region X][&limit=10]. Matches name prefixes first,
+    then the start of any later word ("oro" finds "Cagayan de Oro").
+    """
+    query = request.query_params.get('q', '')
+    try:
+        limit = min(max(int(request.query_params.get('limit', 10)), 1), MAX_SEARCH_RESULTS)
+    except ValueError:
+        return Response({'error': 'limit must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    records = get_snapshot().search_index().search(query, limit, request.query_params.get('region'))
+    return Response([
+        {'id': record.id, 'name': record.name, 'region': record.region}
+        for record in records
+    ], status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def get_changes(request):
+    """
+    Delta sync: returns cities, population rows and forecasts changed since ?since=<token>,
+    with tombstones for deletes. Without a token (or with one older than the retained
+    change log) the response only carries the current token and full_resync=true.
+    """
+    since = request.query_params.get('since')
+    if since in (None, ''):
+        since = None
+    else:
+        try:
+            since = int(since)
+        except ValueError:
+            return Response({'error': 'since must be an integer change token.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response(changes_since(since), status=status.HTTP_200_OK)
+
+
+async def forecast_events(request):
+    """
+    Server-Sent Events stream of dataset changes (the same deltas as /api/changes/,
+    including per-city forecasts). Needs an ASGI server so idle connections do not
+    hold a worker thread each. Reconnecting clients send Last-Event-ID to catch up.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'error': 'Event stream requires the ASGI application.'}, status=501)
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('since')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return JsonResponse({'error': 'Last-Event-ID must be an integer change token.'}, status=400)
+
+    subscriber = await broadcaster.subscribe(last_event_id)
+    response = StreamingHttpResponse(event_stream(subscriber), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 # --- Admin Management ---
 @api_view(['POST'])
 @permission_classes([AllowAny])
@@ -278,6 +444,25 @@ def create_admin(request):
 
 
 # --- City Management ---
+def _parse_location(data):
+    """
+    Reads latitude / longitude from a request body. Returns ((latitude, longitude), None),
+    (None, None) when neither is given or both are null, or (None, error).
+    """
+    latitude, longitude = data.get('latitude'), data.get('longitude')
+    if latitude is None and longitude is None:
+        return None, None
+    if latitude is None or longitude is None:
+        return None, 'latitude and longitude must be given together.'
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return None, 'latitude and longitude must be numbers.'
+    if not valid_location(latitude, longitude):
+        return None, 'latitude must be between -90 and 90 and longitude between -180 and 180.'
+    return (latitude, longitude), None
+
+
 @api_view(['POST'])
 def add_city(request):
     base = BasePopulationView()
@@ -290,13 +475,77 @@ def add_city(request):
     if not city_name:
         return Response({'error': 'City name is required.'}, status=status.HTTP_400_BAD_REQUEST)
 
-    if City.objects.filter(city_name__iexact=city_name).exists():
+    # Cached lookup first; the Lower() query is authoritative and uses city_name_lower_idx (the
+    # city_name_lower column's index on SQL Server). Both sides are lowered by the database, whose
+    # LOWER() need not agree with Python's str.lower() beyond ASCII
+    if city_cache.get_city_by_name(city_name) or City.objects.annotate(
+        name_lower=Lower('city_name')
+    ).filter(name_lower=Lower(Value(city_name))).exists():
         return Response({'error': 'City already exists.'}, status=status.HTTP_400_BAD_REQUEST)
 
-    city = City.objects.create(city_name=city_name, region=region)
+    location, error = _parse_location(request.data)
+    if error:
+        return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+    latitude, longitude = location or (None, None)
+
+    city = City.objects.create(city_name=city_name, region=region, latitude=latitude, longitude=longitude)
     return Response({'message': f'City {city_name} added successfully.'}, status=status.HTTP_201_CREATED)
 
 
+def _screening_entry(rows, screening, position):
+    return {
+        'id': rows[position].pk,
+        'city_id': rows[position].city_id,
+        'year': rows[position].year,
+        'population_count': rows[position].population_count,
+        **screening.details(position),
+        'reason': screening.reason(position),
+    }
+
+
+def _quarantine_data(entry):
+    return {
+        'quarantine_id': entry.id,
+        'population_id': entry.population_id,
+        'city_id': entry.city_id,
+        'year': entry.year,
+        'population_count': entry.population_count,
+        'source': entry.source,
+        'score': entry.score,
+        'expected': entry.expected,
+        'reason': entry.reason,
+        'status': entry.status,
+    }
+
+
+def _screen_writes(rows, user):
+    """
+    Screens population rows (with their new, unsaved values) before they are written, and
+    sets anomaly_score on them. Returns (rejection response, {position: quarantine entry}):
+    nothing may be written when the response is set, and quarantined rows must be skipped.
+    """
+    screening = screen_rows(get_snapshot(), rows)
+    rejected = screening.positions(REJECT)
+    if rejected:
+        return Response({
+            'error': 'Rejected by anomaly screening.',
+            'rejected': [_screening_entry(rows, screening, position) for position in rejected],
+        }, status=status.HTTP_400_BAD_REQUEST), {}
+
+    for position, row in enumerate(rows):
+        row.anomaly_score = screening.details(position)['score'] if screening.actions[position] == FLAG else None
+    quarantined = screening.positions(QUARANTINE)
+    entries = hold_for_review(rows, screening, quarantined, user) if quarantined else []
+    return None, dict(zip(quarantined, entries))
+
+
+def _quarantined_response(entry):
+    return Response({
+        'message': 'Population data quarantined for review.',
+        **_quarantine_data(entry),
+    }, status=status.HTTP_202_ACCEPTED)
+
+
 @api_view(['POST'])
 def add_population_data(request):
     base = BasePopulationView()
@@ -304,21 +553,41 @@ def add_population_data(request):
         return Response({'error': 'Permission denied.'}, status=status.HTTP_403_FORBIDDEN)
 
     city_id = request.data.get('city_id')
+    area_id = request.data.get('area_id')
     year = request.data.get('year')
     population_count = request.data.get('population_count')
     source = request.data.get('source', '')
 
-    city = base.get_city(city_id)
-    if not city:
-        return Response({'error': 'City not found.'}, status=status.HTTP_404_NOT_FOUND)
+    # Rows attach to a city, or (without city_id) directly to an area at any level
+    city = area = None
+    if city_id is None and area_id is not None:
+        area = Area.objects.filter(id=area_id).first()
+        if not area:
+            return Response({'error': 'Area not found.'}, status=status.HTTP_404_NOT_FOUND)
+    else:
+        city = base.get_city(city_id)
+        if not city:
+            return Response({'error': 'City not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+    try:
+        year, population_count = int(year), int(population_count)
+    except (TypeError, ValueError):
+        return Response({'error': 'year and population_count must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
 
-    data = PopulationData.objects.create(
+    data = PopulationData(
         city=city,
+        area=area,
         year=year,
         population_count=population_count,
         source=source,
         created_by=request.user
     )
+    rejected, held = _screen_writes([data], request.user)
+    if rejected is not None:
+        return rejected
+    if held:
+        return _quarantined_response(held[0])
+    data.save()
 
     return Response({
         'success': True,
@@ -328,6 +597,7 @@ def add_population_data(request):
             'year': data.year,
             'population_count': data.population_count,
             'source': data.source,
+            'anomaly_score': data.anomaly_score,
         }
     }, status=status.HTTP_201_CREATED)
 
@@ -342,12 +612,23 @@ def update_population_data(request, population_id):
     if not data:
         return Response({'error': 'Data not found.'}, status=status.HTTP_404_NOT_FOUND)
 
-    data.year = request.data.get('year', data.year)
-    data.population_count = request.data.get('population_count', data.population_count)
+    try:
+        data.year = int(request.data.get('year', data.year))
+        data.population_count = int(request.data.get('population_count', data.population_count))
+    except (TypeError, ValueError):
+        return Response({'error': 'year and population_count must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
     data.source = request.data.get('source', data.source)
+    rejected, held = _screen_writes([data], request.user)
+    if rejected is not None:
+        return rejected
+    if held:
+        return _quarantined_response(held[0])
     data.save()
 
-    return Response({'message': 'Population data updated successfully.'}, status=status.HTTP_200_OK)
+    return Response({
+        'message': 'Population data updated successfully.',
+        'anomaly_score': data.anomaly_score,
+    }, status=status.HTTP_200_OK)
 
 
 @api_view(['DELETE'])
@@ -378,6 +659,619 @@ def delete_population_data(request, population_id):
     return Response({'message': 'Population data deleted successfully.'}, status=status.HTTP_200_OK)
 
 
+# --- Bulk Population Management ---
+def _parse_bulk_changes(changes):
+    """Validates a {field: value} dict for the bulk endpoints; returns (cleaned, error)."""
+    if not isinstance(changes, dict) or not changes:
+        return None, 'changes must be a non-empty object.'
+    unknown = set(changes) - set(BULK_FIELDS)
+    if unknown:
+        return None, f'Unsupported fields: {", ".join(sorted(unknown))}.'
+    cleaned = {}
+    try:
+        for field, value in changes.items():
+            cleaned[field] = str(value) if field == 'source' else int(value)
+    except (TypeError, ValueError):
+        return None, 'year and population_count must be integers.'
+    return cleaned, None
+
+
+def _filter_population(spec):
+    """Builds a PopulationData queryset from {"city_id", "year_from", "year_to", "source"}."""
+    if not isinstance(spec, dict) or not spec:
+        return None, 'filter must be a non-empty object.'
+    unknown = set(spec) - {'city_id', 'year_from', 'year_to', 'source'}
+    if unknown:
+        return None, f'Unsupported filter keys: {", ".join(sorted(unknown))}.'
+    queryset = PopulationData.objects.all()
+    try:
+        if 'city_id' in spec:
+            queryset = queryset.filter(city_id=int(spec['city_id']))
+        if 'year_from' in spec:
+            queryset = queryset.filter(year__gte=int(spec['year_from']))
+        if 'year_to' in spec:
+            queryset = queryset.filter(year__lte=int(spec['year_to']))
+    except (TypeError, ValueError):
+        return None, 'city_id, year_from and year_to must be integers.'
+    if 'source' in spec:
+        queryset = queryset.filter(source=spec['source'])
+    return queryset, None
+
+
+def _chunked(items, size=BULK_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+@api_view(['PUT'])
+def bulk_update_population_data(request):
+    """
+    Update many population rows in one request, either per id:
+        {"items": [{"id": 1, "source": "PSA"}, {"id": 2, "population_count": 1200}]}
+    or by filter:
+        {"filter": {"city_id": 3, "year_from": 2015, "year_to": 2020, "source": "Old"}, "changes": {"source": "PSA"}}
+    Rows are written with bulk_update / one UPDATE per chunk inside a transaction, and the
+    change log is written once for the whole request; the snapshot and subscribers are
+    updated once it commits.
+    New years and counts are screened first: any rejected row fails the request, and
+    quarantined rows are held for review (listed in "quarantined") instead of written.
+    """
+    base = BasePopulationView()
+    if not base.check_permissions(request):
+        return Response({'error': 'Permission denied.'}, status=status.HTTP_403_FORBIDDEN)
+
+    items = request.data.get('items')
+    spec = request.data.get('filter')
+    if (items is None) == (spec is None):
+        return Response({'error': 'Provide either items or filter.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    changed_rows = []
+    missing = []
+    quarantined = []
+    with transaction.atomic():
+        if items is not None:
+            if not isinstance(items, list) or not items:
+                return Response({'error': 'items must be a non-empty list.'}, status=status.HTTP_400_BAD_REQUEST)
+            updates = {}
+            for item in items:
+                if not isinstance(item, dict) or 'id' not in item:
+                    return Response({'error': 'Every item needs an id.'}, status=status.HTTP_400_BAD_REQUEST)
+                changes, error = _parse_bulk_changes({k: v for k, v in item.items() if k != 'id'})
+                if error:
+                    return Response({'error': f'Item {item["id"]}: {error}'}, status=status.HTTP_400_BAD_REQUEST)
+                try:
+                    updates[int(item['id'])] = changes
+                except (TypeError, ValueError):
+                    return Response({'error': 'Item ids must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
+
+            rows = [
+                row
+                for chunk in _chunked(list(updates))
+                for row in PopulationData.objects.filter(id__in=chunk).only('id', 'city_id', 'area_id', *BULK_FIELDS)
+            ]
+            before = {row.id: (row.area_id, row.year, row.population_count) for row in rows}
+            fields = set()
+            for row in rows:
+                for field, value in updates[row.id].items():
+                    setattr(row, field, value)
+                    fields.add(field)
+
+            # New counts and years are screened as one batch; quarantined rows are not written
+            if {'year', 'population_count'} & fields:
+                rejected, held = _screen_writes(rows, request.user)
+                if rejected is not None:
+                    return rejected
+                quarantined = [rows[position].id for position in held]
+                rows = [row for position, row in enumerate(rows) if position not in held]
+                fields.add('anomaly_score')
+
+            for chunk in _chunked(rows):
+                PopulationData.objects.bulk_update(chunk, sorted(fields))
+            apply_changes(
+                removed=[before[row.id] for row in rows],
+                added=[(row.area_id, row.year, row.population_count) for row in rows],
+            )
+            record_actuals(
+                [(row.city_id, before[row.id][1]) for row in rows] + [(row.city_id, row.year) for row in rows]
+            )
+            changed_rows = [(row.id, row.city_id) for row in rows]
+            missing = [row_id for row_id in updates if row_id not in before]
+        else:
+            queryset, error = _filter_population(spec)
+            if not error:
+                changes, error = _parse_bulk_changes(request.data.get('changes'))
+            if error:
+                return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+
+            targets = list(queryset.values_list('id', 'city_id', 'area_id', 'year', 'population_count', 'source'))
+            rows = [
+                PopulationData(
+                    id=row_id, city_id=city_id, area_id=area_id,
+                    year=changes.get('year', year),
+                    population_count=changes.get('population_count', population),
+                    source=changes.get('source', source),
+                )
+                for row_id, city_id, area_id, year, population, source in targets
+            ]
+            screened = bool({'year', 'population_count'} & set(changes))
+            if screened:
+                rejected, held = _screen_writes(rows, request.user)
+                if rejected is not None:
+                    return rejected
+                quarantined = [rows[position].id for position in held]
+                targets = [row for position, row in enumerate(targets) if position not in held]
+                rows = [row for position, row in enumerate(rows) if position not in held]
+                changes = {**changes, 'anomaly_score': None}
+
+            for chunk in _chunked(targets):
+                PopulationData.objects.filter(id__in=[row[0] for row in chunk]).update(**changes)
+            if screened:
+                flagged = [row for row in rows if row.anomaly_score is not None]
+                PopulationData.objects.bulk_update(flagged, ['anomaly_score'], batch_size=BULK_CHUNK_SIZE)
+                apply_changes(
+                    removed=[(area_id, year, population) for _, _, area_id, year, population, _ in targets],
+                    added=[(row.area_id, row.year, row.population_count) for row in rows],
+                )
+                record_actuals(
+                    [(city_id, year) for _, city_id, _, year, _, _ in targets] + [(row.city_id, row.year) for row in rows]
+                )
+            changed_rows = [(row_id, city_id) for row_id, city_id, *_ in targets]
+
+        if changed_rows:
+            record_changes('population', changed_rows, 'upsert')
+            transaction.on_commit(dataset_changed)
+
+    return Response({
+        'message': 'Population data updated successfully.',
+        'updated': len(changed_rows),
+        'cities': sorted({city_id for _, city_id in changed_rows}),
+        'missing': missing,
+        'quarantined': quarantined,
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['POST', 'DELETE'])
+def bulk_delete_population_data(request):
+    """
+    Delete many population rows in one request: {"ids": [1, 2, 3]} or
+    {"filter": {"city_id": 3, "year_from": 2015, "year_to": 2020, "source": "Old"}}.
+    Deletes run per chunk inside a transaction; tombstones are logged in bulk and the
+    snapshot is invalidated once the whole request commits.
+    """
+    base = BasePopulationView()
+    if not base.check_permissions(request):
+        return Response({'error': 'Permission denied.'}, status=status.HTTP_403_FORBIDDEN)
+
+    ids = request.data.get('ids')
+    spec = request.data.get('filter')
+    if (ids is None) == (spec is None):
+        return Response({'error': 'Provide either ids or filter.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    if ids is not None:
+        if not isinstance(ids, list) or not ids:
+            return Response({'error': 'ids must be a non-empty list.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            ids = [int(row_id) for row_id in ids]
+        except (TypeError, ValueError):
+            return Response({'error': 'ids must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
+    else:
+        queryset, error = _filter_population(spec)
+        if error:
+            return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+
+    with transaction.atomic(), bulk_write():
+        fields = ('id', 'city_id', 'area_id', 'year', 'population_count')
+        if ids is not None:
+            rows = [
+                row
+                for chunk in _chunked(ids)
+                for row in PopulationData.objects.filter(id__in=chunk).values_list(*fields)
+            ]
+        else:
+            rows = list(queryset.values_list(*fields))
+        targets = [(row_id, city_id) for row_id, city_id, *_ in rows]
+        for chunk in _chunked(targets):
+            PopulationData.objects.filter(id__in=[row_id for row_id, _ in chunk]).delete()
+
+        if targets:
+            apply_changes(removed=[(area_id, year, population) for _, _, area_id, year, population in rows])
+            record_actuals([(city_id, year) for _, city_id, _, year, _ in rows])
+            record_changes('population', targets, 'delete')
+            transaction.on_commit(dataset_changed)
+
+    deleted = {row_id for row_id, _ in targets}
+    return Response({
+        'message': 'Population data deleted successfully.',
+        'deleted': len(targets),
+        'cities': sorted({city_id for _, city_id in targets}),
+        'missing': [row_id for row_id in ids if row_id not in deleted] if ids is not None else [],
+    }, status=status.HTTP_200_OK)
+
+
+# --- Sub-annual Observations ---
+def _parse_observation(item):
+    """Validates one uploaded observation; returns ((city_id, year, granularity, period, count, source), error)."""
+    if not isinstance(item, dict):
+        return None, 'Every observation must be an object.'
+    if ('quarter' in item) == ('month' in item):
+        return None, 'Every observation needs either quarter or month.'
+    granularity = 'quarter' if 'quarter' in item else 'month'
+    try:
+        city_id, year, period, population_count = (
+            int(item.get('city_id')), int(item.get('year')), int(item[granularity]), int(item.get('population_count'))
+        )
+    except (TypeError, ValueError):
+        return None, 'city_id, year, quarter / month and population_count must be integers.'
+    if not 1 <= period <= GRANULARITY_PERIODS[granularity]:
+        return None, f'{granularity} must be between 1 and {GRANULARITY_PERIODS[granularity]}.'
+    return (city_id, year, granularity, period, population_count, str(item.get('source', ''))), None
+
+
+@api_view(['POST'])
+def add_population_observations(request):
+    """
+    Store quarterly or monthly counts, replacing any already stored for the same period:
+    {"observations": [{"city_id": 3, "year": 2024, "quarter": 2, "population_count": 1200,
+    "source": "Registry"}, {"city_id": 3, "year": 2024, "month": 7, ...}]}
+    They do not appear in histories (which stay yearly) but fill in forecasts for years
+    without a yearly row, and are served resampled by /api/cities/<id>/series/.
+    """
+    base = BasePopulationView()
+    if not base.check_permissions(request):
+        return Response({'error': 'Permission denied.'}, status=status.HTTP_403_FORBIDDEN)
+
+    items = request.data.get('observations')
+    if not isinstance(items, list) or not items:
+        return Response({'error': 'observations must be a non-empty list.'}, status=status.HTTP_400_BAD_REQUEST)
+    observations = {}
+    for item in items:
+        parsed, error = _parse_observation(item)
+        if error:
+            return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+        # A period listed twice keeps its last value
+        observations[parsed[:4]] = parsed[4:]
+
+    city_ids = sorted({city_id for city_id, *_ in observations})
+    existing_cities = {
+        city_id
+        for chunk in _chunked(city_ids)
+        for city_id in City.objects.filter(id__in=chunk).values_list('id', flat=True)
+    }
+    unknown = [city_id for city_id in city_ids if city_id not in existing_cities]
+    if unknown:
+        return Response({'error': 'Cities not found.', 'missing': unknown}, status=status.HTTP_404_NOT_FOUND)
+
+    with transaction.atomic():
+        years = {year for _, year, *_ in observations}
+        stored = {
+            (row.city_id, row.year, row.granularity, row.period): row
+            for chunk in _chunked(city_ids)
+            for row in PopulationObservation.objects.filter(city_id__in=chunk, year__in=years)
+        }
+        created, updated = [], []
+        for key, (population_count, source) in observations.items():
+            row = stored.get(key)
+            if row is None:
+                city_id, year, granularity, period = key
+                created.append(PopulationObservation(
+                    city_id=city_id, year=year, granularity=granularity, period=period,
+                    population_count=population_count, source=source, created_by=request.user,
+                ))
+            else:
+                row.population_count, row.source = population_count, source
+                updated.append(row)
+        try:
+            with transaction.atomic():
+                PopulationObservation.objects.bulk_create(created, batch_size=BULK_CHUNK_SIZE // 10)
+        except IntegrityError:
+            return Response({'error': 'Observations for these periods were stored concurrently; retry.'},
+                            status=status.HTTP_409_CONFLICT)
+        PopulationObservation.objects.bulk_update(updated, ['population_count', 'source'], batch_size=BULK_CHUNK_SIZE // 10)
+
+        # Their forecasts changed; delta-sync clients pick them up through the cities
+        record_changes('city', [(city_id, city_id) for city_id in city_ids], 'upsert')
+        transaction.on_commit(dataset_changed)
+
+    return Response({
+        'message': 'Observations stored successfully.',
+        'created': len(created),
+        'updated': len(updated),
+        'cities': city_ids,
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@throttle_classes([SingleCityThrottle])
+def get_city_series(request, city_id):
+    """
+    A city's yearly rows and sub-annual observations on one axis, resampled:
+    GET [?frequency=annual|quarterly|monthly][&max_points=N]. Each point is the last count
+    of its period (a yearly row counts as the end of its year); growth is the percent
+    change from the previous period, computed before any downsampling. kind tells yearly
+    rows from observations.
+    """
+    frequency = request.query_params.get('frequency', 'annual')
+    if frequency not in FREQUENCIES:
+        return Response({'error': f'frequency must be one of {", ".join(FREQUENCIES)}.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    max_points, error = _parse_max_points(request.query_params)
+    if error:
+        return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+
+    snapshot = get_snapshot()
+    record = snapshot.get_city(city_id)
+    if not record:
+        return Response({'error': 'City not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    buckets, populations, source_ids, is_row = snapshot.resampled(record, frequency)
+    growth = period_growth(populations)
+    if max_points is not None:
+        kept = lttb(buckets, populations, max_points)
+        buckets, populations, source_ids, is_row, growth = (
+            buckets[kept], populations[kept], source_ids[kept], is_row[kept], growth[kept]
+        )
+    years, periods = bucket_period(buckets, frequency)
+    sources = snapshot.sources
+    return Response({
+        'id': record.id,
+        'name': record.name,
+        'frequency': frequency,
+        'points': [
+            {
+                'year': year,
+                'period': period if frequency != 'annual' else None,
+                'population': population,
+                'source': sources[source_id],
+                'growth': None if point_growth != point_growth else round(point_growth, 2),
+                'kind': 'yearly' if row else 'observation',
+            }
+            for year, period, population, source_id, point_growth, row in zip(
+                years.tolist(), periods.tolist(), populations.tolist(), source_ids.tolist(),
+                growth.tolist(), is_row.tolist(),
+            )
+        ],
+    }, status=status.HTTP_200_OK)
+
+
+# --- Quarantine Review ---
+@api_view(['GET'])
+def get_quarantined_population(request):
+    """
+    Writes held back by anomaly screening, oldest first:
+    GET [?status=pending|released|discarded][&city_id=3][&after=<quarantine id>][&limit=100]
+    """
+    base = BasePopulationView()
+    if not base.check_permissions(request):
+        return Response({'error': 'Permission denied.'}, status=status.HTTP_403_FORBIDDEN)
+
+    params = request.query_params
+    entry_status = params.get('status', 'pending')
+    if entry_status not in dict(QuarantinedPopulation.STATUS_CHOICES):
+        return Response({'error': 'status must be pending, released or discarded.'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        after = int(params.get('after', 0))
+        limit = min(max(int(params.get('limit', DEFAULT_QUARANTINE_PAGE)), 1), MAX_QUARANTINE_PAGE)
+        city_id = int(params['city_id']) if 'city_id' in params else None
+    except ValueError:
+        return Response({'error': 'after, limit and city_id must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    entries = QuarantinedPopulation.objects.filter(status=entry_status, id__gt=after)
+    if city_id is not None:
+        entries = entries.filter(city_id=city_id)
+    entries = list(entries.order_by('id')[:limit + 1])
+    return Response({
+        'results': [_quarantine_data(entry) for entry in entries[:limit]],
+        'next': entries[limit - 1].id if len(entries) > limit else None,
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+def review_quarantined_population(request):
+    """
+    Release quarantined writes (written as submitted, keeping their anomaly score as a
+    flag) or discard them: {"release": [1, 2], "discard": [3]}. Only pending entries are
+    reviewed; the writes go through in bulk and are logged and broadcast once. Releasing
+    several entries that change the same row is rejected.
+    """
+    base = BasePopulationView()
+    if not base.check_permissions(request):
+        return Response({'error': 'Permission denied.'}, status=status.HTTP_403_FORBIDDEN)
+
+    decisions = {}
+    for decision in ('release', 'discard'):
+        ids = request.data.get(decision, [])
+        if not isinstance(ids, list):
+            return Response({'error': f'{decision} must be a list of ids.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            # An id listed twice is reviewed once
+            decisions[decision] = list(dict.fromkeys(int(entry_id) for entry_id in ids))
+        except (TypeError, ValueError):
+            return Response({'error': 'Quarantine ids must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
+    if not decisions['release'] and not decisions['discard']:
+        return Response({'error': 'Provide ids to release or discard.'}, status=status.HTTP_400_BAD_REQUEST)
+    if set(decisions['release']) & set(decisions['discard']):
+        return Response({'error': 'An id cannot be both released and discarded.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    with transaction.atomic(), bulk_write():
+        released = [
+            entry
+            for chunk in _chunked(decisions['release'])
+            for entry in QuarantinedPopulation.objects.select_for_update().filter(id__in=chunk, status='pending')
+        ]
+        # Two held changes of one row would each be applied to the rollups
+        targets = Counter(entry.population_id for entry in released if entry.population_id)
+        shared = sorted(population_id for population_id, count in targets.items() if count > 1)
+        if shared:
+            return Response({
+                'error': 'Several entries change the same population rows; release one and discard the others.',
+                'population_ids': shared,
+            }, status=status.HTTP_400_BAD_REQUEST)
+        rows = release(released, request.user)
+        discarded = 0
+        for chunk in _chunked(decisions['discard']):
+            discarded += QuarantinedPopulation.objects.filter(id__in=chunk, status='pending').update(
+                status='discarded', reviewed_by=request.user, reviewed_at=timezone.now(),
+            )
+        if rows:
+            record_changes('population', [(row.id, row.city_id) for row in rows], 'upsert')
+            transaction.on_commit(dataset_changed)
+
+    return Response({
+        'message': 'Quarantined population data reviewed.',
+        'released': [entry.id for entry in released],
+        'population_ids': [row.id for row in rows],
+        'discarded': discarded,
+    }, status=status.HTTP_200_OK)
+
+
+# --- Area Hierarchy ---
+def _area_data(area):
+    return {
+        'id': area.id,
+        'name': area.name,
+        'level': area.level,
+        'parent_id': area.parent_id,
+        'path': area.path,
+        'depth': area.depth,
+    }
+
+
+@api_view(['POST'])
+def add_area(request):
+    """
+    Add a node to the area hierarchy: {"name": "Region VII", "level": "region", "parent_id": 1}.
+    With "city_id" the city is placed at the new area and its population rows count towards it.
+    """
+    base = BasePopulationView()
+    if not base.check_permissions(request):
+        return Response({'error': 'Permission denied.'}, status=status.HTTP_403_FORBIDDEN)
+
+    name = request.data.get('name')
+    level = request.data.get('level')
+    parent_id = request.data.get('parent_id')
+    city_id = request.data.get('city_id')
+    if not name:
+        return Response({'error': 'Area name is required.'}, status=status.HTTP_400_BAD_REQUEST)
+    if level not in dict(Area.LEVEL_CHOICES):
+        return Response({'error': f'level must be one of {", ".join(dict(Area.LEVEL_CHOICES))}.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    parent = None
+    if parent_id is not None:
+        parent = Area.objects.filter(id=parent_id).first()
+        if not parent:
+            return Response({'error': 'Parent area not found.'}, status=status.HTTP_404_NOT_FOUND)
+    city = None
+    if city_id is not None:
+        city = base.get_city(city_id)
+        if not city:
+            return Response({'error': 'City not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+    with transaction.atomic():
+        area = create_area(name, level, parent)
+        if city is not None:
+            city.area = area
+            city.save(update_fields=['area'])
+
+    return Response({'message': f'Area {name} added successfully.', 'area': _area_data(area)},
+                    status=status.HTTP_201_CREATED)
+
+
+@api_view(['PUT'])
+def reparent_area(request, area_id):
+    """
+    Move an area and its whole subtree under another parent: {"parent_id": 5}
+    (null makes it a root). Paths and yearly totals are updated in one transaction.
+    """
+    base = BasePopulationView()
+    if not base.check_permissions(request):
+        return Response({'error': 'Permission denied.'}, status=status.HTTP_403_FORBIDDEN)
+
+    area = Area.objects.filter(id=area_id).first()
+    if not area:
+        return Response({'error': 'Area not found.'}, status=status.HTTP_404_NOT_FOUND)
+    parent_id = request.data.get('parent_id')
+    parent = None
+    if parent_id is not None:
+        parent = Area.objects.filter(id=parent_id).first()
+        if not parent:
+            return Response({'error': 'Parent area not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+    try:
+        area = move_area(area, parent)
+    except ValueError as exc:
+        return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({'message': 'Area moved successfully.', 'area': _area_data(area)}, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def get_area_population(request, area_id):
+    """
+    Population of an area including everything below it: ?year=2020 for one year (a
+    single indexed read of the stored rollup), or every stored year without it.
+    """
+    area = Area.objects.filter(id=area_id).first()
+    if not area:
+        return Response({'error': 'Area not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+    year = request.query_params.get('year')
+    if year not in (None, ''):
+        try:
+            year = int(year)
+        except ValueError:
+            return Response({'error': 'year must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'area': _area_data(area), 'year': year, 'total': area_total(area.id, year)},
+                        status=status.HTTP_200_OK)
+
+    totals = area.rollups.order_by('year').values_list('year', 'total')
+    return Response({
+        'area': _area_data(area),
+        'totals': [{'year': year, 'total': total} for year, total in totals],
+    }, status=status.HTTP_200_OK)
+
+
+# --- Forecast Accuracy ---
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@throttle_classes([AllCitiesThrottle])
+def get_forecast_accuracy(request):
+    """
+    Error of archived forecasts against the actual figures of their target years:
+    GET [?group_by=engine,region][&engine=linear][&region=NCR][&city_id=3][&target_year=2025]
+    group_by takes any of city, region, engine and target_year (default engine). MAE and
+    bias are in people, MAPE in percent; all come from the error columns stored when the
+    actual figure arrived.
+    """
+    params = request.query_params
+    group_by = [group for group in params.get('group_by', 'engine').split(',') if group]
+    unknown = [group for group in group_by if group not in ACCURACY_GROUPS]
+    if unknown or not group_by:
+        return Response({'error': f'group_by must list any of {", ".join(ACCURACY_GROUPS)}.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    group_by = list(dict.fromkeys(group_by))
+
+    forecasts = ForecastArchive.objects.all()
+    if 'engine' in params:
+        engines = {name: value for value, name in ForecastArchive.ENGINE_CHOICES}
+        if params['engine'] not in engines:
+            return Response({'error': f'engine must be one of {", ".join(engines)}.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        forecasts = forecasts.filter(engine=engines[params['engine']])
+    if 'region' in params:
+        forecasts = forecasts.filter(city__region=params['region'])
+    try:
+        if 'city_id' in params:
+            forecasts = forecasts.filter(city_id=int(params['city_id']))
+        if 'target_year' in params:
+            forecasts = forecasts.filter(target_year=int(params['target_year']))
+    except ValueError:
+        return Response({'error': 'city_id and target_year must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response({'group_by': group_by, 'results': accuracy(forecasts, group_by)}, status=status.HTTP_200_OK)
+
+
 # --- Admin Helper APIs ---
 def get_admins(request):
     admins = User.objects.filter(role='admin')
@@ -399,19 +1293,25 @@ def delete_admin(request, admin_id):
 @api_view(['PUT']) # optional, can remove if you want open access
 def update_city(request, city_id):
     """
-    Update city name and region by ID.
-    Example body: {"city_name": "Quezon City", "region": "NCR"}
+    Update city name, region and location by ID.
+    Example body: {"city_name": "Quezon City", "region": "NCR", "latitude": 14.676, "longitude": 121.0437}
+    (latitude and longitude null clear the location)
     """
     city = get_object_or_404(City, id=city_id)
     data = request.data
 
     city_name = data.get('city_name')
     region = data.get('region')
+    location, error = _parse_location(data)
+    if error:
+        return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
 
     if city_name:
         city.city_name = city_name
     if region:
         city.region = region
+    if 'latitude' in data or 'longitude' in data:
+        city.latitude, city.longitude = location or (None, None)
 
     city.save()
 
@@ -420,74 +1320,169 @@ def update_city(request, city_id):
         'city': {
             'id': city.id,
             'city_name': city.city_name,
-            'region': city.region
+            'region': city.region,
+            'latitude': city.latitude,
+            'longitude': city.longitude,
         }
     }, status=status.HTTP_200_OK)
 
 
+@api_view(['PUT'])
+def bulk_update_city_locations(request):
+    """
+    Set the coordinates of many cities at once (e.g. after importing a gazetteer):
+        {"items": [{"id": 1, "latitude": 14.5995, "longitude": 120.9842}, ...]}
+    Written with bulk_update per chunk inside a transaction; the change log is written once
+    for the whole request, and the city lookup and snapshot (with its location index) are
+    invalidated once it commits.
+    """
+    base = BasePopulationView()
+    if not base.check_permissions(request):
+        return Response({'error': 'Permission denied.'}, status=status.HTTP_403_FORBIDDEN)
+
+    items = request.data.get('items')
+    if not isinstance(items, list) or not items:
+        return Response({'error': 'items must be a non-empty list.'}, status=status.HTTP_400_BAD_REQUEST)
+    locations = {}
+    for item in items:
+        if not isinstance(item, dict) or 'id' not in item:
+            return Response({'error': 'Every item needs an id.'}, status=status.HTTP_400_BAD_REQUEST)
+        location, error = _parse_location(item)
+        if error:
+            return Response({'error': f'Item {item["id"]}: {error}'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            locations[int(item['id'])] = location or (None, None)
+        except (TypeError, ValueError):
+            return Response({'error': 'Item ids must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    updated = []
+    with transaction.atomic():
+        for chunk in _chunked(list(locations)):
+            cities = list(City.objects.filter(id__in=chunk).only('id', 'latitude', 'longitude'))
+            for city in cities:
+                city.latitude, city.longitude = locations[city.id]
+            City.objects.bulk_update(cities, ['latitude', 'longitude'])
+            updated.extend(city.id for city in cities)
+
+        if updated:
+            record_changes('city', [(city_id, city_id) for city_id in updated], 'upsert')
+            transaction.on_commit(city_cache.bump_city_version)
+            transaction.on_commit(dataset_changed)
+
+    found = set(updated)
+    return Response({
+        'message': 'City locations updated successfully.',
+        'updated': len(updated),
+        'missing': [city_id for city_id in locations if city_id not in found],
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@throttle_classes([NearbyThrottle])
+def get_nearby_cities(request):
+    """
+    Cities nearest to a point, nearest first, with their latest population and forecast:
+    GET ?lat=14.6&lon=121.0 or ?city_id=3 (centered on that city, which is left out),
+    [&limit=10][&radius_km=50]. Served from the snapshot's KD-tree over city coordinates.
+    """
+    params = request.query_params
+    snapshot = get_snapshot()
+    center = None
+    if 'city_id' in params:
+        try:
+            center = snapshot.get_city(int(params['city_id']))
+        except ValueError:
+            return Response({'error': 'city_id must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+        if center is None:
+            return Response({'error': 'City not found'}, status=status.HTTP_404_NOT_FOUND)
+        location = snapshot.location(center)
+        if location is None:
+            return Response({'error': 'City has no location.'}, status=status.HTTP_400_BAD_REQUEST)
+    else:
+        location, error = _parse_location({'latitude': params.get('lat'), 'longitude': params.get('lon')})
+        if error or location is None:
+            return Response({'error': error or 'Provide lat and lon, or city_id.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        limit = int(params.get('limit', DEFAULT_NEARBY_RESULTS))
+        radius_km = float(params['radius_km']) if 'radius_km' in params else None
+    except ValueError:
+        return Response({'error': 'limit and radius_km must be numbers.'}, status=status.HTTP_400_BAD_REQUEST)
+    if not 1 <= limit <= MAX_NEARBY_RESULTS:
+        return Response({'error': f'limit must be between 1 and {MAX_NEARBY_RESULTS}.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if radius_km is not None and not radius_km > 0:
+        return Response({'error': 'radius_km must be positive.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    neighbours = snapshot.location_index().nearest(*location, limit=limit, radius_km=radius_km, exclude=center)
+    forecasts = snapshot.forecast_many([record for record, _ in neighbours])
+
+    result = []
+    for (record, distance), (predicted_year, predicted_population) in zip(neighbours, forecasts):
+        latitude, longitude = snapshot.location(record)
+        result.append({
+            'id': record.id,
+            'name': record.name,
+            'region': record.region,
+            'latitude': latitude,
+            'longitude': longitude,
+            'distance_km': round(distance, 3),
+            'latest_population': snapshot.latest_population(record),
+            'predicted_year': predicted_year,
+            'predicted_population': predicted_population,
+        })
+
+    return Response({
+        'center': {'city_id': center.id if center else None, 'latitude': location[0], 'longitude': location[1]},
+        'radius_km': radius_km,
+        'cities': result,
+    }, status=status.HTTP_200_OK)
+
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
+@throttle_classes([AllCitiesThrottle])
 def generate_ml_summary_report(request):
     """
     Generate a comprehensive paragraph summary of population predictions
     for the next year using machine learning analysis.
     """
-    base = BasePopulationView()
-    cities = City.objects.all()
+    snapshot = get_snapshot()
 
-    if not cities.exists():
+    if not snapshot.cities:
         return Response({
             'summary': 'No city data available for analysis.',
             'year': datetime.now().year + 1
         }, status=status.HTTP_200_OK)
 
-    # Collect predictions and analysis data
-    total_predicted_population = 0
-    city_predictions = []
-    growth_rates = []
+    # Everything comes from the precomputed ranking arrays; only the cities the text names are sorted
+    rankings = snapshot.rankings()
     current_year = datetime.now().year
     next_year = current_year + 1
-
-    for city in cities:
-        population_data = PopulationData.objects.filter(city=city).order_by('year')
-
-        if population_data.exists():
-            predicted_year, predicted_population = base.predict_next_year_population(population_data)
-
-            # Calculate average historical growth rate
-            history = base.calculate_growth(population_data)
-            valid_growth = [h['growth'] for h in history if h['growth'] is not None]
-            avg_growth = np.mean(valid_growth) if valid_growth else 0
-
-            # Get latest actual population
-            latest_data = population_data.last()
-            latest_population = latest_data.population_count
-
-            # Calculate predicted change
-            predicted_change = predicted_population - latest_population
-            predicted_growth_rate = (predicted_change / latest_population * 100) if latest_population > 0 else 0
-
-            city_predictions.append({
-                'name': city.city_name,
-                'region': city.region,
-                'current_population': latest_population,
-                'predicted_population': predicted_population,
-                'predicted_change': predicted_change,
-                'predicted_growth_rate': predicted_growth_rate,
-                'avg_historical_growth': avg_growth
-            })
-
-            total_predicted_population += predicted_population
-            growth_rates.append(predicted_growth_rate)
-
-    # Sort cities by predicted population
-    city_predictions.sort(key=lambda x: x['predicted_population'], reverse=True)
+    evaluated = rankings.all_cities
+    total_predicted_population = int(rankings.predicted[evaluated].sum())
+    growth_rates = rankings.metrics['predicted_growth'][evaluated]
+
+    def city_prediction(index):
+        record = snapshot.cities[index]
+        return {
+            'name': record.name,
+            'region': record.region,
+            'current_population': int(rankings.latest[index]),
+            'predicted_population': int(rankings.predicted[index]),
+            'predicted_change': int(rankings.predicted_change[index]),
+            'predicted_growth_rate': float(rankings.metrics['predicted_growth'][index]),
+        }
 
     # Identify key insights
-    fastest_growing = max(city_predictions, key=lambda x: x['predicted_growth_rate']) if city_predictions else None
-    slowest_growing = min(city_predictions, key=lambda x: x['predicted_growth_rate']) if city_predictions else None
-    largest_city = city_predictions[0] if city_predictions else None
-    avg_growth_rate = np.mean(growth_rates) if growth_rates else 0
+    top_three = [city_prediction(index) for index in rankings.top('predicted_population', 3)]
+    fastest = rankings.top('predicted_growth', 1)
+    slowest = rankings.top('predicted_growth', 1, ascending=True)
+    fastest_growing = city_prediction(fastest[0]) if len(fastest) else None
+    slowest_growing = city_prediction(slowest[0]) if len(slowest) else None
+    largest_city = top_three[0] if top_three else None
+    avg_growth_rate = float(np.mean(growth_rates)) if len(growth_rates) else 0
 
     # Generate comprehensive paragraph summary
     summary_parts = []
@@ -495,7 +1490,7 @@ def generate_ml_summary_report(request):
     # Opening statement
     summary_parts.append(
         f"Based on machine learning analysis using Linear Regression models trained on historical population data, "
-        f"the total projected population across all {len(city_predictions)} cities for {next_year} is estimated at "
+        f"the total projected population across all {len(evaluated)} cities for {next_year} is estimated at "
         f"{total_predicted_population:,} people, representing an overall average growth rate of {avg_growth_rate:.2f}%."
     )
 
@@ -516,8 +1511,7 @@ def generate_ml_summary_report(request):
         )
 
     # Top 3 cities breakdown
-    if len(city_predictions) >= 3:
-        top_three = city_predictions[:3]
+    if len(top_three) >= 3:
         top_three_text = ", ".join([
             f"{c['name']} ({c['predicted_population']:,})" for c in top_three[:2]
         ]) + f", and {top_three[2]['name']} ({top_three[2]['predicted_population']:,})"
@@ -540,9 +1534,209 @@ def generate_ml_summary_report(request):
     return Response({
         'summary': full_summary,
         'year': next_year,
-        'total_cities': len(city_predictions),
+        'total_cities': len(evaluated),
         'total_predicted_population': total_predicted_population,
         'average_growth_rate': round(avg_growth_rate, 2),
         'methodology': 'Linear Regression Machine Learning Model',
         'generated_at': datetime.now().isoformat()
-    }, status=status.HTTP_200_OK)
\ No newline at end of file
+    }, status=status.HTTP_200_OK)
+
+
+# --- Rankings ---
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@throttle_classes([RankingsThrottle])
+def get_rankings(request):
+    """
+    Leaderboard of cities: GET ?metric=predicted_growth[&order=top|bottom][&k=20][&region=Region VII].
+    Metrics: predicted_population, predicted_growth (% over the latest population),
+    predicted_change (people), historical_growth (mean yearly %) and absolute_change (latest
+    minus first recorded population). Cities without population data are not ranked.
+    """
+    params = request.query_params
+    metric = params.get('metric', 'predicted_population')
+    if metric not in RANKING_METRICS:
+        return Response({'error': f'metric must be one of {", ".join(RANKING_METRICS)}.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    order = params.get('order', 'top')
+    if order not in ('top', 'bottom'):
+        return Response({'error': 'order must be top or bottom.'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        k = int(params.get('k', DEFAULT_RANKING_RESULTS))
+    except ValueError:
+        return Response({'error': 'k must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+    if not 1 <= k <= MAX_RANKING_RESULTS:
+        return Response({'error': f'k must be between 1 and {MAX_RANKING_RESULTS}.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    region = params.get('region') or None
+
+    snapshot = get_snapshot()
+    rankings = snapshot.rankings()
+    values = rankings.metrics[metric]
+    results = []
+    for rank, index in enumerate(rankings.top(metric, k, region, ascending=order == 'bottom').tolist(), start=1):
+        record = snapshot.cities[index]
+        value = float(values[index])
+        results.append({
+            'rank': rank,
+            'id': record.id,
+            'name': record.name,
+            'region': record.region,
+            'value': round(value, 2) if metric in ('predicted_growth', 'historical_growth') else int(value),
+            'latest_population': int(rankings.latest[index]),
+            'predicted_year': int(rankings.predicted_years[index]),
+            'predicted_population': int(rankings.predicted[index]),
+        })
+
+    return Response({
+        'metric': metric,
+        'order': order,
+        'region': region,
+        'results': results,
+    }, status=status.HTTP_200_OK)
+
+
+# --- Growth Similarity ---
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@throttle_classes([SimilarThrottle])
+def get_similar_cities(request, city_id):
+    """
+    Cities whose growth trajectory is closest to this city's, closest first: GET [?limit=10]
+    (at most the STORED_NEIGHBOURS kept per city). distance is the root mean square
+    difference of yearly log growth, in percentage points, over the shared_years both cities
+    have in the comparison window. Cities with fewer than two growth years have no neighbours.
+    stale is true while the index of the current dataset is computed, and the previous one's
+    is served (cities added since have no neighbours yet).
+    """
+    snapshot = get_snapshot()
+    record = snapshot.get_city(city_id)
+    if record is None:
+        return Response({'error': 'City not found'}, status=status.HTTP_404_NOT_FOUND)
+    try:
+        limit = int(request.query_params.get('limit', DEFAULT_NEARBY_RESULTS))
+    except ValueError:
+        return Response({'error': 'limit must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+    if not 1 <= limit <= STORED_NEIGHBOURS:
+        return Response({'error': f'limit must be between 1 and {STORED_NEIGHBOURS}.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    similarity = snapshot.similarity()
+    results = []
+    for index, distance, shared_years in similarity.similar(record.index, limit):
+        neighbour = snapshot.cities[index]
+        results.append({
+            'id': neighbour.id,
+            'name': neighbour.name,
+            'region': neighbour.region,
+            'distance': round(distance, 4),
+            'shared_years': shared_years,
+            'cluster': int(similarity.labels[index]),
+            'latest_population': snapshot.latest_population(neighbour),
+        })
+
+    cluster = int(similarity.labels[record.index])
+    return Response({
+        'id': record.id,
+        'name': record.name,
+        'region': record.region,
+        'cluster': cluster if cluster >= 0 else None,
+        'window': [similarity.start_year, similarity.start_year + SIMILARITY_WINDOW_YEARS - 1],
+        'stale': similarity.stale,
+        'results': results,
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@throttle_classes([ClustersThrottle])
+def get_city_clusters(request):
+    """
+    k-means clusters of cities by growth trajectory: GET lists every cluster with its size,
+    its profile (mean yearly log growth in % per year of the window) and a few members;
+    ?cluster=3 returns that cluster with all its members. Cities with fewer than two growth
+    years are in no cluster. stale is true while the previous dataset's clusters are served.
+    """
+    snapshot = get_snapshot()
+    similarity = snapshot.similarity()
+    clusters = range(len(similarity.sizes))
+    if 'cluster' in request.query_params:
+        try:
+            cluster = int(request.query_params['cluster'])
+        except ValueError:
+            return Response({'error': 'cluster must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+        if cluster not in clusters:
+            return Response({'error': 'Cluster not found'}, status=status.HTTP_404_NOT_FOUND)
+        clusters = [cluster]
+        shown = None
+    else:
+        shown = CLUSTER_SAMPLE_SIZE
+
+    result = []
+    for cluster in clusters:
+        if not similarity.sizes[cluster]:
+            continue
+        members = similarity.members(cluster)[:shown].tolist()
+        result.append({
+            'cluster': cluster,
+            'size': int(similarity.sizes[cluster]),
+            'profile': [round(value, 2) for value in similarity.centroids[cluster].tolist()],
+            'members': [
+                {'id': snapshot.cities[index].id, 'name': snapshot.cities[index].name,
+                 'region': snapshot.cities[index].region}
+                for index in members
+            ],
+        })
+
+    return Response({
+        'window': [similarity.start_year, similarity.start_year + SIMILARITY_WINDOW_YEARS - 1],
+        'stale': similarity.stale,
+        'clusters': result,
+    }, status=status.HTTP_200_OK)
+
+
+# --- Scenario Simulation ---
+@api_view(['GET', 'POST'])
+@permission_classes([AllowAny])
+@throttle_classes([SimulationThrottle])
+def simulate_population(request):
+    """
+    Monte Carlo growth scenarios: GET ?horizon=10&paths=1000[&seed=1] or POST
+    {"horizon": 10, "paths": 1000, "shocks": {"NCR": -1.5}, "seed": 1}. Every path draws
+    each year's growth from the city's historical growth rates (plus the region's shock,
+    in percentage points); returns p5/p25/p50/p75/p95 bands per city and per region.
+    Plain JSON is streamed city by city, as the cities listing (?stream=false to buffer).
+    """
+    params = request.data if request.method == 'POST' else request.query_params
+    try:
+        horizon = int(params.get('horizon', DEFAULT_SIMULATION_HORIZON))
+        paths = int(params.get('paths', DEFAULT_SIMULATION_PATHS))
+        seed = params.get('seed')
+        seed = int(seed) if seed not in (None, '') else None
+    except (TypeError, ValueError):
+        return Response({'error': 'horizon, paths and seed must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
+    if not 1 <= horizon <= MAX_SIMULATION_HORIZON:
+        return Response({'error': f'horizon must be between 1 and {MAX_SIMULATION_HORIZON}.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if not 1 <= paths <= MAX_SIMULATION_PATHS:
+        return Response({'error': f'paths must be between 1 and {MAX_SIMULATION_PATHS}.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    shocks = request.data.get('shocks') if request.method == 'POST' else None
+    if shocks is not None:
+        if not isinstance(shocks, dict):
+            return Response({'error': 'shocks must be an object of region: percentage points.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            shocks = {str(region): float(shock) for region, shock in shocks.items()}
+        except (TypeError, ValueError):
+            return Response({'error': 'Every shock must be a number.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        simulation = Simulation(get_snapshot(), horizon, paths, shocks, seed)
+    except ValueError as exc:
+        return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+    if wants_stream(request):
+        # Every city's bands go out as soon as its chunk is simulated; region totals come last
+        return streaming_json_response(iter_object_json(simulation.head(), 'cities', simulation.cities(), simulation.tail))
+    return Response(simulation.result(), status=status.HTTP_200_OK)
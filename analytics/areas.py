@@ -0,0 +1,144 @@
+# analytics/areas.py
+"""
+Area hierarchy and its incrementally maintained per-year rollups.
+
+Every population row counts towards its area (see PopulationData.area). Instead of
+summing descendants at read time, each write turns into (area, year) deltas that are
+added to the AreaPopulation row of the area and of every ancestor, read straight from
+the materialized path. A total for any area and year is then a single read on the
+(area, year) unique index, and moving a subtree shifts its totals from the old
+ancestors to the new ones in one transaction.
+"""
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import BigIntegerField, Case, CharField, F, Sum, Value, When
+from django.db.models.functions import Concat, Substr
+
+from .models import Area, AreaPopulation, PopulationData
+
+# (area, year) pairs per UPDATE: three parameters each keeps statements under 2100 parameters
+ROLLUP_CHUNK_SIZE = 300
+
+
+def _chunks(items, size=ROLLUP_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def path_ids(path):
+    """Area ids on a materialized path, root first (the area itself last)."""
+    return [int(part) for part in path.strip('/').split('/') if part]
+
+
+def create_area(name, level, parent=None):
+    with transaction.atomic():
+        area = Area.objects.create(name=name, level=level, parent=parent, depth=parent.depth + 1 if parent else 0)
+        area.path = f'{parent.path if parent else "/"}{area.id}/'
+        area.save(update_fields=['path'])
+    return area
+
+
+def contributions(rows):
+    """Sums (area_id, year, population_count) rows into {(area_id, year): population}."""
+    totals = Counter()
+    for area_id, year, population in rows:
+        if area_id is not None:
+            totals[(area_id, year)] += population
+    return totals
+
+
+def apply_changes(removed=(), added=()):
+    """
+    Updates the rollups for rows that stopped counting (removed) and started counting
+    (added), each given as (area_id, year, population_count) tuples.
+    """
+    deltas = contributions(added)
+    deltas.subtract(contributions(removed))
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    paths = dict(Area.objects.filter(id__in={area_id for area_id, _ in deltas}).values_list('id', 'path'))
+    totals = Counter()
+    for (area_id, year), delta in deltas.items():
+        for ancestor_id in path_ids(paths[area_id]):
+            totals[(ancestor_id, year)] += delta
+    _add_to_rollups(totals)
+
+
+def _add_to_rollups(totals):
+    """Adds {(area_id, year): delta} to the stored totals, creating missing rollup rows."""
+    keys = sorted(key for key, delta in totals.items() if delta)
+    for chunk in _chunks(keys):
+        area_ids = {area_id for area_id, _ in chunk}
+        years = {year for _, year in chunk}
+        rollups = AreaPopulation.objects.filter(area_id__in=area_ids, year__in=years)
+        _create_missing(rollups, chunk)
+        rollups.update(total=F('total') + Case(
+            *[When(area_id=area_id, year=year, then=Value(totals[(area_id, year)])) for area_id, year in chunk],
+            default=Value(0),
+            output_field=BigIntegerField(),
+        ))
+
+
+def _create_missing(rollups, keys, attempts=3):
+    for attempt in range(attempts):
+        existing = set(rollups.values_list('area_id', 'year'))
+        missing = [AreaPopulation(area_id=area_id, year=year) for area_id, year in keys if (area_id, year) not in existing]
+        if not missing:
+            return
+        try:
+            with transaction.atomic():
+                AreaPopulation.objects.bulk_create(missing)
+            return
+        except IntegrityError:
+            # A concurrent writer created some of them first; look again
+            if attempt == attempts - 1:
+                raise
+
+
+def area_total(area_id, year):
+    """Population of an area and all its descendants in a year (one indexed read)."""
+    return AreaPopulation.objects.filter(area_id=area_id, year=year).values_list('total', flat=True).first() or 0
+
+
+def move_area(area, parent):
+    """
+    Re-parents an area and its subtree in one transaction: rewrites the paths with one
+    prefix UPDATE and moves the subtree's yearly totals from the old ancestors to the new.
+    """
+    with transaction.atomic():
+        area = Area.objects.select_for_update().get(pk=area.pk)
+        if parent is not None and parent.path.startswith(area.path):
+            raise ValueError('An area cannot be moved under itself or its descendants.')
+
+        old_path = area.path
+        new_path = f'{parent.path if parent else "/"}{area.id}/'
+        subtree_totals = list(AreaPopulation.objects.filter(area=area).values_list('year', 'total'))
+        totals = Counter()
+        for year, total in subtree_totals:
+            for ancestor_id in path_ids(old_path)[:-1]:
+                totals[(ancestor_id, year)] -= total
+            for ancestor_id in path_ids(new_path)[:-1]:
+                totals[(ancestor_id, year)] += total
+        _add_to_rollups(totals)
+
+        Area.objects.filter(path__startswith=old_path).update(
+            path=Concat(Value(new_path), Substr('path', len(old_path) + 1), output_field=CharField()),
+            depth=F('depth') + ((parent.depth + 1 if parent else 0) - area.depth),
+        )
+        Area.objects.filter(pk=area.pk).update(parent=parent)
+        area.refresh_from_db()
+    return area
+
+
+def move_city_rows(city_id, old_area_id, new_area_id):
+    """Points a city's rows at its new area and moves their totals along (city re-placed)."""
+    rows = PopulationData.objects.filter(city_id=city_id)
+    yearly = list(rows.values('year').annotate(total=Sum('population_count')).values_list('year', 'total'))
+    rows.update(area_id=new_area_id)
+    apply_changes(
+        removed=[(old_area_id, year, total) for year, total in yearly],
+        added=[(new_area_id, year, total) for year, total in yearly],
+    )
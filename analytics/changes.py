@@ -0,0 +1,201 @@
+# analytics/changes.py
+"""
+Change log behind the /api/changes/ delta sync endpoint.
+
+Every City / PopulationData write appends a ChangeLog row (see signals.py) carrying a
+monotonically increasing change token. Clients send back the last token they saw and
+receive only what changed after it: upserted cities and population rows, fresh
+forecasts for every affected city, and tombstones for deletes.
+
+Tokens are not the row ids: an id is assigned at insert time, so a slow transaction
+could commit id N after a client had already been handed N + 1, and the client would
+never see that change. Tokens come from the single ChangeSequence row instead, which a
+writer updates in the transaction that logs its changes; the row stays locked until
+that transaction commits, so a token is only ever visible after every smaller one.
+"""
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max, Min
+from django.utils import timezone
+
+from .forecasting import predict_next_year
+from .models import ChangeLog, ChangeSequence, City, PopulationData, PopulationObservation
+from .resampling import GRANULARITY_PERIODS, annual_series, to_months
+from .routers import REPLICA
+
+# Prune old entries once every this many log writes
+PRUNE_EVERY = 100
+
+# Keeps id__in lists under per-statement parameter limits (2100 on SQL Server)
+LOOKUP_CHUNK_SIZE = 1000
+
+
+def _chunks(ids, size=LOOKUP_CHUNK_SIZE):
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def _take_tokens(count):
+    """
+    Returns the last of `count` new tokens. Must run inside a transaction: the UPDATE
+    locks the sequence row, as select_for_update would (SQLite ignores FOR UPDATE but
+    not the write lock), until that transaction commits.
+    """
+    if not ChangeSequence.objects.filter(pk=1).update(value=F('value') + count):
+        # Flushed table (test databases); continue after whatever is logged
+        ChangeSequence.objects.get_or_create(pk=1, defaults={'value': latest_token()})
+        ChangeSequence.objects.filter(pk=1).update(value=F('value') + count)
+    return ChangeSequence.objects.using('default').values_list('value', flat=True).get(pk=1)
+
+
+def record_change(entity, object_id, city_id, action):
+    # No savepoint: a failure here aborts the caller's transaction with its change
+    with transaction.atomic(savepoint=False):
+        token = _take_tokens(1)
+        entry = ChangeLog.objects.create(
+            token=token, entity=entity, object_id=object_id, city_id=city_id, action=action,
+        )
+    if token % PRUNE_EVERY == 0:
+        prune_change_log()
+    return entry
+
+
+def record_changes(entity, rows, action, batch_size=1000):
+    """Logs many (object_id, city_id) changes at once, for the bulk endpoints."""
+    rows = list(rows)
+    if not rows:
+        return
+    with transaction.atomic(savepoint=False):
+        first = _take_tokens(len(rows)) - len(rows) + 1
+        ChangeLog.objects.bulk_create(
+            [
+                ChangeLog(token=first + offset, entity=entity, object_id=object_id, city_id=city_id, action=action)
+                for offset, (object_id, city_id) in enumerate(rows)
+            ],
+            batch_size=batch_size,
+        )
+    prune_change_log()
+
+
+def latest_token(using='default'):
+    return ChangeLog.objects.using(using).aggregate(latest=Max('token'))['latest'] or 0
+
+
+def replica_is_current():
+    """
+    True when the replica has applied every change the primary had committed when this was
+    called: tokens commit in order and every dataset write logs one, so it is enough that
+    the replica holds the primary's latest token. False when no replica is configured.
+    """
+    if REPLICA not in settings.DATABASES:
+        return False
+    return latest_token(REPLICA) >= latest_token('default')
+
+
+def prune_change_log():
+    """Deletes entries older than ANALYTICS_CHANGELOG_RETENTION_DAYS, always keeping the newest one."""
+    retention = getattr(settings, 'ANALYTICS_CHANGELOG_RETENTION_DAYS', 7)
+    latest = ChangeLog.objects.aggregate(latest=Max('token'))['latest']
+    if latest is None:
+        return 0
+    # The newest entry stays so the latest token can still be read from the log
+    cutoff = timezone.now() - timedelta(days=retention)
+    deleted, _ = ChangeLog.objects.filter(created_at__lt=cutoff).exclude(token=latest).delete()
+    return deleted
+
+
+def changes_since(since):
+    """
+    Returns the delta payload for a client whose last token is `since` (None for a new client).
+    full_resync is set when the client has no token or its token predates the retained log.
+    """
+    bounds = ChangeLog.objects.aggregate(latest=Max('token'), oldest=Min('token'))
+    token = bounds['latest'] or 0
+    payload = {
+        'token': token,
+        'full_resync': False,
+        'cities': [],
+        'population': [],
+        'forecasts': [],
+        'deleted': {'cities': [], 'population': []},
+    }
+    if since is None or (bounds['oldest'] is not None and since < bounds['oldest'] - 1) or since > token:
+        payload['full_resync'] = True
+        return payload
+    if since == token:
+        return payload
+
+    # Collapse to the last action per object
+    entries = ChangeLog.objects.filter(token__gt=since, token__lte=token).order_by('token').values_list(
+        'entity', 'object_id', 'city_id', 'action'
+    )
+    latest_action = {}
+    affected_cities = set()
+    for entity, object_id, city_id, action in entries:
+        latest_action[(entity, object_id)] = action
+        if city_id is not None:
+            affected_cities.add(city_id)
+
+    upserted = {'city': [], 'population': []}
+    deleted = {'city': [], 'population': []}
+    for (entity, object_id), action in latest_action.items():
+        (upserted if action == 'upsert' else deleted)[entity].append(object_id)
+
+    payload['cities'] = sorted((
+        {'id': city_id, 'name': name, 'region': region}
+        for chunk in _chunks(upserted['city'])
+        for city_id, name, region in City.objects.filter(id__in=chunk).values_list('id', 'city_name', 'region')
+    ), key=lambda city: city['id'])
+    payload['population'] = sorted((
+        {'Historyid': row_id, 'city_id': city_id, 'year': year, 'population': population, 'source': source}
+        for chunk in _chunks(upserted['population'])
+        for row_id, city_id, year, population, source in PopulationData.objects.filter(id__in=chunk).values_list(
+            'id', 'city_id', 'year', 'population_count', 'source'
+        )
+    ), key=lambda row: (row['city_id'], row['year'], row['Historyid']))
+    payload['forecasts'] = _forecasts_for(affected_cities)
+    payload['deleted'] = {'cities': sorted(deleted['city']), 'population': sorted(deleted['population'])}
+    return payload
+
+
+def _forecasts_for(city_ids):
+    """Recomputes forecasts for the affected cities that still exist, from one series query."""
+    series = {
+        city_id: ([], [], [])
+        for chunk in _chunks(list(city_ids))
+        for city_id in City.objects.filter(id__in=chunk).values_list('id', flat=True)
+    }
+    for chunk in _chunks(sorted(series)):
+        rows = PopulationData.objects.filter(city_id__in=chunk).order_by('city_id', 'year', 'id').values_list(
+            'city_id', 'year', 'population_count'
+        )
+        for city_id, year, population in rows:
+            series[city_id][0].append(year)
+            series[city_id][1].append(population)
+        # Sub-annual observations fill in years without a yearly row, as in the snapshot
+        observations = PopulationObservation.objects.filter(city_id__in=chunk).values_list(
+            'city_id', 'year', 'granularity', 'period', 'population_count'
+        )
+        for city_id, year, granularity, period, population in observations:
+            series[city_id][2].append((
+                int(to_months(year, period, GRANULARITY_PERIODS[granularity])), population,
+            ))
+
+    forecasts = []
+    for city_id in sorted(series):
+        years, populations, observed = series[city_id]
+        observed.sort()
+        predicted_year, predicted_population = predict_next_year(*annual_series(
+            np.array(years, dtype=np.int64), np.array(populations, dtype=np.int64),
+            np.array([month for month, _ in observed], dtype=np.int64),
+            np.array([population for _, population in observed], dtype=np.int64),
+        ))
+        forecasts.append({
+            'city_id': city_id,
+            'predicted_year': predicted_year,
+            'predicted_population': predicted_population,
+        })
+    return forecasts
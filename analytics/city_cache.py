@@ -0,0 +1,78 @@
+# analytics/city_cache.py
+"""
+In-process id -> City and lowercased name -> City lookup cache.
+
+Rebuilt from one query when the city version in the cache changes (bumped by the City
+signals, i.e. add_city / update_city / delete_city, once the write commits) or after ANALYTICS_SNAPSHOT_MAX_AGE
+seconds. Callers get copies, so a view mutating or deleting its City cannot corrupt
+the shared entry.
+"""
+import copy
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .changes import replica_is_current
+from .models import City
+from .routers import use_primary
+
+VERSION_CACHE_KEY = 'analytics:city_version'
+
+
+def bump_city_version():
+    cache.set(VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def normalize_name(name):
+    return name.lower()
+
+
+class CityLookup:
+    def __init__(self, version):
+        self.version = version
+        self.built_at = time.monotonic()
+        # Rebuilds follow city writes and the lookup is shared by all requests: read the
+        # replica only once it has caught up with the primary
+        with use_primary(not replica_is_current()):
+            cities = list(City.objects.all())
+        self.by_id = {city.id: city for city in cities}
+        self.by_name = {normalize_name(city.city_name): city for city in cities}
+
+    def is_fresh(self, version):
+        max_age = getattr(settings, 'ANALYTICS_SNAPSHOT_MAX_AGE', 60)
+        return self.version == version and time.monotonic() - self.built_at < max_age
+
+
+_lookup = None
+_lookup_lock = threading.Lock()
+
+
+def _get_lookup():
+    global _lookup
+    version = cache.get(VERSION_CACHE_KEY)
+    lookup = _lookup
+    if lookup is not None and lookup.is_fresh(version):
+        return lookup
+    with _lookup_lock:
+        if _lookup is None or not _lookup.is_fresh(version):
+            _lookup = CityLookup(version)
+        return _lookup
+
+
+def get_city(city_id):
+    """Returns a copy of the City with this id, or None."""
+    try:
+        city_id = int(city_id)
+    except (TypeError, ValueError):
+        return None
+    city = _get_lookup().by_id.get(city_id)
+    return copy.copy(city) if city is not None else None
+
+
+def get_city_by_name(name):
+    """Returns a copy of the City whose name matches case-insensitively, or None."""
+    city = _get_lookup().by_name.get(normalize_name(name))
+    return copy.copy(city) if city is not None else None
@@ -0,0 +1,147 @@
+# analytics/events.py
+"""
+In-process Server-Sent Events fan-out of dataset changes.
+
+One tailer task per process follows the change log (changes.py) and pushes each new
+delta to every subscriber, so N idle connections cost N small queues, not N threads or
+N database polls. Writes in this process wake the tailer immediately through notify();
+writes made by other workers are picked up on the next poll, so no Redis is needed.
+
+Each subscriber has a bounded queue. A client that falls behind is not allowed to
+hold the broadcaster up: its backlog is dropped and replaced with a single `resync`
+event carrying the last token it received, so it can catch up via /api/changes/.
+"""
+import asyncio
+import contextvars
+import json
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import Max
+
+from .changes import changes_since
+from .models import ChangeLog
+
+
+def format_event(event, data, token=None):
+    lines = []
+    if token is not None:
+        lines.append(f'id: {token}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscriber:
+    __slots__ = ('queue', 'token')
+
+    def __init__(self, maxsize, token):
+        # Items are (token, message); token is the last one handed to the client
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.token = token
+
+    def offer(self, token, message):
+        try:
+            self.queue.put_nowait((token, message))
+        except asyncio.QueueFull:
+            # Slow client: replace its backlog with one resync hint from its last delivered token.
+            # The hint has no SSE id, so a reconnect's Last-Event-ID still names that token
+            # rather than skipping the dropped changes
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait((self.token, format_event('resync', {'since': self.token})))
+
+
+class ChangeBroadcaster:
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self._tailer = None
+        self._token = None
+
+    def notify(self):
+        """Wakes the tailer after a local write. Safe to call from any thread."""
+        with self._lock:
+            loop, wakeup = self._loop, self._wakeup
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(wakeup.set)
+
+    async def subscribe(self, last_event_id=None):
+        buffer_size = getattr(settings, 'ANALYTICS_SSE_CLIENT_BUFFER', 32)
+        if self._tailer is None or self._tailer.done():
+            # Nothing has followed the change log since the last subscriber left
+            self._token = await sync_to_async(_latest_token)()
+        subscriber = Subscriber(buffer_size, self._token)
+
+        # Reconnecting clients first get everything they missed since Last-Event-ID
+        if last_event_id is not None and last_event_id < self._token:
+            payload = await sync_to_async(changes_since)(last_event_id)
+            event = 'resync' if payload['full_resync'] else 'changes'
+            subscriber.offer(payload['token'], format_event(event, payload, payload['token']))
+
+        self._subscribers.add(subscriber)
+        self._ensure_tailer()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+    def _ensure_tailer(self):
+        if self._tailer is not None and not self._tailer.done():
+            return
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+        # Run outside the request's context: its thread-sensitive executor shuts down once
+        # the view returns, while the tailer must keep querying the change log
+        self._tailer = self._loop.create_task(self._tail(), context=contextvars.Context())
+
+    async def _tail(self):
+        poll_interval = getattr(settings, 'ANALYTICS_SSE_POLL_INTERVAL', 2)
+        while self._subscribers:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                payload = await sync_to_async(changes_since)(self._token)
+            except DatabaseError:
+                # Keep subscribers connected and retry on the next poll
+                continue
+            if payload['token'] == self._token and not payload['full_resync']:
+                continue
+            event = 'resync' if payload['full_resync'] else 'changes'
+            message = format_event(event, payload, payload['token'])
+            self._token = payload['token']
+            for subscriber in list(self._subscribers):
+                subscriber.offer(self._token, message)
+
+
+def _latest_token():
+    return ChangeLog.objects.aggregate(latest=Max('token'))['latest'] or 0
+
+
+broadcaster = ChangeBroadcaster()
+
+
+async def event_stream(subscriber):
+    """Yields SSE messages for one client, with keep-alive comments while idle."""
+    heartbeat = getattr(settings, 'ANALYTICS_SSE_HEARTBEAT', 15)
+    try:
+        yield format_event('ready', {'token': subscriber.token}, subscriber.token)
+        while True:
+            try:
+                token, message = await asyncio.wait_for(subscriber.queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield ': keep-alive\n\n'
+                continue
+            subscriber.token = token
+            yield message
+    finally:
+        broadcaster.unsubscribe(subscriber)
@@ -0,0 +1,204 @@
+# analytics/forecast_archive.py
+"""
+Archive of past forecasts and their accuracy, behind /api/forecast/accuracy/.
+
+archive_forecasts() stores the current forecast of every city as one ForecastArchive row
+per (city, engine, target year, basis), where basis is a CRC32 of the city's history:
+cities whose history did not change since their last archived forecast are skipped
+without refitting. It runs after each committed dataset change on a background thread
+(coalescing bursts of writes) and from manage.py archive_forecasts.
+
+record_actuals() keeps the actual / error columns of the archive in step with the
+population rows of the target years; it is called by the PopulationData signals and,
+for bulk writes, by the bulk endpoints.
+"""
+import threading
+import zlib
+from datetime import datetime
+
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Avg, Case, Count, F, FloatField, OuterRef, Subquery, Value, When
+from django.db.models.functions import Abs, Cast
+
+from .models import ForecastArchive, PopulationData
+
+# (city, year) pairs per statement, keeping the id lists under 2100 parameters on SQL Server
+ARCHIVE_CHUNK_SIZE = 1000
+
+
+def _chunks(items, size=ARCHIVE_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def history_basis(snapshot, record):
+    """CRC32 of a city's yearly (years, populations) series, identifying the input of a forecast."""
+    years, populations = snapshot.annual_series(record)
+    return zlib.crc32(years.tobytes() + populations.tobytes())
+
+
+def archive_forecasts(snapshot, engine=ForecastArchive.ENGINE_LINEAR):
+    """Archives the snapshot's forecasts of cities whose history changed. Returns the rows added."""
+    target_year = datetime.now().year + 1
+    bases = {
+        record.index: history_basis(snapshot, record)
+        for record in snapshot.cities
+        if snapshot.latest_population(record) is not None
+    }
+    archived = set(
+        ForecastArchive.objects.filter(engine=engine, target_year=target_year).values_list('city_id', 'basis')
+    )
+    pending = [
+        record for record in snapshot.cities
+        if record.index in bases and (record.id, bases[record.index]) not in archived
+    ]
+
+    rows = []
+    for record, (predicted_year, predicted_population) in zip(pending, snapshot.forecast_many(pending)):
+        years, _ = snapshot.annual_series(record)
+        rows.append(ForecastArchive(
+            city_id=record.id,
+            engine=engine,
+            target_year=predicted_year,
+            base_year=int(years[-1]),
+            basis=bases[record.index],
+            predicted_population=predicted_population,
+        ))
+
+    created = []
+    for chunk in _chunks(rows):
+        try:
+            with transaction.atomic():
+                created.extend(ForecastArchive.objects.bulk_create(chunk))
+        except IntegrityError:
+            # A concurrent archiver stored some of them first; keep only the rest
+            keys = set(ForecastArchive.objects.filter(
+                engine=engine, target_year=target_year, city_id__in=[row.city_id for row in chunk],
+            ).values_list('city_id', 'basis'))
+            created.extend(ForecastArchive.objects.bulk_create(
+                [row for row in chunk if (row.city_id, row.basis) not in keys]
+            ))
+    record_actuals({(row.city_id, row.target_year) for row in created})
+    return created
+
+
+def record_actuals(pairs):
+    """
+    Re-reads the actual population of the (city_id, year) pairs (the newest row of that
+    year, or none) into the archived forecasts for them, and recomputes their errors.
+    """
+    pairs = sorted({(city_id, year) for city_id, year in pairs if city_id is not None})
+    for chunk in _chunks(pairs):
+        # Matching on both lists may include a few extra pairs; recomputing them is harmless
+        forecasts = ForecastArchive.objects.filter(
+            city_id__in={city_id for city_id, _ in chunk},
+            target_year__in={year for _, year in chunk},
+        )
+        actual = PopulationData.objects.filter(
+            city_id=OuterRef('city_id'), year=OuterRef('target_year'),
+        ).order_by('-id').values('population_count')[:1]
+        forecasts.update(actual_population=Subquery(actual))
+        forecasts.update(
+            error=F('predicted_population') - F('actual_population'),
+            abs_pct_error=Case(
+                When(actual_population__gt=0, then=(
+                    Cast(Abs(F('predicted_population') - F('actual_population')), FloatField())
+                    * Value(100.0) / Cast(F('actual_population'), FloatField())
+                )),
+                default=None,
+                output_field=FloatField(),
+            ),
+        )
+
+
+# Dimensions /api/forecast/accuracy/ can group by, and the columns they read
+ACCURACY_GROUPS = {
+    'city': ('city_id', 'city__city_name'),
+    'region': ('city__region',),
+    'engine': ('engine',),
+    'target_year': ('target_year',),
+}
+
+
+def accuracy(forecasts, group_by):
+    """
+    Error statistics of archived forecasts per group, aggregated from the stored error
+    columns: forecasts counts every archived run, evaluated those whose target year has an
+    actual figure (the only ones the error averages cover).
+    """
+    columns = [column for group in group_by for column in ACCURACY_GROUPS[group]]
+    rows = forecasts.values(*columns).annotate(
+        forecasts=Count('id'),
+        evaluated=Count('actual_population'),
+        mae=Avg(Abs('error')),
+        mape=Avg('abs_pct_error'),
+        bias=Avg('error'),
+    ).order_by(*columns)
+
+    engines = dict(ForecastArchive.ENGINE_CHOICES)
+    results = []
+    for row in rows:
+        result = {}
+        if 'city' in group_by:
+            result['city_id'], result['city'] = row['city_id'], row['city__city_name']
+        if 'region' in group_by:
+            result['region'] = row['city__region']
+        if 'engine' in group_by:
+            result['engine'] = engines.get(row['engine'], row['engine'])
+        if 'target_year' in group_by:
+            result['target_year'] = row['target_year']
+        result.update({
+            'forecasts': row['forecasts'],
+            'evaluated': row['evaluated'],
+            'mae': None if row['mae'] is None else round(row['mae'], 1),
+            'mape': None if row['mape'] is None else round(row['mape'], 2),
+            'bias': None if row['bias'] is None else round(row['bias'], 1),
+        })
+        results.append(result)
+    return results
+
+
+# ------------------ On-change archiver ------------------
+
+_archiver_lock = threading.Lock()
+_archiver_thread = None
+_archiver_pending = False
+
+
+def schedule_forecast_archive():
+    """Archives changed forecasts in the background once the current transaction commits."""
+    transaction.on_commit(_start_archiver)
+
+
+def _start_archiver():
+    global _archiver_thread, _archiver_pending
+    with _archiver_lock:
+        # Writes that land while a pass is running are coalesced into one more pass
+        _archiver_pending = True
+        if _archiver_thread is not None:
+            return
+        _archiver_thread = threading.Thread(target=_run_archiver, daemon=True)
+        _archiver_thread.start()
+
+
+def _run_archiver():
+    global _archiver_thread, _archiver_pending
+    from django.conf import settings
+
+    from .snapshot import DatasetSnapshot, get_snapshot
+
+    try:
+        while True:
+            with _archiver_lock:
+                if not _archiver_pending:
+                    _archiver_thread = None
+                    return
+                _archiver_pending = False
+            # A shared snapshot file is rewritten concurrently and may still hold the old data
+            archive_forecasts(DatasetSnapshot.build() if settings.ANALYTICS_SNAPSHOT_FILE else get_snapshot())
+    except Exception:
+        with _archiver_lock:
+            _archiver_thread = None
+        raise
+    finally:
+        connections.close_all()
@@ -0,0 +1,66 @@
+# analytics/forecasting.py
+from datetime import datetime
+
+import numpy as np
+from sklearn.linear_model import LinearRegression
+
+
+def predict_next_year(years, populations):
+    """
+    Predict next year's population from a year-ordered series using Linear Regression
+    (scikit-learn), starting from the current year, not the last year in the data.
+    Returns (predicted_year, predicted_population), or (None, 0) for an empty series.
+    """
+    if len(years) < 2:
+        if len(years):
+            # If less than 2 data points, return current year + 1 with last known population
+            current_year = datetime.now().year
+            return current_year + 1, int(populations[-1])
+        return None, 0
+
+    # Prepare training data
+    years = np.asarray(years).reshape(-1, 1)
+    populations = np.asarray(populations)
+
+    # Train the linear regression model
+    model = LinearRegression()
+    model.fit(years, populations)
+
+    # Predict for next year starting from current year
+    current_year = datetime.now().year
+    next_year = current_year + 1
+    predicted_population = model.predict([[next_year]])[0]
+
+    return int(next_year), int(predicted_population)
+
+
+def predict_next_year_many(series_index, years, populations, size, next_year=None):
+    """
+    predict_next_year for `size` series at once, each (year, population) point belonging to
+    series series_index. Every series' least-squares line comes in closed form from bincount
+    sums of its centred years: slope = sum(dx * dy) / sum(dx * dx), through the means.
+    Returns (predicted_years, predicted_populations), the year -1 for empty series.
+    """
+    if next_year is None:
+        next_year = datetime.now().year + 1
+    series_index = np.asarray(series_index, dtype=np.int64)
+    years = np.asarray(years, dtype=np.float64)
+    populations = np.asarray(populations, dtype=np.float64)
+
+    counts = np.bincount(series_index, minlength=size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_year = np.bincount(series_index, years, minlength=size) / counts
+        mean_population = np.bincount(series_index, populations, minlength=size) / counts
+        centered = years - mean_year[series_index]
+        spread = np.bincount(series_index, centered * centered, minlength=size)
+        covariance = np.bincount(
+            series_index, centered * (populations - mean_population[series_index]), minlength=size
+        )
+        # One point (or one distinct year) gives a flat line through the mean, as the fit does
+        slope = np.where(spread > 0, covariance / spread, 0.0)
+        predicted = mean_population + slope * (next_year - mean_year)
+
+    has_data = counts > 0
+    predicted_years = np.where(has_data, next_year, -1).astype(np.int64)
+    predicted_populations = np.trunc(np.where(has_data, predicted, 0)).astype(np.int64)
+    return predicted_years, predicted_populations
@@ -0,0 +1,89 @@
+# analytics/gapfill.py
+"""
+Gap filling of yearly series, behind ?fill=linear|log on the city read endpoints.
+
+Cities with holes in their history otherwise report a multi-year jump as one year's
+growth and fit their forecast on unevenly spaced points. fill_gaps() inserts the missing
+years of every series at once: each row is repeated once per missing year after it, and
+the inserted points are interpolated between the two rows around the gap, linearly or
+log-linearly (constant growth rate, for positive counts). It is a handful of NumPy
+operations over the whole snapshot, with no per-city loop.
+
+yearly_rows() first adds the year-end sub-annual observation of every year without a
+yearly row, so imputed years never hide an observed count. The result is served as a
+derived snapshot (DatasetSnapshot.filled) whose rows carry an imputed flag; imputed
+points only ever live there and are never written to the database.
+"""
+import numpy as np
+
+METHODS = ('linear', 'log')
+
+# Packs (city index, year) into one int64 sort / lookup key
+YEAR_SPAN = 1 << 32
+
+
+def yearly_rows(snapshot):
+    """
+    The snapshot's rows plus year-end observations for years without a row, ordered by
+    (city, year). Returns (city_index, years, populations, row_ids, source_ids); added
+    observations have row id -1.
+    """
+    observation_index = np.repeat(
+        np.arange(len(snapshot.cities), dtype=np.int64), np.diff(snapshot.observation_offsets)
+    )
+    observation_years = snapshot.observation_months // 12
+    observation_keys = observation_index * YEAR_SPAN + observation_years
+    # Observations are sorted by (city, month): the last of each (city, year) run is its year end
+    last = np.flatnonzero(np.append(observation_keys[1:] != observation_keys[:-1], True)) \
+        if len(observation_keys) else observation_keys
+    city_index = snapshot.city_index.astype(np.int64)
+    # Rows are sorted by (city, year), so their keys can be searched directly
+    row_keys = city_index * YEAR_SPAN + snapshot.years
+    found = np.minimum(np.searchsorted(row_keys, observation_keys[last]), max(len(row_keys) - 1, 0))
+    extra = last[row_keys[found] != observation_keys[last]] if len(row_keys) else last
+    if not len(extra):
+        return city_index, snapshot.years, snapshot.populations, snapshot.row_ids, snapshot.source_ids
+
+    keys = np.concatenate([row_keys, observation_keys[extra]])
+    # Stable, so rows of the same year keep their id order
+    order = np.argsort(keys, kind='stable')
+    city_index = np.concatenate([city_index, observation_index[extra]])
+    years = np.concatenate([snapshot.years, observation_years[extra]])
+    return (
+        city_index[order],
+        years[order],
+        np.concatenate([snapshot.populations, snapshot.observation_populations[extra]])[order],
+        np.concatenate([snapshot.row_ids, np.full(len(extra), -1, dtype=np.int64)])[order],
+        np.concatenate([snapshot.source_ids, snapshot.observation_source_ids[extra]])[order],
+    )
+
+
+def fill_gaps(city_index, years, populations, method='linear'):
+    """
+    Inserts the missing years of (city, year)-ordered series. Returns (source, years,
+    populations, imputed), where source is the input point each output point is or follows.
+    """
+    size = len(years)
+    gaps = np.zeros(size, dtype=np.int64)
+    if size > 1:
+        same_city = city_index[1:] == city_index[:-1]
+        gaps[:-1] = np.where(same_city, np.maximum(years[1:] - years[:-1] - 1, 0), 0)
+
+    counts = gaps + 1
+    source = np.repeat(np.arange(size), counts)
+    # 0 for the input point itself, k for the k-th year inserted after it
+    step = np.arange(counts.sum()) - (np.cumsum(counts) - counts)[source]
+    imputed = step > 0
+
+    low = populations[source].astype(np.float64)
+    high = populations[np.minimum(source + 1, max(size - 1, 0))].astype(np.float64)
+    fraction = step / counts[source]
+    values = low + (high - low) * fraction
+    if method == 'log':
+        positive = (low > 0) & (high > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            geometric = np.exp(np.log(low) + (np.log(high) - np.log(low)) * fraction)
+        values = np.where(positive, geometric, values)
+
+    filled = np.where(imputed, np.rint(values).astype(np.int64), populations[source])
+    return source, years[source] + step, filled, imputed
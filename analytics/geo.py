@@ -0,0 +1,67 @@
+# analytics/geo.py
+"""
+Nearest-city queries for /api/cities/nearby/.
+
+Built once per dataset snapshot (so it follows city writes, like the search index) as a
+SciPy cKDTree over the cities that have coordinates. Points are placed on the unit
+sphere, so the straight-line (chord) distance the tree measures grows monotonically
+with great-circle distance: k-nearest and radius queries are exact, with no lat/lon
+distortion near the poles or the antimeridian, and need no spatial database.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def to_unit_vectors(latitudes, longitudes):
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_latitude = np.cos(latitudes)
+    return np.column_stack((cos_latitude * np.cos(longitudes), cos_latitude * np.sin(longitudes), np.sin(latitudes)))
+
+
+def km_to_chord(km):
+    return 2 * np.sin(np.minimum(km / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(np.asarray(chord) / 2, 1))
+
+
+def valid_location(latitude, longitude):
+    return -90 <= latitude <= 90 and -180 <= longitude <= 180
+
+
+class CityLocationIndex:
+    def __init__(self, records, latitudes, longitudes):
+        located = ~(np.isnan(latitudes) | np.isnan(longitudes))
+        self._records = [record for record, has_location in zip(records, located.tolist()) if has_location]
+        self._tree = cKDTree(to_unit_vectors(latitudes[located], longitudes[located])) if self._records else None
+
+    def __len__(self):
+        return len(self._records)
+
+    def nearest(self, latitude, longitude, limit=10, radius_km=None, exclude=None):
+        """
+        Returns [(record, distance_km)] of the `limit` cities closest to the point, nearest
+        first, optionally only those within radius_km. exclude is a record to leave out
+        (the city a search is centered on).
+        """
+        if self._tree is None or limit < 1:
+            return []
+        point = to_unit_vectors([latitude], [longitude])[0]
+        wanted = min(limit + (exclude is not None), len(self._records))
+        upper_bound = km_to_chord(radius_km) * (1 + 1e-9) if radius_km is not None else np.inf
+        distances, positions = self._tree.query(point, k=wanted, distance_upper_bound=upper_bound)
+
+        results = []
+        for distance, position in zip(np.atleast_1d(distances).tolist(), np.atleast_1d(positions).tolist()):
+            # Fewer than k points in range are padded with an infinite distance
+            if distance == np.inf:
+                break
+            record = self._records[position]
+            if exclude is not None and record.id == exclude.id:
+                continue
+            results.append((record, float(chord_to_km(distance))))
+        return results[:limit]
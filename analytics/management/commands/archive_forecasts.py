@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from analytics.forecast_archive import archive_forecasts, record_actuals
+from analytics.models import ForecastArchive
+from analytics.snapshot import DatasetSnapshot
+
+
+class Command(BaseCommand):
+    help = 'Archive the current forecast of every city whose history changed since its last archived forecast.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--refresh-actuals',
+            action='store_true',
+            help='Also re-read the actual figures and errors of every archived forecast.',
+        )
+
+    def handle(self, *args, **options):
+        created = archive_forecasts(DatasetSnapshot.build())
+        self.stdout.write(self.style.SUCCESS(f'✔ Archived {len(created)} forecasts'))
+
+        if options['refresh_actuals']:
+            pairs = set(ForecastArchive.objects.values_list('city_id', 'target_year').distinct())
+            record_actuals(pairs)
+            self.stdout.write(self.style.SUCCESS(f'✔ Refreshed actuals of {len(pairs)} city target years'))
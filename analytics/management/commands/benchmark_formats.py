@@ -0,0 +1,153 @@
+import gzip
+import json
+import statistics
+import time
+from datetime import datetime
+
+import msgpack
+import numpy as np
+import pyarrow as pa
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from analytics.renderers import ArrowStreamRenderer, MessagePackRenderer, cities_table
+from analytics.snapshot import CityRecord, DatasetSnapshot, get_snapshot
+from analytics.streaming import iter_cities_json
+
+FORMATS = ('json', 'msgpack', 'arrow')
+
+
+def city_dicts(snapshot, records):
+    """The JSON / MessagePack body of the city endpoints (as built by the views)."""
+    return [
+        {
+            'id': record.id,
+            'name': record.name,
+            'region': record.region,
+            'predicted_year': predicted_year,
+            'predicted_population': predicted_population,
+            'history': snapshot.history(record),
+        }
+        for record, (predicted_year, predicted_population) in zip(records, snapshot.forecast_many(records))
+    ]
+
+
+def encode(fmt, snapshot, records, streamed):
+    """Builds and renders a response body the way the read endpoints do for this format."""
+    if fmt == 'json':
+        if streamed:
+            return b''.join(iter_cities_json(snapshot))
+        return JSONRenderer().render(city_dicts(snapshot, records))
+    if fmt == 'msgpack':
+        return MessagePackRenderer().render(city_dicts(snapshot, records))
+    return ArrowStreamRenderer().render(cities_table(snapshot, records))
+
+
+def decode(fmt, body):
+    if fmt == 'json':
+        return json.loads(body)
+    if fmt == 'msgpack':
+        return msgpack.unpackb(body)
+    return pa.ipc.open_stream(body).read_all()
+
+
+def synthetic_snapshot(cities, years, seed):
+    """An in-memory snapshot of generated cities, with precomputed forecasts."""
+    rng = np.random.default_rng(seed)
+    records = [CityRecord(index, index + 1, f'City {index}', f'Region {index % 17}') for index in range(cities)]
+    city_index = np.repeat(np.arange(cities, dtype=np.int32), years)
+    base = rng.integers(10_000, 2_000_000, cities)
+    growth = 1 + rng.normal(0.015, 0.01, (cities, years))
+    populations = (base[:, None] * np.cumprod(growth, axis=1)).astype(np.int64).ravel()
+    sources = ['Census', 'PSA', 'Seeded Data']
+    return DatasetSnapshot(
+        None,
+        records,
+        np.arange(1, cities * years + 1, dtype=np.int64),
+        city_index,
+        np.tile(np.arange(2000, 2000 + years, dtype=np.int64), cities),
+        populations,
+        rng.integers(0, len(sources), cities * years).astype(np.int32),
+        sources,
+        forecasts=(
+            datetime.now().year,
+            np.full(cities, 2000 + years, dtype=np.int64),
+            populations[years - 1::years] * 102 // 100,
+        ),
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare payload size and encode/decode time of the JSON, MessagePack and Arrow '
+        'responses of the city read endpoints, on the current dataset or a generated one.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cities', type=int, default=0,
+                            help='Generate this many cities in memory instead of using the database.')
+        parser.add_argument('--years', type=int, default=20, help='Years of history per generated city.')
+        parser.add_argument('--batch', type=int, default=100, help='Cities in the batch-fetch scenario.')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per measurement (median is reported).')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for generated data.')
+        parser.add_argument('--output', help='Write the JSON report here instead of stdout.')
+
+    def handle(self, *args, **options):
+        if options['cities']:
+            snapshot = synthetic_snapshot(options['cities'], options['years'], options['seed'])
+        else:
+            snapshot = get_snapshot()
+            # Fit every forecast once up front so the timings measure encoding only
+            snapshot.forecast_many(snapshot.cities)
+        if not snapshot.cities:
+            raise CommandError('No cities to encode; load data or pass --cities.')
+
+        scenarios = {
+            'list': (snapshot.cities, True),
+            'batch': (snapshot.cities[:options['batch']], False),
+            'detail': (snapshot.cities[:1], False),
+        }
+        report = {
+            'cities': len(snapshot.cities),
+            'rows': len(snapshot.row_ids),
+            'repeat': options['repeat'],
+            'scenarios': {
+                name: self.measure(snapshot, records, streamed, options['repeat'])
+                for name, (records, streamed) in scenarios.items()
+            },
+        }
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output + '\n')
+            self.stdout.write(self.style.SUCCESS(f'✔ Wrote format benchmark to {options["output"]}'))
+        else:
+            self.stdout.write(output)
+
+    @staticmethod
+    def timed(function, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = function()
+            timings.append(time.perf_counter() - started)
+        return result, round(statistics.median(timings) * 1000, 3)
+
+    def measure(self, snapshot, records, streamed, repeat):
+        results = {}
+        for fmt in FORMATS:
+            body, encode_ms = self.timed(lambda: encode(fmt, snapshot, records, streamed), repeat)
+            _, decode_ms = self.timed(lambda: decode(fmt, body), repeat)
+            results[fmt] = {
+                'bytes': len(body),
+                'gzip_bytes': len(gzip.compress(body, compresslevel=6)),
+                'encode_ms': encode_ms,
+                'decode_ms': decode_ms,
+            }
+        json_result = results['json']
+        for fmt in FORMATS[1:]:
+            results[fmt]['size_vs_json'] = round(results[fmt]['bytes'] / json_result['bytes'], 3)
+            results[fmt]['encode_speedup'] = round(json_result['encode_ms'] / max(results[fmt]['encode_ms'], 1e-3), 2)
+            results[fmt]['decode_speedup'] = round(json_result['decode_ms'] / max(results[fmt]['decode_ms'], 1e-3), 2)
+        return results
@@ -0,0 +1,301 @@
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+
+from analytics.models import City, User
+
+# Read-only endpoints (URL names from analytics/urls.py) the mix may use, and the default weights
+READ_ROUTES = (
+    'cities-list', 'cities-list-noapi', 'city-detail', 'city-detail-noapi', 'cities-batch', 'cities-batch-noapi',
+    'cities-search', 'cities-search-noapi', 'changes', 'changes-noapi', 'overall-summary',
+)
+DEFAULT_MIX = 'cities-list:1,city-detail:8,cities-batch:3,cities-search:6,overall-summary:1,changes:1'
+
+# Routes that need a city id, and how many ids a batch request asks for
+CITY_ROUTES = ('city-detail', 'city-detail-noapi')
+BATCH_SIZE = 10
+
+SERVER_COMMANDS = {
+    'wsgi': lambda port, workers: [
+        sys.executable, '-m', 'gunicorn', 'population_site.wsgi',
+        '--bind', f'127.0.0.1:{port}', '--workers', str(workers), '--log-level', 'warning',
+    ],
+    'asgi': lambda port, workers: [
+        sys.executable, '-m', 'uvicorn', 'population_site.asgi:application',
+        '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers), '--log-level', 'warning',
+    ],
+}
+
+
+class Connection:
+    """A keep-alive HTTP/1.1 connection; enough of the protocol for JSON API responses."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, host, port):
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def request(self, host, path, headers):
+        lines = [f'GET {path} HTTP/1.1', f'Host: {host}', 'Connection: keep-alive']
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        response_headers = {}
+        while (line := await self.reader.readline()) not in (b'\r\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get('transfer-encoding') == 'chunked':
+            while size := int((await self.reader.readline()).strip(), 16):
+                await self.reader.readexactly(size + 2)
+            await self.reader.readline()
+        elif 'content-length' in response_headers:
+            await self.reader.readexactly(int(response_headers['content-length']))
+        else:
+            await self.reader.read()
+            return status, False
+        reusable = response_headers.get('connection', '').lower() != 'close'
+        return status, reusable
+
+    def close(self):
+        self.writer.close()
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive a weighted mix of the read endpoints at a target request rate with anonymous and '
+        'token-authenticated calls, against a local gunicorn (WSGI) or uvicorn (ASGI) server, and '
+        'report throughput and p50/p95/p99 latency per endpoint as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=sorted(SERVER_COMMANDS), default='wsgi',
+                            help='Server to start: gunicorn (wsgi) or uvicorn (asgi).')
+        parser.add_argument('--workers', type=int, default=2, help='Server worker processes.')
+        parser.add_argument('--port', type=int, default=0, help='Port for the local server (default: a free one).')
+        parser.add_argument('--url', help='Load an already running server at this base URL instead of starting one.')
+        parser.add_argument('--rate', type=float, default=50, help='Target requests per second.')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to generate load.')
+        parser.add_argument('--warmup', type=float, default=2,
+                            help='Seconds of unmeasured load first (worker imports, snapshot builds).')
+        parser.add_argument('--concurrency', type=int, default=32, help='Most requests in flight (open connections).')
+        parser.add_argument('--mix', default=DEFAULT_MIX, help='Comma-separated url_name:weight pairs.')
+        parser.add_argument('--user', default='superadmin', help='User whose API token authenticated calls use.')
+        parser.add_argument('--auth-ratio', type=float, default=0.5, help='Share of calls sent with the token.')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the request sequence.')
+        parser.add_argument('--output', help='Write the JSON report here instead of stdout.')
+
+    def handle(self, *args, **options):
+        mix = self.parse_mix(options['mix'])
+        city_ids = list(City.objects.values_list('id', flat=True))
+        names = list(City.objects.values_list('city_name', flat=True))
+        if not city_ids:
+            raise CommandError('No cities in the database; nothing to load test.')
+        token = self.get_token(options['user']) if options['auth_ratio'] > 0 else None
+
+        rng = random.Random(options['seed'])
+        warmup = self.build_plan(mix, rng, city_ids, names, token, options, options['warmup'])
+        plan = self.build_plan(mix, rng, city_ids, names, token, options, options['duration'])
+
+        server = None
+        base_url = options['url']
+        if base_url is None:
+            port = options['port'] or self.free_port()
+            server = self.start_server(options['mode'], port, options['workers'])
+            base_url = f'http://127.0.0.1:{port}'
+        try:
+            parsed = urlsplit(base_url)
+            load = (parsed.hostname, parsed.port or 80, token, options['rate'], options['concurrency'])
+            if warmup:
+                asyncio.run(self.run_load(load, warmup))
+            started = time.perf_counter()
+            results = asyncio.run(self.run_load(load, plan))
+            elapsed = time.perf_counter() - started
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait(timeout=30)
+
+        report = self.build_report(results, elapsed, options, base_url)
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output + '\n')
+            self.stdout.write(self.style.SUCCESS(f'✔ Wrote load test report to {options["output"]}'))
+        else:
+            self.stdout.write(output)
+
+    # ------------------ Setup ------------------
+
+    def parse_mix(self, spec):
+        mix = {}
+        for item in spec.split(','):
+            name, _, weight = item.strip().partition(':')
+            if name not in READ_ROUTES:
+                raise CommandError(f'Unsupported endpoint in --mix: {name!r} (choose from {", ".join(READ_ROUTES)})')
+            try:
+                mix[name] = float(weight or 1)
+            except ValueError:
+                raise CommandError(f'Invalid weight in --mix: {item!r}')
+            if not math.isfinite(mix[name]) or mix[name] < 0:
+                raise CommandError(f'Invalid weight in --mix: {item!r}')
+        if not sum(mix.values()):
+            raise CommandError('At least one --mix weight must be positive.')
+        return mix
+
+    def build_plan(self, mix, rng, city_ids, names, token, options, seconds):
+        """Returns (url_name, path, authenticated) for every request of a run."""
+        return [
+            (
+                name,
+                self.build_path(name, rng, city_ids, names),
+                token is not None and rng.random() < options['auth_ratio'],
+            )
+            for name in rng.choices(list(mix), weights=list(mix.values()), k=int(options['rate'] * seconds))
+        ]
+
+    def build_path(self, name, rng, city_ids, names):
+        if name in CITY_ROUTES:
+            return reverse(name, kwargs={'city_id': rng.choice(city_ids)})
+        path = reverse(name)
+        if name.startswith('cities-batch'):
+            return path + '?ids=' + ','.join(str(city_id) for city_id in rng.sample(city_ids, min(BATCH_SIZE, len(city_ids))))
+        if name.startswith('cities-search'):
+            return path + '?q=' + rng.choice(names)[:3].replace(' ', '+')
+        return path
+
+    def get_token(self, username):
+        try:
+            user = User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise CommandError(f'User {username!r} not found (needed for authenticated calls; see --user).')
+        token, _ = Token.objects.get_or_create(user=user)
+        return token.key
+
+    @staticmethod
+    def free_port():
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    def start_server(self, mode, port, workers, timeout=60):
+        server = subprocess.Popen(SERVER_COMMANDS[mode](port, workers), cwd=settings.BASE_DIR, env=os.environ.copy())
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f'The {mode} server exited with code {server.returncode}.')
+            # Workers may still be importing the app after the port opens, so wait for a response
+            try:
+                urlopen(f'http://127.0.0.1:{port}{reverse("cities-search")}', timeout=5).close()
+                return server
+            except HTTPError:
+                return server
+            except OSError:
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError(f'The {mode} server did not start listening on port {port} within {timeout}s.')
+
+    # ------------------ Load ------------------
+
+    async def run_load(self, load, plan):
+        """
+        Open-loop load: request i is due at start + i / rate whether or not earlier ones
+        finished, and latency is measured from that due time so a stalled server is not
+        hidden by the client backing off (coordinated omission).
+        """
+        host, port, token, rate, concurrency = load
+        idle = []
+        slots = asyncio.Semaphore(concurrency)
+        results = []
+        loop = asyncio.get_running_loop()
+
+        async def send(name, path, authenticated, due):
+            async with slots:
+                connection = idle.pop() if idle else None
+                headers = {'Authorization': f'Token {token}'} if authenticated else {}
+                try:
+                    if connection is None:
+                        connection = await Connection.open(host, port)
+                    status, reusable = await connection.request(host, path, headers)
+                except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                    status, reusable = None, False
+                latency = loop.time() - due
+                if connection is not None:
+                    if reusable:
+                        idle.append(connection)
+                    else:
+                        connection.close()
+                results.append((name, authenticated, status, latency))
+
+        start = loop.time()
+        tasks = []
+        for index, (name, path, authenticated) in enumerate(plan):
+            due = start + index / rate
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(name, path, authenticated, due)))
+        await asyncio.gather(*tasks)
+        for connection in idle:
+            connection.close()
+        return results
+
+    # ------------------ Report ------------------
+
+    @staticmethod
+    def summarize(rows, elapsed):
+        latencies = np.array([latency for *_, latency in rows]) * 1000
+        statuses = {}
+        for _, _, status, _ in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (0, 0, 0)
+        return {
+            'requests': len(rows),
+            'errors': sum(1 for _, _, status, _ in rows if status is None or status >= 500),
+            'statuses': statuses,
+            'throughput': round(len(rows) / elapsed, 2),
+            'latency_ms': {
+                'p50': round(float(p50), 2),
+                'p95': round(float(p95), 2),
+                'p99': round(float(p99), 2),
+                'mean': round(float(latencies.mean()), 2) if len(latencies) else 0,
+                'max': round(float(latencies.max()), 2) if len(latencies) else 0,
+            },
+        }
+
+    def build_report(self, results, elapsed, options, base_url):
+        endpoints = {}
+        for row in results:
+            endpoints.setdefault(row[0], []).append(row)
+        return {
+            'mode': options['mode'] if options['url'] is None else 'external',
+            'url': base_url,
+            'workers': options['workers'] if options['url'] is None else None,
+            'target_rate': options['rate'],
+            'duration': round(elapsed, 2),
+            'concurrency': options['concurrency'],
+            'overall': self.summarize(results, elapsed),
+            'anonymous': self.summarize([row for row in results if not row[1]], elapsed),
+            'authenticated': self.summarize([row for row in results if row[1]], elapsed),
+            'endpoints': {name: self.summarize(rows, elapsed) for name, rows in sorted(endpoints.items())},
+        }
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from analytics.similarity import cache_path
+from analytics.snapshot import get_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Compute the growth similarity index of the current dataset version and store it in the disk cache.'
+
+    def handle(self, *args, **options):
+        snapshot = get_snapshot()
+        similarity = snapshot.similarity()
+        clustered = int(similarity.sizes.sum())
+        self.stdout.write(self.style.SUCCESS(
+            f'✔ {clustered} of {len(snapshot.cities)} cities in {len(similarity.sizes)} growth clusters'
+        ))
+        if snapshot.version is None:
+            self.stdout.write('Dataset has no version yet (nothing written since the cache was cleared); not stored')
+        else:
+            self.stdout.write(f'Stored in {cache_path(snapshot.version)}')
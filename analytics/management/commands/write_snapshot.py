@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from analytics.snapshot import DatasetSnapshot, current_version
+from analytics.snapshot_file import write_snapshot_file
+
+
+class Command(BaseCommand):
+    help = 'Write the shared, memory-mapped dataset snapshot file (city series and precomputed forecasts).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            default=settings.ANALYTICS_SNAPSHOT_FILE,
+            help='Snapshot file to write (defaults to ANALYTICS_SNAPSHOT_FILE).',
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not path:
+            raise CommandError('No snapshot path given and ANALYTICS_SNAPSHOT_FILE is not set.')
+
+        # Labelled with the current dataset version, so workers serve it until the next write
+        snapshot = DatasetSnapshot.build(current_version())
+        version = write_snapshot_file(snapshot, path)
+        self.stdout.write(self.style.SUCCESS(
+            f'✔ Wrote snapshot {version} to {path} '
+            f'({len(snapshot.cities)} cities, {len(snapshot.years)} population rows)'
+        ))
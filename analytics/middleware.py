@@ -0,0 +1,74 @@
+# analytics/middleware.py
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .routers import pin_primary, unpin
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+SESSION_PIN_KEY = 'primary_pinned_until'
+
+
+class ReadYourWritesMiddleware:
+    """
+    Pins the request's database reads to the primary when it is a write, or when the
+    same token / session wrote within ANALYTICS_PRIMARY_PIN_SECONDS, so clients never
+    read their own changes back from a lagging replica.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        is_write = request.method not in SAFE_METHODS
+        token = pin_primary(is_write or self._recently_wrote(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            unpin(token)
+
+        if is_write and response.status_code < 400:
+            self._remember_write(request)
+        return response
+
+    @staticmethod
+    def _token_pin_key(request):
+        # DRF authenticates later, so read the token straight from the header
+        authorization = request.headers.get('Authorization', '')
+        if not authorization.startswith('Token '):
+            return None
+        digest = hashlib.sha256(authorization[6:].strip().encode()).hexdigest()
+        return f'analytics:primary-pin:{digest}'
+
+    def _recently_wrote(self, request):
+        key = self._token_pin_key(request)
+        if key is not None:
+            return cache.get(key) is not None
+        session = getattr(request, 'session', None)
+        return session is not None and session.get(SESSION_PIN_KEY, 0) > time.time()
+
+    def _remember_write(self, request):
+        seconds = getattr(settings, 'ANALYTICS_PRIMARY_PIN_SECONDS', 10)
+        key = self._token_pin_key(request)
+        if key is not None:
+            cache.set(key, 1, timeout=seconds)
+        elif getattr(request, 'session', None) is not None:
+            request.session[SESSION_PIN_KEY] = time.time() + seconds
+
+
+class ThrottleHeadersMiddleware:
+    """Reports the caller's cost-throttle budget (see throttles.py) on throttled endpoints."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        budget = getattr(request, 'throttle_budget', None)
+        if budget is not None:
+            response['X-RateLimit-Limit'] = budget['limit']
+            response['X-RateLimit-Remaining'] = budget['remaining']
+            response['X-RateLimit-Cost'] = budget['cost']
+        return response
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 02:53
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0004_changelog'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='city',
+            index=models.Index(django.db.models.functions.text.Lower('city_name'), name='city_name_lower_idx'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.7 on 2026-10-19 03:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0005_city_name_lower_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='populationdata',
+            name='city',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='analytics.city'),
+        ),
+        migrations.CreateModel(
+            name='Area',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('level', models.CharField(choices=[('country', 'Country'), ('region', 'Region'), ('province', 'Province'), ('city', 'City'), ('barangay', 'Barangay')], max_length=20)),
+                ('path', models.CharField(db_index=True, editable=False, max_length=255)),
+                ('depth', models.PositiveSmallIntegerField(default=0, editable=False)),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='children', to='analytics.area')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='city',
+            name='area',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='cities', to='analytics.area'),
+        ),
+        migrations.AddField(
+            model_name='populationdata',
+            name='area',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='population', to='analytics.area'),
+        ),
+        migrations.CreateModel(
+            name='AreaPopulation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('total', models.BigIntegerField(default=0)),
+                ('area', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='analytics.area')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('area', 'year'), name='area_population_area_year_uniq')],
+            },
+        ),
+    ]
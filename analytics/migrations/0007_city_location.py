@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-19 03:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0006_areas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='city',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='city',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.7 on 2026-10-19 03:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0007_city_location'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='populationdata',
+            name='anomaly_score',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='QuarantinedPopulation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('population_count', models.BigIntegerField()),
+                ('source', models.CharField(blank=True, max_length=255)),
+                ('score', models.FloatField()),
+                ('expected', models.BigIntegerField(blank=True, null=True)),
+                ('reason', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('pending', 'Pending review'), ('released', 'Released'), ('discarded', 'Discarded')], db_index=True, default='pending', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('reviewed_at', models.DateTimeField(blank=True, null=True)),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='quarantined', to='analytics.city')),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='quarantined_population', to=settings.AUTH_USER_MODEL)),
+                ('population', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='quarantined', to='analytics.populationdata')),
+                ('reviewed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
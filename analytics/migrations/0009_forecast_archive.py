@@ -0,0 +1,34 @@
+# Generated by Django 5.2.7 on 2026-10-19 03:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0008_population_screening'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForecastArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('engine', models.PositiveSmallIntegerField(choices=[(1, 'linear')])),
+                ('target_year', models.IntegerField()),
+                ('base_year', models.IntegerField()),
+                ('basis', models.BigIntegerField()),
+                ('predicted_population', models.BigIntegerField()),
+                ('made_at', models.DateTimeField(auto_now_add=True)),
+                ('actual_population', models.BigIntegerField(blank=True, null=True)),
+                ('error', models.BigIntegerField(blank=True, null=True)),
+                ('abs_pct_error', models.FloatField(blank=True, null=True)),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='forecasts', to='analytics.city')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['engine', 'target_year'], name='forecast_archive_engine_idx')],
+                'constraints': [models.UniqueConstraint(fields=('city', 'engine', 'target_year', 'basis'), name='forecast_archive_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.7 on 2026-10-19 03:36
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0009_forecast_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PopulationObservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('granularity', models.CharField(choices=[('quarter', 'Quarterly'), ('month', 'Monthly')], max_length=7)),
+                ('period', models.PositiveSmallIntegerField()),
+                ('population_count', models.BigIntegerField()),
+                ('source', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='observations', to='analytics.city')),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='population_observations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('city', 'year', 'granularity', 'period'), name='population_observation_uniq')],
+            },
+        ),
+    ]
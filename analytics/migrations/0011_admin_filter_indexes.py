@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-19 03:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0010_population_observations'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='city',
+            index=models.Index(fields=['region'], name='city_region_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='populationdata',
+            index=models.Index(fields=['year'], name='population_year_idx'),
+        ),
+    ]
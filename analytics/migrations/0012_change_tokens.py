@@ -0,0 +1,41 @@
+# Generated by Django 5.2.7 on 2026-10-19 05:10
+
+from django.db import migrations, models
+from django.db.models import F, Max
+
+
+def seed_tokens(apps, schema_editor):
+    # Existing entries keep their id as their token; the sequence continues after them
+    ChangeLog = apps.get_model('analytics', 'ChangeLog')
+    ChangeSequence = apps.get_model('analytics', 'ChangeSequence')
+    ChangeLog.objects.update(token=F('id'))
+    latest = ChangeLog.objects.aggregate(latest=Max('id'))['latest'] or 0
+    ChangeSequence.objects.create(pk=1, value=latest)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0011_admin_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='changelog',
+            name='token',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.RunPython(seed_tokens, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='changelog',
+            name='token',
+            field=models.BigIntegerField(unique=True),
+        ),
+    ]
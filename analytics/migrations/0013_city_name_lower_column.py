@@ -0,0 +1,38 @@
+# Generated by Django 5.2.7 on 2026-10-19 05:40
+
+from django.db import migrations
+
+# mssql-django skips the Lower('city_name') expression index of 0005. On SQL Server the same
+# lookup is served by an index on a persisted computed column: the optimizer matches
+# LOWER(city_name) in a query to the column's definition and seeks its index. The column
+# is unknown to Django, so it must be dropped before any later migration alters city_name.
+COMPUTED_COLUMN = 'city_name_lower'
+COMPUTED_INDEX = 'city_name_lower_col_idx'
+
+
+def add_computed_column(apps, schema_editor):
+    if schema_editor.connection.vendor != 'microsoft':
+        return
+    table = schema_editor.quote_name(apps.get_model('analytics', 'City')._meta.db_table)
+    column = schema_editor.quote_name(COMPUTED_COLUMN)
+    schema_editor.execute(f'ALTER TABLE {table} ADD {column} AS LOWER({schema_editor.quote_name("city_name")}) PERSISTED')
+    schema_editor.execute(f'CREATE INDEX {schema_editor.quote_name(COMPUTED_INDEX)} ON {table} ({column})')
+
+
+def drop_computed_column(apps, schema_editor):
+    if schema_editor.connection.vendor != 'microsoft':
+        return
+    table = schema_editor.quote_name(apps.get_model('analytics', 'City')._meta.db_table)
+    schema_editor.execute(f'DROP INDEX {schema_editor.quote_name(COMPUTED_INDEX)} ON {table}')
+    schema_editor.execute(f'ALTER TABLE {table} DROP COLUMN {schema_editor.quote_name(COMPUTED_COLUMN)}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0012_change_tokens'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_computed_column, drop_computed_column),
+    ]
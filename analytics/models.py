@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser, Group, Permission
+from django.db.models.functions import Lower
 
 class User(AbstractUser):
     ROLE_CHOICES = (
@@ -28,20 +29,217 @@ class User(AbstractUser):
         verbose_name='user permissions'
     )
 
+class Area(models.Model):
+    """
+    Node of the geographic hierarchy (country > region > province > city > barangay).
+    path is the materialized path of ids from the root, e.g. "/1/4/17/", so ancestors
+    are read from the path itself and a subtree is one indexed prefix match.
+    """
+    LEVEL_CHOICES = (
+        ('country', 'Country'),
+        ('region', 'Region'),
+        ('province', 'Province'),
+        ('city', 'City'),
+        ('barangay', 'Barangay'),
+    )
+    name = models.CharField(max_length=100)
+    level = models.CharField(max_length=20, choices=LEVEL_CHOICES)
+    parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.PROTECT, related_name='children')
+    path = models.CharField(max_length=255, db_index=True, editable=False)
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
+
+    def __str__(self):
+        return f"{self.name} ({self.level})"
+
+
+class AreaPopulation(models.Model):
+    """
+    Per-year population total of an area including all of its descendants, kept up to
+    date incrementally along the path to the root on every write (see areas.py).
+    """
+    area = models.ForeignKey(Area, on_delete=models.CASCADE, related_name='rollups')
+    year = models.IntegerField()
+    total = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['area', 'year'], name='area_population_area_year_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.area.name} - {self.year}: {self.total}"
+
+
 class City(models.Model):
     city_name = models.CharField(max_length=100, unique=True)
     region = models.CharField(max_length=100, blank=True)
+    # The city's node in the area hierarchy, if placed
+    area = models.ForeignKey(Area, null=True, blank=True, on_delete=models.PROTECT, related_name='cities')
+    # WGS84 coordinates in degrees, for the nearby-cities search
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Case-insensitive name lookups and duplicate checks (add_city). mssql-django does not
+            # create expression indexes; there migration 0013 indexes a computed column instead
+            models.Index(Lower('city_name'), name='city_name_lower_idx'),
+            # Region filters of the admin changelists
+            models.Index(fields=['region'], name='city_region_idx'),
+        ]
 
     def __str__(self):
         return self.city_name
 
 class PopulationData(models.Model):
-    city = models.ForeignKey(City, on_delete=models.CASCADE)
+    # Rows attach to a city or directly to an area at any level; area always holds the
+    # area the row counts towards (the city's area for city rows)
+    city = models.ForeignKey(City, null=True, blank=True, on_delete=models.CASCADE)
+    area = models.ForeignKey(Area, null=True, blank=True, on_delete=models.PROTECT, related_name='population')
     year = models.IntegerField()
     population_count = models.BigIntegerField()
     source = models.CharField(max_length=255, blank=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Screening score of a row written despite looking anomalous (see screening.py); null otherwise
+    anomaly_score = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Year filters and the admin's year range (MIN / MAX seeks)
+            models.Index(fields=['year'], name='population_year_idx'),
+        ]
+
+    def __str__(self):
+        name = self.city.city_name if self.city_id else self.area.name
+        return f"{name} - {self.year}"
+
+
+class PopulationObservation(models.Model):
+    """
+    A sub-annual (quarterly or monthly) population count of a city. Kept apart from the
+    yearly PopulationData rows so histories, rollups and screening stay annual; forecasting
+    and growth read them resampled (see resampling.py).
+    """
+    GRANULARITY_CHOICES = (
+        ('quarter', 'Quarterly'),
+        ('month', 'Monthly'),
+    )
+    city = models.ForeignKey(City, on_delete=models.CASCADE, related_name='observations')
+    year = models.IntegerField()
+    granularity = models.CharField(max_length=7, choices=GRANULARITY_CHOICES)
+    # Quarter 1-4 or month 1-12 of the year; the count is taken at the end of the period
+    period = models.PositiveSmallIntegerField()
+    population_count = models.BigIntegerField()
+    source = models.CharField(max_length=255, blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='population_observations')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['city', 'year', 'granularity', 'period'], name='population_observation_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.city.city_name} - {self.year} {self.granularity} {self.period}"
+
+
+class QuarantinedPopulation(models.Model):
+    """
+    A population write held back by ingestion screening until it is reviewed: a new row
+    (population empty) or new values for an existing one. Releasing writes it as submitted.
+    """
+    STATUS_CHOICES = (
+        ('pending', 'Pending review'),
+        ('released', 'Released'),
+        ('discarded', 'Discarded'),
+    )
+    city = models.ForeignKey(City, on_delete=models.CASCADE, related_name='quarantined')
+    population = models.ForeignKey(PopulationData, null=True, blank=True, on_delete=models.CASCADE, related_name='quarantined')
+    year = models.IntegerField()
+    population_count = models.BigIntegerField()
+    source = models.CharField(max_length=255, blank=True)
+    score = models.FloatField()
+    expected = models.BigIntegerField(null=True, blank=True)
+    reason = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', db_index=True)
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='quarantined_population')
+    created_at = models.DateTimeField(auto_now_add=True)
+    reviewed_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    reviewed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.city.city_name} - {self.year}: {self.population_count} ({self.status})"
+
+
+class ForecastArchive(models.Model):
+    """
+    A forecast of a city's population for a target year by one engine. basis is a checksum
+    of the city's history the forecast was made from, so re-running on unchanged data adds
+    nothing. The actual / error columns are filled in when a row for the target year lands
+    (see forecast_archive.py), so accuracy is aggregated without touching the history.
+    """
+    ENGINE_LINEAR = 1
+    ENGINE_CHOICES = (
+        (ENGINE_LINEAR, 'linear'),
+    )
+    city = models.ForeignKey(City, on_delete=models.CASCADE, related_name='forecasts')
+    engine = models.PositiveSmallIntegerField(choices=ENGINE_CHOICES)
+    target_year = models.IntegerField()
+    # Latest observed year of the history the forecast was made from
+    base_year = models.IntegerField()
+    basis = models.BigIntegerField()
+    predicted_population = models.BigIntegerField()
+    made_at = models.DateTimeField(auto_now_add=True)
+    actual_population = models.BigIntegerField(null=True, blank=True)
+    # predicted - actual, and its absolute value as a percentage of the actual
+    error = models.BigIntegerField(null=True, blank=True)
+    abs_pct_error = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['city', 'engine', 'target_year', 'basis'], name='forecast_archive_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['engine', 'target_year'], name='forecast_archive_engine_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.city.city_name} - {self.target_year} ({self.get_engine_display()}): {self.predicted_population}"
+
+
+class ChangeSequence(models.Model):
+    """
+    Single-row counter the change tokens are taken from. Writers update the row in the
+    transaction that logs their changes and hold its lock until commit, so tokens
+    become visible in the order they were issued.
+    """
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"Change sequence at {self.value}"
+
+
+class ChangeLog(models.Model):
+    """
+    Append-only log of dataset writes. The token, taken from ChangeSequence, is the
+    change token handed to clients of /api/changes/; deletes are kept as tombstones.
+    """
+    ENTITY_CHOICES = (
+        ('city', 'City'),
+        ('population', 'Population data'),
+    )
+    ACTION_CHOICES = (
+        ('upsert', 'Created or updated'),
+        ('delete', 'Deleted'),
+    )
+    token = models.BigIntegerField(unique=True)
+    entity = models.CharField(max_length=20, choices=ENTITY_CHOICES)
+    object_id = models.BigIntegerField()
+    # Plain integer so tombstones outlive the city they refer to
+    city_id = models.BigIntegerField(null=True, blank=True)
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
     def __str__(self):
-        return f"{self.city.city_name} - {self.year}"
+        return f"{self.token}: {self.action} {self.entity} {self.object_id}"
@@ -0,0 +1,88 @@
+# analytics/rankings.py
+"""
+Top-k city leaderboards for /api/rankings/ and the summary report.
+
+CityRankings holds every ranking metric as an array aligned with the snapshot's cities,
+computed once per snapshot and forecast year (so it follows data writes and the new
+year's forecasts) with bincount / offset arithmetic over the CSR arrays, plus the
+members of every region. A query takes the candidates (all cities or one region's),
+selects the k best with argpartition in linear time, and sorts only those k.
+"""
+from datetime import datetime
+
+import numpy as np
+
+METRICS = ('predicted_population', 'predicted_growth', 'predicted_change', 'historical_growth', 'absolute_change')
+
+
+class CityRankings:
+    def __init__(self, snapshot):
+        self.year = datetime.now().year
+        self.ids = np.array([record.id for record in snapshot.cities], dtype=np.int64)
+
+        offsets = np.asarray(snapshot.offsets)
+        counts = np.diff(offsets)
+        # Cities without rows have no latest population and are left out of every ranking
+        self.has_data = counts > 0
+        latest_rows = np.where(self.has_data, offsets[1:] - 1, 0)
+        first_rows = np.where(self.has_data, offsets[:-1], 0)
+        populations = snapshot.populations if len(snapshot.populations) else np.zeros(1, dtype=np.int64)
+        self.latest = np.where(self.has_data, populations[latest_rows], 0)
+        first = np.where(self.has_data, populations[first_rows], 0)
+
+        _, self.predicted_years, self.predicted = snapshot.forecast_arrays()
+        self.predicted_change = self.predicted - self.latest
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # As in the summary report: no growth rate from a latest population of 0
+            predicted_growth = np.where(self.latest > 0, self.predicted_change / self.latest * 100, 0.0)
+            # Mean year-over-year growth, 0 for cities without any (as snapshot.average_growth)
+            valid = ~np.isnan(snapshot.growth)
+            city_index = snapshot.city_index[valid]
+            growth_counts = np.bincount(city_index, minlength=len(self.ids))
+            historical_growth = np.where(
+                growth_counts > 0,
+                np.bincount(city_index, snapshot.growth[valid], minlength=len(self.ids)) / growth_counts,
+                0.0,
+            )
+
+        self.metrics = {
+            'predicted_population': self.predicted.astype(np.float64),
+            'predicted_growth': predicted_growth,
+            'predicted_change': self.predicted_change.astype(np.float64),
+            'historical_growth': historical_growth,
+            'absolute_change': (self.latest - first).astype(np.float64),
+        }
+
+        # Cities (with data) of each region, from one stable sort of the region codes
+        regions, codes = np.unique(np.array([record.region for record in snapshot.cities], dtype=str),
+                                   return_inverse=True)
+        members = np.flatnonzero(self.has_data)
+        members = members[np.argsort(codes[members], kind='stable')]
+        bounds = np.searchsorted(codes[members], np.arange(len(regions) + 1))
+        self.all_cities = np.flatnonzero(self.has_data)
+        self.regions = {
+            region: members[bounds[code]:bounds[code + 1]] for code, region in enumerate(regions.tolist())
+        }
+
+    def is_fresh(self):
+        return self.year == datetime.now().year
+
+    def top(self, metric, k, region=None, ascending=False):
+        """
+        Snapshot indexes of the k cities with the highest (or with ascending, lowest) metric,
+        best first, optionally within one region. Ties go to the lower city id.
+        """
+        candidates = self.all_cities if region is None else self.regions.get(region, self.all_cities[:0])
+        if k < 1 or not len(candidates):
+            return candidates[:0]
+        keys = self.metrics[metric][candidates]
+        if not ascending:
+            keys = -keys
+        if k < len(candidates):
+            # Everything tied with the k-th value is kept, so the id tie-break below stays exact
+            selected = np.argpartition(keys, k - 1)[:k]
+            selected = np.flatnonzero(keys <= keys[selected].max())
+        else:
+            selected = np.arange(len(candidates))
+        order = np.lexsort((self.ids[candidates[selected]], keys[selected]))[:k]
+        return candidates[selected[order]]
@@ -0,0 +1,160 @@
+# analytics/renderers.py
+"""
+Binary response formats for the read endpoints, chosen by the Accept header.
+
+    Accept: application/msgpack                  -> MessagePack, same structure as the JSON
+    Accept: application/vnd.apache.arrow.stream  -> Arrow IPC stream, one row per city
+
+In the Arrow form, history is a struct of per-field lists (history.year,
+history.population, ...) rather than a list of row objects. cities_table builds those
+columns straight from the snapshot's CSR arrays, so no per-row dicts are created.
+Fields of a response that are not city rows (e.g. the batch endpoint's "missing") are
+stored JSON-encoded in the schema metadata.
+"""
+import json
+
+import msgpack
+import numpy as np
+import pyarrow as pa
+from rest_framework.renderers import BaseRenderer
+from rest_framework.settings import api_settings
+
+HISTORY_FIELDS = ('Historyid', 'year', 'population', 'source', 'growth')
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=str)
+
+
+class ArrowStreamRenderer(BaseRenderer):
+    media_type = 'application/vnd.apache.arrow.stream'
+    format = 'arrow'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        table = to_table(data)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+
+# Renderers of the read endpoints: the defaults (JSON, browsable API) plus the binary formats
+READ_RENDERER_CLASSES = [*api_settings.DEFAULT_RENDERER_CLASSES, MessagePackRenderer, ArrowStreamRenderer]
+
+BINARY_RENDERER_CLASSES = (MessagePackRenderer, ArrowStreamRenderer)
+
+
+def binary_renderer(request):
+    """
+    The binary renderer a plain Django view should answer with (it has no DRF content
+    negotiation), or None when the client did not ask for one.
+    """
+    accept = request.headers.get('Accept', '')
+    for renderer_class in BINARY_RENDERER_CLASSES:
+        if renderer_class.media_type in accept:
+            return renderer_class()
+    return None
+
+
+def wants_arrow(request):
+    renderer = getattr(request, 'accepted_renderer', None)
+    return renderer is not None and renderer.format == 'arrow'
+
+
+def _columnar_history(row):
+    history = row.get('history')
+    if not isinstance(history, list):
+        return row
+    fields = HISTORY_FIELDS + (('imputed',) if history and 'imputed' in history[0] else ())
+    return {
+        **row,
+        'history': {field: [entry.get(field) for entry in history] for field in fields},
+    }
+
+
+def to_table(data):
+    """
+    Converts response data to an Arrow table: a list of rows, the "cities" of a dict (the
+    other keys go to the metadata), or a single object as one row.
+    """
+    metadata = {}
+    if isinstance(data, dict) and isinstance(data.get('cities'), (list, pa.Table)):
+        metadata = {key: json.dumps(value, default=str) for key, value in data.items() if key != 'cities'}
+        rows = data['cities']
+    elif isinstance(data, (list, pa.Table)):
+        rows = data
+    else:
+        rows = [data]
+
+    if isinstance(rows, pa.Table):
+        table = rows
+    else:
+        rows = [_columnar_history(row) if isinstance(row, dict) else {'value': row} for row in rows]
+        keys = list(dict.fromkeys(key for row in rows for key in row))
+        table = pa.table({key: [row.get(key) for row in rows] for key in keys})
+    if metadata:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata})
+    return table
+
+
+def _history_column(snapshot, records, max_points=None):
+    """history as struct<field: list<...>> for these cities, gathered from the CSR arrays."""
+    offsets = np.zeros(len(records) + 1, dtype=np.int32)
+    if max_points is None:
+        indexes = np.array([record.index for record in records], dtype=np.int64)
+        starts = snapshot.offsets[indexes]
+        counts = snapshot.offsets[indexes + 1] - starts
+        np.cumsum(counts, out=offsets[1:])
+        # Row positions of every selected city, in order: each city's range shifted to its new offset
+        rows = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+    else:
+        selected = [np.r_[snapshot.history_rows(record, max_points)] for record in records]
+        np.cumsum([len(positions) for positions in selected], out=offsets[1:])
+        rows = np.concatenate(selected) if selected else np.zeros(0, dtype=np.int64)
+
+    row_ids = snapshot.row_ids[rows]
+    values = [
+        # Points of a gap-filled snapshot without a row (id -1) get a null id
+        pa.array(row_ids, mask=row_ids < 0) if snapshot.imputed is not None else pa.array(row_ids),
+        pa.array(snapshot.years[rows]),
+        pa.array(snapshot.populations[rows]),
+        pa.DictionaryArray.from_arrays(
+            pa.array(snapshot.source_ids[rows], type=pa.int32()), pa.array(snapshot.sources, type=pa.string())
+        ),
+        # Rounded like the JSON; NaN (no previous year) becomes null
+        pa.array(np.round(snapshot.growth[rows], 2), from_pandas=True),
+    ]
+    names = list(HISTORY_FIELDS)
+    if snapshot.imputed is not None:
+        values.append(pa.array(snapshot.imputed[rows]))
+        names.append('imputed')
+    offsets = pa.array(offsets)
+    return pa.StructArray.from_arrays(
+        [pa.ListArray.from_arrays(offsets, column) for column in values], names=names
+    )
+
+
+def cities_table(snapshot, records, forecasts=None, max_points=None):
+    """The cities in the shape of the JSON city objects, as an Arrow table."""
+    if forecasts is None:
+        forecasts = snapshot.forecast_many(records)
+    return pa.table({
+        'id': pa.array([record.id for record in records], type=pa.int64()),
+        'name': pa.array([record.name for record in records], type=pa.string()),
+        'region': pa.array([record.region for record in records], type=pa.string()),
+        'predicted_year': pa.array([year for year, _ in forecasts], type=pa.int64()),
+        'predicted_population': pa.array([population for _, population in forecasts], type=pa.int64()),
+        'history': _history_column(snapshot, records, max_points),
+    })
@@ -0,0 +1,124 @@
+# analytics/resampling.py
+"""
+Resampling of mixed-granularity population series, and chart downsampling.
+
+Every observation is placed on a month axis (year * 12 + month - 1) at the end of its
+period: a yearly PopulationData row at December, a quarterly count at the quarter's last
+month, a monthly count at its month. Resampling to a coarser frequency keeps the last
+observation of each bucket, the right reduction for a stock such as a population count,
+and a yearly row wins over a sub-annual count of the same month. All of it works on the
+sorted arrays of a series at once.
+
+For yearly forecasting, annual_series() adds resampled year-end figures only for years
+without a yearly row, so a city without sub-annual observations keeps exactly the series
+it had before.
+
+lttb() picks the points of a series that Largest-Triangle-Three-Buckets keeps, so chart
+payloads stay within max_points however long the series is.
+"""
+import numpy as np
+
+# Periods per year of the resampling frequencies and of the stored granularities
+FREQUENCIES = {'annual': 1, 'quarterly': 4, 'monthly': 12}
+GRANULARITY_PERIODS = {'quarter': 4, 'month': 12}
+
+YEAR_END_MONTH = 11
+
+
+def to_months(years, periods, periods_per_year):
+    """Month index (year * 12 + month - 1) of the end of each period."""
+    months_per_period = 12 // np.asarray(periods_per_year, dtype=np.int64)
+    return np.asarray(years, dtype=np.int64) * 12 + np.asarray(periods, dtype=np.int64) * months_per_period - 1
+
+
+def merge(row_years, months):
+    """
+    Places yearly rows (at year end) and sub-annual observations on one month axis, yearly
+    rows after observations of the same month. Returns (months, is_row, order), where order
+    sorts values concatenated as [rows..., observations...] the same way.
+    """
+    all_months = np.concatenate([np.asarray(row_years, dtype=np.int64) * 12 + YEAR_END_MONTH, months])
+    is_row = np.concatenate([np.ones(len(row_years), dtype=bool), np.zeros(len(months), dtype=bool)])
+    order = np.lexsort((is_row, all_months))
+    return all_months[order], is_row[order], order
+
+
+def resample(months, values, frequency):
+    """
+    Resamples a month-ordered series to a frequency, keeping the last value of each bucket.
+    Returns (buckets, values, positions); buckets count periods from year 0 (year * 4 +
+    quarter - 1 for quarterly) and positions index the kept input points.
+    """
+    buckets = np.asarray(months, dtype=np.int64) // (12 // FREQUENCIES[frequency])
+    positions = np.flatnonzero(np.append(buckets[1:] != buckets[:-1], True)) if len(buckets) else buckets
+    return buckets[positions], np.asarray(values)[positions], positions
+
+
+def bucket_period(buckets, frequency):
+    """(years, periods) of resampled buckets; the period is 1 for annual buckets."""
+    periods_per_year = FREQUENCIES[frequency]
+    return buckets // periods_per_year, buckets % periods_per_year + 1
+
+
+def annual_series(years, populations, months, values):
+    """
+    The yearly series a forecast is fitted on: the yearly rows, plus the last sub-annual
+    count of every year that has no yearly row. Without observations, the rows unchanged.
+    """
+    if not len(months):
+        return years, populations
+    observed_years, observed = resample(months, values, 'annual')[:2]
+    missing = ~np.isin(observed_years, years)
+    if not missing.any():
+        return years, populations
+    merged_years = np.concatenate([years, observed_years[missing]])
+    order = np.argsort(merged_years, kind='stable')
+    return merged_years[order], np.concatenate([populations, observed[missing]])[order]
+
+
+def period_growth(values):
+    """Percent change from the previous point, NaN for the first point or a previous value <= 0."""
+    values = np.asarray(values, dtype=np.float64)
+    growth = np.full(len(values), np.nan)
+    if len(values) > 1:
+        previous = values[:-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            growth[1:] = np.where(previous > 0, (values[1:] - previous) / previous * 100, np.nan)
+    return growth
+
+
+def lttb(x, y, threshold):
+    """
+    Indexes of the points Largest-Triangle-Three-Buckets keeps to draw (x, y) with at most
+    threshold points: always the first and last, and from each of the threshold - 2 equal
+    buckets in between, the point forming the largest triangle with the previously kept
+    point and the average of the next bucket. All points if there are no more than threshold.
+    """
+    size = len(x)
+    if threshold >= size:
+        return np.arange(size)
+    if threshold < 3:
+        return np.array([0, size - 1][:max(threshold, 0)], dtype=np.int64)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # Bucket b holds points edges[b]:edges[b + 1]; the first and last points are their own buckets
+    edges = np.floor(np.arange(threshold - 1) * (size - 2) / (threshold - 2)).astype(np.int64) + 1
+    edges[-1] = size - 1
+    counts = np.diff(edges)
+    average_x = np.append(np.add.reduceat(x[:-1], edges[:-1]) / counts, x[-1])
+    average_y = np.append(np.add.reduceat(y[:-1], edges[:-1]) / counts, y[-1])
+
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, size - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        # Twice the triangle area; the constant factor does not change the argmax
+        areas = np.abs(
+            (x[previous] - average_x[bucket + 1]) * (y[start:stop] - y[previous])
+            - (x[previous] - x[start:stop]) * (average_y[bucket + 1] - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        kept[bucket + 1] = previous
+    return kept
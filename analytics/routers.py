@@ -0,0 +1,63 @@
+# analytics/routers.py
+"""
+Primary/replica database routing.
+
+Reads go to the `replica` alias when one is configured; writes, migrations and
+authentication/session lookups always use `default`. A request is pinned to the
+primary for its whole duration when it is a write, or when the same session/token
+wrote something in the last ANALYTICS_PRIMARY_PIN_SECONDS (read-your-own-writes,
+see middleware.ReadYourWritesMiddleware).
+"""
+import contextvars
+from contextlib import contextmanager
+
+from django.conf import settings
+
+REPLICA = 'replica'
+
+# Auth and session data is read right after it is written (login, token issue)
+PRIMARY_ONLY_APPS = {'admin', 'auth', 'authtoken', 'contenttypes', 'sessions'}
+
+_pinned = contextvars.ContextVar('analytics_primary_pinned', default=False)
+
+
+def primary_pinned():
+    return _pinned.get()
+
+
+def pin_primary(pinned=True):
+    """Pins reads in the current context to the primary; returns a token for unpin()."""
+    return _pinned.set(pinned)
+
+
+def unpin(token):
+    _pinned.reset(token)
+
+
+@contextmanager
+def use_primary(pinned=True):
+    token = pin_primary(pinned)
+    try:
+        yield
+    finally:
+        unpin(token)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if REPLICA not in settings.DATABASES or primary_pinned():
+            return 'default'
+        if model._meta.app_label in PRIMARY_ONLY_APPS or model._meta.model_name == 'user':
+            return 'default'
+        return REPLICA
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica gets its schema through replication (or a copy of the primary locally)
+        return db == 'default'
@@ -0,0 +1,268 @@
+# analytics/screening.py
+"""
+Ingestion-time anomaly screening of population writes.
+
+Each incoming (city, year, population_count) is scored against the city's history in the
+current snapshot, in two ways:
+    trend:  distance from the city's least-squares line over its history (the same kind of
+            trend predict_next_year fits), in residual standard deviations, and
+    growth: the annualized growth implied from the city's nearest earlier year, in robust
+            standard deviations (median / MAD) of its historical year-over-year growth.
+The score is the larger of the two; both scales have floors so that short, smooth
+histories do not turn every small revision into an outlier. Cities with fewer than
+MIN_HISTORY rows are not screened.
+
+The per-city statistics are computed once per snapshot with bincount / sort over the CSR
+arrays, and a whole batch is scored with array operations, so screening costs a few
+microseconds per row even for very large loads. ANALYTICS_SCREENING_POLICY maps each
+action (flag, quarantine, reject) to the score at which it starts; flagged rows are
+written with their score, quarantined writes wait in QuarantinedPopulation for review.
+"""
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .areas import apply_changes
+from .forecast_archive import record_actuals
+from .models import City, PopulationData, QuarantinedPopulation
+
+MIN_HISTORY = 3
+
+# Floors of the two scales: a share of the expected population, and percentage points of growth
+TREND_FLOOR = 0.05
+GROWTH_FLOOR = 1.0
+
+# 1.4826 * MAD estimates the standard deviation of normally distributed growth
+MAD_SCALE = 1.4826
+
+DEFAULT_POLICY = {'flag': 4.0, 'quarantine': 8.0, 'reject': None}
+
+PASS, FLAG, QUARANTINE, REJECT = range(4)
+ACTIONS = ('pass', 'flag', 'quarantine', 'reject')
+
+# Lookup keys pack (city index, year) into one sortable int64
+YEAR_BITS = 20
+YEAR_OFFSET = 1 << (YEAR_BITS - 1)
+
+
+def _keys(city_index, years):
+    years = np.clip(np.asarray(years, dtype=np.int64), -YEAR_OFFSET, YEAR_OFFSET - 1) + YEAR_OFFSET
+    return (np.asarray(city_index, dtype=np.int64) << YEAR_BITS) | years
+
+
+def _grouped_medians(groups, values, size):
+    """Median of values per group (0..size-1), NaN for empty groups."""
+    # One argsort over group-offset values is several times faster than lexsort; the offsets
+    # keep groups apart and only round away differences far below what a median resolves
+    low_value = values.min() if len(values) else 0
+    order = np.argsort(groups * (np.ptp(values) + 1 if len(values) else 1) + (values - low_value))
+    groups, values = groups[order], values[order]
+    counts = np.bincount(groups, minlength=size)
+    starts = np.zeros(size, dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+    medians = np.full(size, np.nan)
+    present = counts > 0
+    low = starts[present] + (counts[present] - 1) // 2
+    high = starts[present] + counts[present] // 2
+    medians[present] = (values[low] + values[high]) / 2
+    return medians
+
+
+class CityTrends:
+    """Per-city trend line and growth distribution of a snapshot."""
+
+    def __init__(self, snapshot):
+        size = len(snapshot.cities)
+        city_index = snapshot.city_index.astype(np.int64)
+        years = snapshot.years.astype(np.float64)
+        populations = snapshot.populations.astype(np.float64)
+
+        self.city_ids = np.array([record.id for record in snapshot.cities], dtype=np.int64)
+        self.counts = np.bincount(city_index, minlength=size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.mean_year = np.bincount(city_index, years, minlength=size) / self.counts
+            self.mean_population = np.bincount(city_index, populations, minlength=size) / self.counts
+            centered = years - self.mean_year[city_index]
+            spread = np.bincount(city_index, centered * centered, minlength=size)
+            self.slope = np.where(spread > 0, np.bincount(city_index, centered * populations, minlength=size) / spread, 0)
+            residuals = populations - (self.mean_population[city_index] + self.slope[city_index] * centered)
+            self.residual_std = np.sqrt(
+                np.bincount(city_index, residuals * residuals, minlength=size) / np.maximum(self.counts - 2, 1)
+            )
+
+        valid = ~np.isnan(snapshot.growth)
+        growth_index = city_index[valid]
+        growth = snapshot.growth[valid]
+        self.growth_median = _grouped_medians(growth_index, growth, size)
+        deviations = np.abs(growth - self.growth_median[growth_index])
+        self.growth_spread = _grouped_medians(growth_index, deviations, size) * MAD_SCALE
+
+        # Rows sorted by (city, year) already, as the snapshot keeps them
+        self.row_keys = _keys(city_index, snapshot.years)
+        self.row_years = snapshot.years
+        self.row_populations = populations
+
+    def city_index(self, city_ids):
+        """Snapshot index of each city id (ids are sorted), -1 for unknown ids and None."""
+        city_ids = np.array([-1 if city_id is None else city_id for city_id in city_ids], dtype=np.int64)
+        if not len(self.city_ids):
+            return np.full(len(city_ids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.city_ids, city_ids), len(self.city_ids) - 1)
+        return np.where(self.city_ids[positions] == city_ids, positions, -1)
+
+
+class Screening:
+    """Scores and actions of a screened batch, aligned with its input rows."""
+
+    def __init__(self, score, expected, growth, previous_year, actions):
+        self.score = score
+        self.expected = expected
+        self.growth = growth
+        self.previous_year = previous_year
+        self.actions = actions
+
+    def __len__(self):
+        return len(self.actions)
+
+    def positions(self, action):
+        return np.flatnonzero(self.actions == action).tolist()
+
+    def action(self, position):
+        return ACTIONS[self.actions[position]]
+
+    def details(self, position):
+        score = self.score[position]
+        expected = self.expected[position]
+        growth = self.growth[position]
+        return {
+            'score': None if np.isnan(score) else round(float(score), 2),
+            'expected': None if np.isnan(expected) else int(round(expected)),
+            'implied_growth': None if np.isnan(growth) else round(float(growth), 2),
+        }
+
+    def reason(self, position):
+        details = self.details(position)
+        parts = []
+        if details['expected'] is not None:
+            parts.append(f"trend expects about {details['expected']}")
+        if details['implied_growth'] is not None:
+            parts.append(f"implies {details['implied_growth']}%/year since {int(self.previous_year[position])}")
+        return f"Anomaly score {details['score']}: " + ', '.join(parts)
+
+
+def get_policy():
+    return {**DEFAULT_POLICY, **getattr(settings, 'ANALYTICS_SCREENING_POLICY', {})}
+
+
+def screen(trends, city_ids, years, populations, policy=None):
+    """Scores (city_id, year, population_count) rows against the city trends and applies the policy."""
+    policy = policy or get_policy()
+    years = np.asarray(years, dtype=np.int64)
+    populations = np.asarray(populations, dtype=np.float64)
+    score = expected = growth = np.full(len(years), np.nan)
+    previous_year = np.full(len(years), -1, dtype=np.int64)
+
+    index = trends.city_index(city_ids)
+    screened = index >= 0
+    screened[screened] = trends.counts[index[screened]] >= MIN_HISTORY
+    if screened.any():
+        index = np.where(screened, index, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Distance from the trend line, in residual standard deviations
+            expected = trends.mean_population[index] + trends.slope[index] * (years - trends.mean_year[index])
+            trend_scale = np.maximum(trends.residual_std[index], np.maximum(TREND_FLOOR * np.abs(expected), 1))
+            trend_score = np.abs(populations - expected) / trend_scale
+
+            # Annualized growth since the nearest earlier year of the same city, in robust deviations
+            previous = np.maximum(np.searchsorted(trends.row_keys, _keys(index, years)) - 1, 0)
+            previous_population = trends.row_populations[previous]
+            has_previous = (trends.row_keys[previous] >> YEAR_BITS == index) & (trends.row_years[previous] < years) \
+                & (previous_population > 0) & ~np.isnan(trends.growth_median[index])
+            previous_year = np.where(has_previous, trends.row_years[previous], -1)
+            ratio = np.maximum(populations, 0) / previous_population
+            growth = (np.power(ratio, 1 / np.maximum(years - previous_year, 1)) - 1) * 100
+            growth_scale = np.maximum(np.nan_to_num(trends.growth_spread[index]), GROWTH_FLOOR)
+            growth_score = np.where(has_previous, np.abs(growth - trends.growth_median[index]) / growth_scale, np.nan)
+
+        score = np.where(screened, np.fmax(trend_score, growth_score), np.nan)
+        expected = np.where(screened, expected, np.nan)
+        growth = np.where(screened & has_previous, growth, np.nan)
+
+    actions = np.zeros(len(years), dtype=np.int8)
+    for action, name in ((FLAG, 'flag'), (QUARANTINE, 'quarantine'), (REJECT, 'reject')):
+        threshold = policy.get(name)
+        if threshold is not None:
+            actions[score >= threshold] = action
+    return Screening(score, expected, growth, previous_year, actions)
+
+
+def screen_rows(snapshot, rows, policy=None):
+    """Screens PopulationData instances (their unsaved values) as one batch."""
+    return screen(
+        snapshot.city_trends(),
+        [row.city_id for row in rows],
+        [int(row.year) for row in rows],
+        [int(row.population_count) for row in rows],
+        policy,
+    )
+
+
+def hold_for_review(rows, screening, positions, user):
+    """Stores the writes of rows[positions] (new rows or changes to existing ones) for review."""
+    return QuarantinedPopulation.objects.bulk_create([
+        QuarantinedPopulation(
+            city_id=rows[position].city_id,
+            population_id=rows[position].pk,
+            year=rows[position].year,
+            population_count=rows[position].population_count,
+            source=rows[position].source,
+            score=screening.details(position)['score'],
+            expected=screening.details(position)['expected'],
+            reason=screening.reason(position)[:255],
+            created_by=user,
+        )
+        for position in positions
+    ], batch_size=500)
+
+
+def release(entries, user):
+    """
+    Applies pending quarantined writes, as the bulk endpoints do: new rows with one
+    bulk_create, changes with one bulk_update, and the rollups in one pass. The rows keep
+    their anomaly score as a flag. Returns the written rows.
+    """
+    entries = list(entries)
+    targets = {
+        row.id: row
+        for row in PopulationData.objects.filter(
+            id__in=[entry.population_id for entry in entries if entry.population_id]
+        ).only('id', 'city_id', 'area_id', 'year', 'population_count', 'source', 'anomaly_score')
+    }
+    before = [(row.area_id, row.year, row.population_count) for row in targets.values()]
+    area_of = dict(City.objects.filter(id__in={entry.city_id for entry in entries}).values_list('id', 'area_id'))
+
+    created, updated = [], []
+    for entry in entries:
+        row = targets.get(entry.population_id) if entry.population_id else None
+        if row is None:
+            row = PopulationData(city_id=entry.city_id, area_id=area_of.get(entry.city_id), created_by_id=entry.created_by_id)
+            created.append(row)
+        else:
+            updated.append(row)
+        row.year = entry.year
+        row.population_count = entry.population_count
+        row.source = entry.source
+        row.anomaly_score = entry.score
+
+    PopulationData.objects.bulk_create(created, batch_size=500)
+    PopulationData.objects.bulk_update(updated, ['year', 'population_count', 'source', 'anomaly_score'], batch_size=500)
+    apply_changes(removed=before, added=[(row.area_id, row.year, row.population_count) for row in created + updated])
+    record_actuals(
+        [(row.city_id, year) for row, (_, year, _) in zip(targets.values(), before)]
+        + [(row.city_id, row.year) for row in created + updated]
+    )
+
+    QuarantinedPopulation.objects.filter(id__in=[entry.id for entry in entries]).update(
+        status='released', reviewed_by=user, reviewed_at=timezone.now(),
+    )
+    return created + updated
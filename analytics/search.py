@@ -0,0 +1,76 @@
+# analytics/search.py
+"""
+Prefix / token search over city names for autocomplete.
+
+Built once per dataset snapshot (so it follows city writes) as two sorted arrays of
+lowercased keys: full names, and every word of every name ("Cagayan de Oro" is also
+found by "oro"). A query is a bisect into each array, so lookups cost O(log n + k)
+and never fall back to LIKE '%q%' scans.
+"""
+import re
+from bisect import bisect_left
+
+TOKEN_SPLIT = re.compile(r'[\s\-/,.()]+')
+
+
+class CitySearchIndex:
+    def __init__(self, records):
+        names = sorted((record.name.lower(), record.index) for record in records)
+        tokens = sorted({
+            (token, record.index)
+            for record in records
+            for token in TOKEN_SPLIT.split(record.name.lower())[1:]
+            if token
+        })
+        self._all = list(records)
+        self._records = {record.index: record for record in records}
+        # Only known regions get a (lazily built) sub-index
+        self._regions = dict.fromkeys(record.region.lower() for record in records)
+        self._name_keys = [key for key, _ in names]
+        self._name_refs = [index for _, index in names]
+        self._token_keys = [key for key, _ in tokens]
+        self._token_refs = [index for _, index in tokens]
+
+    @staticmethod
+    def _prefix_range(keys, prefix):
+        start = bisect_left(keys, prefix)
+        end = bisect_left(keys, prefix + '\uffff', lo=start)
+        return start, end
+
+    def search(self, query, limit=10, region=None):
+        """
+        Returns up to `limit` city records: full-name prefix matches first (alphabetical),
+        then matches on a later word of the name.
+        """
+        query = query.strip().lower()
+        if not query:
+            return []
+        if region:
+            return self._region_index(region.lower()).search(query, limit)
+
+        results = []
+        seen = set()
+        for keys, refs in ((self._name_keys, self._name_refs), (self._token_keys, self._token_refs)):
+            start, end = self._prefix_range(keys, query)
+            for position in range(start, end):
+                index = refs[position]
+                if index in seen:
+                    continue
+                seen.add(index)
+                results.append(self._records[index])
+                if len(results) >= limit:
+                    return results
+        return results
+
+    def _region_index(self, region):
+        # Per-region sub-indexes keep filtered queries O(log n + k) instead of skipping non-matches
+        if region not in self._regions:
+            return EMPTY_INDEX
+        index = self._regions[region]
+        if index is None:
+            index = CitySearchIndex([record for record in self._all if record.region.lower() == region])
+            self._regions[region] = index
+        return index
+
+
+EMPTY_INDEX = CitySearchIndex([])
@@ -1,8 +1,20 @@
+import contextvars
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
 from django.contrib.auth import get_user_model
-from django.db.models.signals import post_migrate
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 
+from .areas import apply_changes, move_city_rows
+from .changes import record_change
+from .city_cache import bump_city_version
+from .events import broadcaster
+from .forecast_archive import record_actuals, schedule_forecast_archive
 from .models import City, PopulationData
+from .snapshot import bump_version
+from .snapshot_file import schedule_snapshot_write
 
 User = get_user_model()
 
@@ -33,26 +45,26 @@ def seed_initial_data(sender, **kwargs):
     # 2. CREATE DEFAULT CITIES (ONLY IF MISSING)
     # ------------------------------------------------------
     default_cities = [
-        {"city_name": "Manila", "region": "NCR"},
-        {"city_name": "Quezon City", "region": "NCR"},
-        {"city_name": "Caloocan", "region": "NCR"},
-        {"city_name": "Pasig", "region": "NCR"},
-        {"city_name": "Makati", "region": "NCR"},
-        {"city_name": "Taguig", "region": "NCR"},
-        {"city_name": "Marikina", "region": "NCR"},
-        {"city_name": "Cebu City", "region": "Region VII"},
-        {"city_name": "Mandaue", "region": "Region VII"},
-        {"city_name": "Lapu-Lapu", "region": "Region VII"},
-        {"city_name": "Davao City", "region": "Region XI"},
-        {"city_name": "General Santos", "region": "Region XII"},
-        {"city_name": "Zamboanga City", "region": "Region IX"},
-        {"city_name": "Iloilo City", "region": "Region VI"},
-        {"city_name": "Bacolod", "region": "Region VI"},
-        {"city_name": "Cagayan de Oro", "region": "Region X"},
-        {"city_name": "Baguio City", "region": "CAR"},
-        {"city_name": "Dagupan", "region": "Region I"},
-        {"city_name": "San Fernando", "region": "Region III"},
-        {"city_name": "Angeles City", "region": "Region III"},
+        {"city_name": "Manila", "region": "NCR", "latitude": 14.5995, "longitude": 120.9842},
+        {"city_name": "Quezon City", "region": "NCR", "latitude": 14.676, "longitude": 121.0437},
+        {"city_name": "Caloocan", "region": "NCR", "latitude": 14.6507, "longitude": 120.9676},
+        {"city_name": "Pasig", "region": "NCR", "latitude": 14.5764, "longitude": 121.0851},
+        {"city_name": "Makati", "region": "NCR", "latitude": 14.5547, "longitude": 121.0244},
+        {"city_name": "Taguig", "region": "NCR", "latitude": 14.5176, "longitude": 121.0509},
+        {"city_name": "Marikina", "region": "NCR", "latitude": 14.6507, "longitude": 121.1029},
+        {"city_name": "Cebu City", "region": "Region VII", "latitude": 10.3157, "longitude": 123.8854},
+        {"city_name": "Mandaue", "region": "Region VII", "latitude": 10.3236, "longitude": 123.9223},
+        {"city_name": "Lapu-Lapu", "region": "Region VII", "latitude": 10.3103, "longitude": 123.9494},
+        {"city_name": "Davao City", "region": "Region XI", "latitude": 7.1907, "longitude": 125.4553},
+        {"city_name": "General Santos", "region": "Region XII", "latitude": 6.1164, "longitude": 125.1716},
+        {"city_name": "Zamboanga City", "region": "Region IX", "latitude": 6.9214, "longitude": 122.079},
+        {"city_name": "Iloilo City", "region": "Region VI", "latitude": 10.7202, "longitude": 122.5621},
+        {"city_name": "Bacolod", "region": "Region VI", "latitude": 10.6765, "longitude": 122.9509},
+        {"city_name": "Cagayan de Oro", "region": "Region X", "latitude": 8.4542, "longitude": 124.6319},
+        {"city_name": "Baguio City", "region": "CAR", "latitude": 16.4023, "longitude": 120.596},
+        {"city_name": "Dagupan", "region": "Region I", "latitude": 16.0433, "longitude": 120.3334},
+        {"city_name": "San Fernando", "region": "Region III", "latitude": 15.0286, "longitude": 120.6898},
+        {"city_name": "Angeles City", "region": "Region III", "latitude": 15.145, "longitude": 120.5887},
     ]
 
     city_objects = {}
@@ -60,7 +72,7 @@ def seed_initial_data(sender, **kwargs):
     for data in default_cities:
         city, created = City.objects.get_or_create(
             city_name=data["city_name"],
-            defaults={"region": data["region"]},
+            defaults={"region": data["region"], "latitude": data["latitude"], "longitude": data["longitude"]},
         )
         city_objects[data["city_name"]] = city
 
@@ -68,6 +80,10 @@ def seed_initial_data(sender, **kwargs):
             print(f"✔ Created city: {city.city_name}")
         else:
             print(f"✔ City already exists: {city.city_name}")
+            # Cities seeded before locations existed
+            if city.latitude is None and city.longitude is None:
+                city.latitude, city.longitude = data["latitude"], data["longitude"]
+                city.save(update_fields=["latitude", "longitude"])
 
     # ------------------------------------------------------
     # 3. CREATE POPULATION DATA (ONLY IF MISSING)
@@ -121,3 +137,128 @@ def seed_initial_data(sender, **kwargs):
             pop = int(pop * 1.02)
 
     print("✔ All default population data created if missing.")
+
+
+# Set while bulk endpoints write, so they can log and invalidate once per request
+_bulk_write = contextvars.ContextVar('analytics_bulk_write', default=False)
+
+
+@contextmanager
+def bulk_write():
+    token = _bulk_write.set(True)
+    try:
+        yield
+    finally:
+        _bulk_write.reset(token)
+
+
+def dataset_changed():
+    # Read endpoints serve from the in-memory snapshot; force a rebuild on the next read. Only
+    # after commit: a reader seeing the new version before then would build from the old rows
+    # and cache them under it
+    transaction.on_commit(bump_version)
+
+    # Shared snapshot file: rewrite it so every worker remaps the new version
+    if settings.ANALYTICS_SNAPSHOT_FILE:
+        schedule_snapshot_write(settings.ANALYTICS_SNAPSHOT_FILE)
+
+    # Wake this process's SSE tailer once the change-log entries are committed
+    transaction.on_commit(broadcaster.notify)
+
+    # Archive the forecasts of cities whose history changed
+    if settings.ANALYTICS_FORECAST_ARCHIVE:
+        schedule_forecast_archive()
+
+
+@receiver(pre_save, sender=City)
+def remember_city_area(sender, instance, raw=False, **kwargs):
+    instance._area_before = None
+    if instance.pk is not None and not raw:
+        instance._area_before = City.objects.filter(pk=instance.pk).values_list('area_id', flat=True).first()
+
+
+@receiver(post_save, sender=City)
+def move_city_rollups(sender, instance, created, raw=False, **kwargs):
+    # Placing a city in (or moving it within) the area hierarchy carries its rows along
+    if not raw and not created and instance._area_before != instance.area_id:
+        move_city_rows(instance.id, instance._area_before, instance.area_id)
+
+
+# Rows of cities being deleted: they leave the rollups together in the City's pre_delete, so
+# the cascade's per-row post_delete skips them (and clears its id, whatever the delete order)
+_cascade_rows = contextvars.ContextVar('analytics_cascade_rows', default=frozenset())
+
+
+@receiver(pre_delete, sender=City)
+def remove_city_rollups(sender, instance, **kwargs):
+    rows = list(PopulationData.objects.filter(city_id=instance.id).values_list(
+        'id', 'area_id', 'year', 'population_count'
+    ))
+    apply_changes(removed=[(area_id, year, population) for _, area_id, year, population in rows])
+    _cascade_rows.set(_cascade_rows.get() | {row_id for row_id, *_ in rows})
+
+
+@receiver(post_save, sender=City)
+def log_city_saved(sender, instance, **kwargs):
+    record_change('city', instance.id, instance.id, 'upsert')
+    transaction.on_commit(bump_city_version)
+    dataset_changed()
+
+
+@receiver(post_delete, sender=City)
+def log_city_deleted(sender, instance, **kwargs):
+    record_change('city', instance.id, instance.id, 'delete')
+    transaction.on_commit(bump_city_version)
+    dataset_changed()
+
+
+@receiver(pre_save, sender=PopulationData)
+def remember_population_rollup(sender, instance, raw=False, **kwargs):
+    # Rows of a city count towards the city's area
+    if instance.city_id is not None and not raw:
+        instance.area_id = instance.city.area_id
+    instance._rollup_before = None
+    if instance.pk is not None and not raw and not _bulk_write.get():
+        instance._rollup_before = PopulationData.objects.filter(pk=instance.pk).values_list(
+            'area_id', 'year', 'population_count'
+        ).first()
+
+
+@receiver(post_save, sender=PopulationData)
+def update_population_rollups(sender, instance, raw=False, **kwargs):
+    if raw or _bulk_write.get():
+        return
+    apply_changes(
+        removed=[instance._rollup_before] if instance._rollup_before else [],
+        added=[(instance.area_id, int(instance.year), int(instance.population_count))],
+    )
+    years = {int(instance.year)} | ({instance._rollup_before[1]} if instance._rollup_before else set())
+    record_actuals((instance.city_id, year) for year in years)
+
+
+@receiver(post_delete, sender=PopulationData)
+def remove_population_rollups(sender, instance, **kwargs):
+    cascade_rows = _cascade_rows.get()
+    if instance.pk in cascade_rows:
+        _cascade_rows.set(cascade_rows - {instance.pk})
+        return
+    if _bulk_write.get():
+        return
+    apply_changes(removed=[(instance.area_id, instance.year, instance.population_count)])
+    record_actuals([(instance.city_id, instance.year)])
+
+
+@receiver(post_save, sender=PopulationData)
+def log_population_saved(sender, instance, **kwargs):
+    if _bulk_write.get():
+        return
+    record_change('population', instance.id, instance.city_id, 'upsert')
+    dataset_changed()
+
+
+@receiver(post_delete, sender=PopulationData)
+def log_population_deleted(sender, instance, **kwargs):
+    if _bulk_write.get():
+        return
+    record_change('population', instance.id, instance.city_id, 'delete')
+    dataset_changed()
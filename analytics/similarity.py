@@ -0,0 +1,384 @@
+# analytics/similarity.py
+"""
+Cities with similar growth trajectories, for /api/cities/<id>/similar/ and /api/cities/clusters/.
+
+Every city's series is normalized to its yearly log growth (100 * ln(p[t] / p[t-1])) over
+the WINDOW_YEARS years ending at the dataset's latest year, read from the log gap-filled
+series so a hole in the history does not show up as one year of large growth. Growth
+rates compare cities of any size; years a city has no growth for are masked out.
+
+The distance between two cities is the root mean square difference of their growth over
+the years both have (at least MIN_OVERLAP of them). With missing values zeroed and M the
+mask, the squared sums for a block of query cities against every city come from three
+matrix products, (X*X) M' + M (X*X)' - 2 X X', and the overlap counts from M M', so the
+full N x N matrix is never held: queries go CHUNK_ROWS at a time.
+
+Cities are also grouped by k-means (scipy's kmeans2, missing years taking the city's mean
+growth). Up to EXACT_LIMIT cities every query is compared with every city; above it the
+search is approximate, inverted-file style: the queries of a cluster are compared only
+with the members of the PROBE_CLUSTERS clusters whose centroids are nearest to theirs.
+
+The STORED_NEIGHBOURS nearest cities of every city and the clusters are computed once per
+dataset version and kept on the snapshot and in an .npz file under
+ANALYTICS_SIMILARITY_CACHE_DIR, so other workers and restarts load them instead.
+A new version's index is computed on a background thread: until it is ready, requests
+get the previous version's index carried over to the new cities, where cities it does
+not know have no neighbours or cluster yet. Only a process that has no index at all
+(a new worker, or warm_similarity) computes one in the foreground.
+"""
+import logging
+import os
+import tempfile
+import threading
+
+import numpy as np
+from django.conf import settings
+from scipy.cluster.vq import kmeans2
+
+logger = logging.getLogger(__name__)
+
+WINDOW_YEARS = 20
+MIN_OVERLAP = 2
+STORED_NEIGHBOURS = 50
+EXACT_LIMIT = 5000
+PROBE_CLUSTERS = 8
+CHUNK_ROWS = 1024
+MAX_CLUSTERS = 256
+# k-means++ seeding is quadratic in k, so it runs on at most this many cities per cluster
+SEEDING_SAMPLE = 20
+SEED = 0
+
+# Bumped whenever the stored arrays or the way they are computed change
+CACHE_FORMAT = 1
+# Cache files of older dataset versions kept next to the current one
+KEEP_CACHE_FILES = 4
+
+
+def growth_profiles(snapshot):
+    """
+    (start_year, growth, mask): each city's yearly log growth in percent over the
+    WINDOW_YEARS years ending at the latest year of the dataset, 0 where mask is False.
+    """
+    filled = snapshot.filled('log')
+    size = len(snapshot.cities)
+    growth = np.zeros((size, WINDOW_YEARS))
+    mask = np.zeros((size, WINDOW_YEARS), dtype=bool)
+    years = filled.years
+    if len(years) < 2:
+        return 0, growth, mask
+
+    start_year = int(years.max()) - WINDOW_YEARS + 1
+    previous = filled.populations[:-1]
+    current = filled.populations[1:]
+    # Growth into row r + 1 from row r: same city, the next year, both counts positive
+    valid = (
+        (filled.city_index[1:] == filled.city_index[:-1]) & (years[1:] - years[:-1] == 1)
+        & (previous > 0) & (current > 0) & (years[1:] >= start_year)
+    )
+    rows = np.flatnonzero(valid)
+    cities = filled.city_index[rows + 1]
+    columns = years[rows + 1] - start_year
+    growth[cities, columns] = 100 * np.log(current[rows] / previous[rows])
+    mask[cities, columns] = True
+    return start_year, growth, mask
+
+
+def masked_distances(growth, mask, other_growth, other_mask):
+    """
+    RMS growth difference over shared years between every row of (growth, mask) and every
+    row of (other_growth, other_mask), and the shared year counts; inf below MIN_OVERLAP.
+    """
+    weights = mask.astype(np.float64)
+    other_weights = other_mask.astype(np.float64)
+    squared = (
+        (growth * growth) @ other_weights.T + weights @ (other_growth * other_growth).T
+        - 2 * growth @ other_growth.T
+    )
+    overlap = weights @ other_weights.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distances = np.sqrt(np.maximum(squared, 0) / overlap)
+    distances[overlap < MIN_OVERLAP] = np.inf
+    return distances, overlap.astype(np.int32)
+
+
+def cluster_count(size):
+    """ANALYTICS_SIMILARITY_CLUSTERS, or sqrt(size / 2) when it is 0, within [1, size]."""
+    configured = getattr(settings, 'ANALYTICS_SIMILARITY_CLUSTERS', 0)
+    count = configured or min(int(np.sqrt(size / 2)), MAX_CLUSTERS)
+    return max(1, min(count, size))
+
+
+class SimilarityIndex:
+    """Stored neighbours and clusters of every city, indexed like snapshot.cities."""
+
+    ARRAYS = ('city_ids', 'neighbours', 'distances', 'overlaps', 'labels', 'centroids', 'sizes')
+
+    def __init__(self, start_year, city_ids, neighbours, distances, overlaps, labels, centroids, sizes, stale=False):
+        self.start_year = start_year
+        # True for an older version's index carried over while the current one is computed
+        self.stale = stale
+        self.city_ids = city_ids
+        # Snapshot indexes of each city's nearest cities, nearest first; -1 pads
+        self.neighbours = neighbours
+        self.distances = distances
+        self.overlaps = overlaps
+        # Cluster of each city, -1 for cities without growth data
+        self.labels = labels
+        self.centroids = centroids
+        self.sizes = sizes
+
+    @classmethod
+    def compute(cls, snapshot):
+        start_year, growth, mask = growth_profiles(snapshot)
+        size = len(snapshot.cities)
+        city_ids = np.array([record.id for record in snapshot.cities], dtype=np.int64)
+        stored = min(STORED_NEIGHBOURS, max(size - 1, 0))
+        neighbours = np.full((size, stored), -1, dtype=np.int64)
+        distances = np.full((size, stored), np.inf)
+        overlaps = np.zeros((size, stored), dtype=np.int32)
+        labels = np.full(size, -1, dtype=np.int32)
+
+        members = np.flatnonzero(mask.sum(axis=1) >= MIN_OVERLAP)
+        if not len(members):
+            return cls(start_year, city_ids, neighbours, distances, overlaps, labels,
+                       np.zeros((0, WINDOW_YEARS)), np.zeros(0, dtype=np.int64))
+
+        # k-means on complete profiles: missing years take the city's mean growth
+        counts = mask[members].sum(axis=1)
+        means = growth[members].sum(axis=1) / counts
+        profiles = np.where(mask[members], growth[members], means[:, None])
+        count = cluster_count(len(members))
+        rng = np.random.default_rng(SEED)
+        sample = profiles[rng.permutation(len(members))[:count * SEEDING_SAMPLE]]
+        initial, _ = kmeans2(sample, count, minit='++', seed=rng)
+        centroids, member_labels = kmeans2(profiles, initial, minit='matrix')
+        labels[members] = member_labels
+        sizes = np.bincount(member_labels, minlength=len(centroids))
+
+        if len(members) <= EXACT_LIMIT:
+            groups = [(members, members)]
+        else:
+            # Each cluster's queries against the members of its nearest clusters (itself first)
+            between = ((centroids[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=2)
+            probes = np.argsort(between, axis=1)[:, :PROBE_CLUSTERS]
+            order = np.argsort(member_labels, kind='stable')
+            bounds = np.searchsorted(member_labels[order], np.arange(len(centroids) + 1))
+            cluster_members = [members[order[bounds[c]:bounds[c + 1]]] for c in range(len(centroids))]
+            groups = [
+                (cluster_members[c], np.concatenate([cluster_members[p] for p in probes[c]]))
+                for c in range(len(centroids)) if len(cluster_members[c])
+            ]
+
+        # With a single city there is nothing to compare
+        for queries, candidates in (groups if stored else ()):
+            candidate_growth, candidate_mask = growth[candidates], mask[candidates]
+            for start in range(0, len(queries), CHUNK_ROWS):
+                chunk = queries[start:start + CHUNK_ROWS]
+                block, shared = masked_distances(growth[chunk], mask[chunk], candidate_growth, candidate_mask)
+                # A city is not its own neighbour
+                block[candidates[None, :] == chunk[:, None]] = np.inf
+                keep = min(stored, len(candidates))
+                nearest = np.argpartition(block, keep - 1, axis=1)[:, :keep] if keep < len(candidates) \
+                    else np.broadcast_to(np.arange(len(candidates)), (len(chunk), len(candidates)))
+                nearest_distances = np.take_along_axis(block, nearest, axis=1)
+                # Nearest first, ties to the lower city id
+                ranked = np.lexsort((city_ids[candidates[nearest]], nearest_distances), axis=1)
+                nearest = np.take_along_axis(nearest, ranked, axis=1)
+                nearest_distances = np.take_along_axis(nearest_distances, ranked, axis=1)
+                found = np.isfinite(nearest_distances)
+                neighbours[chunk, :keep] = np.where(found, candidates[nearest], -1)
+                distances[chunk, :keep] = nearest_distances
+                overlaps[chunk, :keep] = np.where(found, np.take_along_axis(shared, nearest, axis=1), 0)
+
+        return cls(start_year, city_ids, neighbours, distances, overlaps, labels, centroids, sizes)
+
+    def carried_over(self, snapshot):
+        """
+        This index over another snapshot's cities, matched by id: cities it does not know
+        get no neighbours or cluster, and neighbours that are gone are dropped.
+        """
+        ids = np.array([record.id for record in snapshot.cities], dtype=np.int64)
+        order = np.argsort(self.city_ids)
+        positions = np.minimum(np.searchsorted(self.city_ids[order], ids), max(len(order) - 1, 0))
+        known = self.city_ids[order][positions] == ids if len(order) else np.zeros(len(ids), dtype=bool)
+        previous = order[positions][known]
+        # New index of every old one; the extra last slot maps the -1 padding to itself
+        renumbered = np.full(len(self.city_ids) + 1, -1, dtype=np.int64)
+        renumbered[previous] = np.flatnonzero(known)
+
+        stored = self.neighbours.shape[1]
+        neighbours = np.full((len(ids), stored), -1, dtype=np.int64)
+        distances = np.full((len(ids), stored), np.inf)
+        overlaps = np.zeros((len(ids), stored), dtype=np.int32)
+        neighbours[known] = renumbered[self.neighbours[previous]]
+        distances[known] = self.distances[previous]
+        overlaps[known] = self.overlaps[previous]
+        # Dropped neighbours move behind the remaining ones, which keep their order
+        kept = np.argsort(neighbours < 0, axis=1, kind='stable')
+        neighbours = np.take_along_axis(neighbours, kept, axis=1)
+        distances = np.take_along_axis(distances, kept, axis=1)
+        overlaps = np.take_along_axis(overlaps, kept, axis=1)
+
+        labels = np.full(len(ids), -1, dtype=np.int32)
+        labels[known] = self.labels[previous]
+        sizes = np.bincount(labels[labels >= 0], minlength=len(self.centroids))
+        return SimilarityIndex(
+            self.start_year, ids, neighbours, distances, overlaps, labels, self.centroids, sizes, stale=True,
+        )
+
+    def similar(self, index, limit):
+        """[(snapshot index, distance, shared years)] of the city's nearest cities, nearest first."""
+        found = self.neighbours[index, :limit] >= 0
+        return list(zip(
+            self.neighbours[index, :limit][found].tolist(),
+            self.distances[index, :limit][found].tolist(),
+            self.overlaps[index, :limit][found].tolist(),
+        ))
+
+    def members(self, cluster):
+        """Snapshot indexes of a cluster's cities."""
+        return np.flatnonzero(self.labels == cluster)
+
+    def save(self, path):
+        """Writes the index to path atomically, through a temporary file in the same directory."""
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as stream:
+                np.savez(stream, format=CACHE_FORMAT, start_year=self.start_year,
+                         **{name: getattr(self, name) for name in self.ARRAYS})
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    @classmethod
+    def load(cls, path, snapshot):
+        """The index stored at path, or None if it is missing, unreadable or for other cities."""
+        try:
+            with np.load(path) as stored:
+                if int(stored['format']) != CACHE_FORMAT:
+                    return None
+                index = cls(int(stored['start_year']), *(stored[name] for name in cls.ARRAYS))
+        except (OSError, ValueError, KeyError):
+            return None
+        ids = np.array([record.id for record in snapshot.cities], dtype=np.int64)
+        return index if np.array_equal(index.city_ids, ids) else None
+
+
+def cache_path(version):
+    directory = getattr(settings, 'ANALYTICS_SIMILARITY_CACHE_DIR', None) \
+        or os.path.join(tempfile.gettempdir(), 'population_site_similarity')
+    clusters = getattr(settings, 'ANALYTICS_SIMILARITY_CLUSTERS', 0)
+    return os.path.join(directory, f'similarity-{version}-{clusters}.npz')
+
+
+def _prune(path):
+    """Removes all but the newest KEEP_CACHE_FILES cache files other than path."""
+    directory = os.path.dirname(path)
+    try:
+        names = [name for name in os.listdir(directory)
+                 if name.startswith('similarity-') and name.endswith('.npz')]
+        others = sorted(
+            (os.path.join(directory, name) for name in names if os.path.join(directory, name) != path),
+            key=os.path.getmtime, reverse=True,
+        )
+        for stale in others[KEEP_CACHE_FILES:]:
+            os.unlink(stale)
+    except OSError:
+        # Another process pruned (or wrote) at the same time; the next write tries again
+        pass
+
+
+# (dataset version, index) of the newest index this process has, and of its carried-over copy
+_latest = None
+_carried = None
+
+
+def build_similarity_index(snapshot):
+    """Computes the snapshot's index, stores it in the disk cache and serves it from then on."""
+    global _latest
+    index = SimilarityIndex.compute(snapshot)
+    path = cache_path(snapshot.version)
+    try:
+        index.save(path)
+    except OSError:
+        logger.exception('Could not store the similarity index in %s', path)
+    else:
+        _prune(path)
+    _latest = (snapshot.version, index)
+    return index
+
+
+def similarity_index(snapshot):
+    """
+    The snapshot's SimilarityIndex: the one this process has for its dataset version,
+    or loaded from the disk cache of that version. Otherwise it is computed in the
+    background and the previous version's index, carried over, is returned meanwhile
+    (stale=True). Snapshots without a version are never stored.
+    """
+    global _latest, _carried
+    if snapshot.version is None:
+        return SimilarityIndex.compute(snapshot)
+    latest = _latest
+    if latest is not None and latest[0] == snapshot.version:
+        return latest[1]
+    # Stored by another worker, or before a restart
+    index = SimilarityIndex.load(cache_path(snapshot.version), snapshot)
+    if index is not None:
+        _latest = (snapshot.version, index)
+        return index
+
+    if latest is None:
+        # Nothing to serve meanwhile: compute it here, once per process
+        with _build_lock:
+            latest = _latest
+            if latest is not None and latest[0] == snapshot.version:
+                return latest[1]
+            return build_similarity_index(snapshot)
+
+    _start_builder(snapshot)
+    carried = _carried
+    if carried is None or carried[0] != snapshot.version:
+        carried = _carried = (snapshot.version, latest[1].carried_over(snapshot))
+    return carried[1]
+
+
+# ------------------ Background builder ------------------
+
+_build_lock = threading.Lock()
+_builder_lock = threading.Lock()
+_builder_thread = None
+_builder_pending = None
+
+
+def _start_builder(snapshot):
+    global _builder_thread, _builder_pending
+    with _builder_lock:
+        # Snapshots asked for while a build is running are coalesced into one more pass, of the newest
+        _builder_pending = snapshot
+        if _builder_thread is not None:
+            return
+        _builder_thread = threading.Thread(target=_run_builder, daemon=True)
+        _builder_thread.start()
+
+
+def _run_builder():
+    global _builder_thread, _builder_pending
+    try:
+        while True:
+            with _builder_lock:
+                snapshot = _builder_pending
+                if snapshot is None:
+                    _builder_thread = None
+                    return
+                _builder_pending = None
+            with _build_lock:
+                latest = _latest
+                if latest is None or latest[0] != snapshot.version:
+                    build_similarity_index(snapshot)
+    except Exception:
+        with _builder_lock:
+            _builder_thread = None
+        raise
@@ -0,0 +1,175 @@
+# analytics/simulation.py
+"""
+Monte Carlo population scenarios for /api/simulate/.
+
+Each path draws every future year's growth rate at random from the city's own
+historical yearly growth, plus an optional per-region shock in percentage points, and
+compounds them from the latest observed population. The rates are read from the log
+gap-filled series (snapshot.filled('log')), so a gap of k years between two rows counts
+as k years of its annualized rate, (p1 / p0) ** (1 / k) - 1, not as one year of the
+whole change. Draws, compounding and percentiles are NumPy operations over a
+(cities x years x paths) float32 array, processed in chunks of cities sized to stay
+within ANALYTICS_SIMULATION_MEMORY_MB, next to the (regions x years x paths) float32
+region totals. A run whose totals (and their sorted copy, for the region bands) leave no
+room for a single city is rejected instead of going over the budget.
+"""
+import numpy as np
+from django.conf import settings
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# 4-byte (cities x years x paths) arrays alive at once while a chunk is simulated, with headroom
+# for the temporaries of the region sums and the percentile sort
+ARRAYS_PER_CHUNK = 4
+
+
+def _budget():
+    return getattr(settings, 'ANALYTICS_SIMULATION_MEMORY_MB', 256) * 1024 * 1024
+
+
+def _chunk_size(paths, horizon, reserved):
+    """Cities per chunk within the budget left after `reserved` bytes; 0 if not even one fits."""
+    return max(0, (_budget() - reserved) // (paths * horizon * 4 * ARRAYS_PER_CHUNK))
+
+
+def _percentiles(values):
+    """
+    Percentiles (linear interpolation, as np.percentile) over the last axis of a
+    (series x years x paths) array -> (percentiles x series x years). A full sort along
+    contiguous paths is several times faster than np.percentile's partitioning here.
+    """
+    values = np.sort(values, axis=-1)
+    positions = np.array(PERCENTILES) / 100 * (values.shape[-1] - 1)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+    low = values[..., lower].astype(np.float64)
+    result = low + (values[..., upper] - low) * (positions - lower)
+    return np.moveaxis(result, -1, 0).round().astype(np.int64)
+
+
+def _bands(percentiles, series):
+    return {f'p{q}': percentiles[position, series].tolist() for position, q in enumerate(PERCENTILES)}
+
+
+class Simulation:
+    """
+    One simulation run. cities() simulates chunk by chunk and yields every city's entry as
+    soon as its chunk is done, adding the chunk to the region totals; tail() (the region
+    bands) is complete once cities() is exhausted. The streamed /api/simulate/ response
+    writes head(), the cities and tail() in the order result() has them.
+    """
+
+    def __init__(self, snapshot, horizon, paths, shocks=None, seed=None):
+        self.horizon = horizon
+        self.paths = paths
+        self.shocks = shocks or {}
+        self.rng = np.random.default_rng(seed)
+
+        records = [record for record in snapshot.cities if snapshot.latest_population(record) is not None]
+        indexes = np.array([record.index for record in records], dtype=np.int64)
+        self.records = records
+        self.latest = np.array([snapshot.latest_population(record) for record in records], dtype=np.float64)
+        self.last_years = snapshot.years[snapshot.offsets[indexes + 1] - 1] if len(records) \
+            else np.array([], dtype=np.int64)
+
+        # Yearly growth rates grouped by city; cities without any draw from a single 0% rate
+        filled = snapshot.filled('log')
+        valid = ~np.isnan(filled.growth)
+        # Two rows of the same year are no year of growth
+        valid[1:] &= filled.years[1:] - filled.years[:-1] == 1
+        self.rates = np.append(filled.growth[valid], 0.0).astype(np.float32)
+        counts = np.bincount(filled.city_index[valid], minlength=len(snapshot.cities))
+        starts = np.zeros(len(snapshot.cities), dtype=np.int64)
+        np.cumsum(counts[:-1], out=starts[1:])
+        self.starts = np.where(counts > 0, starts, len(self.rates) - 1)[indexes].astype(np.int32)
+        counts = np.maximum(counts, 1)[indexes]
+        self.last_rates = (self.starts + counts - 1).astype(np.int32)
+        self.counts = counts.astype(np.float32)
+
+        self.regions = sorted({record.region for record in records})
+        self.region_of = np.array([self.regions.index(record.region) for record in records], dtype=np.int64)
+        self.shock = np.array([float(self.shocks.get(record.region, 0)) for record in records], dtype=np.float32)
+
+        # The region totals are held while the cities are simulated, and sorted (a second
+        # copy) for the region bands once they are done
+        totals_bytes = len(self.regions) * horizon * paths * 4
+        self.chunk_size = _chunk_size(paths, horizon, totals_bytes)
+        if not self.chunk_size or 2 * totals_bytes > _budget():
+            raise ValueError(
+                f'{horizon} years x {paths} paths x {len(self.regions)} regions does not fit in '
+                f'ANALYTICS_SIMULATION_MEMORY_MB; lower horizon or paths.'
+            )
+        self.totals = np.zeros((len(self.regions), horizon, paths), dtype=np.float32)
+
+    def head(self):
+        return {'horizon': self.horizon, 'paths': self.paths, 'percentiles': list(PERCENTILES)}
+
+    def cities(self):
+        horizon, paths, records = self.horizon, self.paths, self.records
+        counts, starts, last_rates, latest = self.counts, self.starts, self.last_rates, self.latest
+        region_of = self.region_of
+        size = self.chunk_size
+        for start in range(0, len(records), size):
+            chunk = slice(start, start + size)
+            draws = self.rng.random((len(records[chunk]), horizon, paths), dtype=np.float32)
+            draws *= counts[chunk, None, None]
+            picks = draws.astype(np.int32)
+            picks += starts[chunk, None, None]
+            # float32 rounding can turn a draw just below 1 into exactly `count`
+            np.minimum(picks, last_rates[chunk, None, None], out=picks)
+            factors = self.rates[picks]
+            del draws, picks
+
+            # Compound (1 + growth) along the years axis; a population cannot go below zero
+            factors += self.shock[chunk, None, None]
+            factors /= 100
+            factors += 1
+            np.maximum(factors, 0, out=factors)
+            np.cumprod(factors, axis=1, out=factors)
+            factors *= latest[chunk, None, None].astype(np.float32)
+
+            for region in np.unique(region_of[chunk]):
+                self.totals[region] += factors[region_of[chunk] == region].sum(axis=0)
+
+            percentiles = _percentiles(factors)
+            del factors
+            for offset, record in enumerate(records[chunk]):
+                last_year = int(self.last_years[start + offset])
+                yield {
+                    'id': record.id,
+                    'name': record.name,
+                    'region': record.region,
+                    'latest_year': last_year,
+                    'latest_population': int(latest[start + offset]),
+                    'years': list(range(last_year + 1, last_year + horizon + 1)),
+                    'bands': _bands(percentiles, offset),
+                }
+
+    def tail(self):
+        percentiles = _percentiles(self.totals)
+        return {
+            # Region totals add up cities step by step from each one's latest observed year
+            'years_ahead': list(range(1, self.horizon + 1)),
+            'regions': [
+                {
+                    'region': region,
+                    'shock': float(self.shocks.get(region, 0)),
+                    'city_count': int((self.region_of == index).sum()),
+                    'bands': _bands(percentiles, index),
+                }
+                for index, region in enumerate(self.regions)
+            ],
+        }
+
+    def result(self):
+        return {**self.head(), 'cities': list(self.cities()), **self.tail()}
+
+
+def simulate(snapshot, horizon, paths, shocks=None, seed=None):
+    """
+    Returns percentile bands of simulated population for the next `horizon` years of every
+    city with data, and of their per-region totals. shocks maps region -> growth shock in
+    percentage points, applied to every simulated year. Raises ValueError for a run that
+    does not fit in ANALYTICS_SIMULATION_MEMORY_MB.
+    """
+    return Simulation(snapshot, horizon, paths, shocks, seed).result()
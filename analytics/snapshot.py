@@ -0,0 +1,442 @@
+# analytics/snapshot.py
+"""
+Compact in-process snapshot of the whole population dataset.
+
+Rows are held in parallel NumPy arrays sorted by (city, year, id), with CSR-style
+offsets so that city i owns rows offsets[i]:offsets[i + 1]. Read endpoints use it
+instead of building PopulationData instances just to read year and population_count.
+
+The snapshot is rebuilt when the dataset version in the cache changes (bumped by the
+signals in signals.py once every City / PopulationData write commits), or when it is older than
+ANALYTICS_SNAPSHOT_MAX_AGE seconds, which bounds staleness across worker processes
+when the cache backend is not shared.
+
+Sub-annual observations (PopulationObservation) are held the same way in a second set
+of arrays (observation_*), placed on a month axis; forecasts are fitted on the yearly
+rows plus year-end figures resampled from them (see resampling.py).
+
+When ANALYTICS_SNAPSHOT_FILE is set, workers instead memory-map a shared snapshot file
+written by snapshot_file.py, so the arrays are not copied into every worker.
+"""
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from .changes import replica_is_current
+from .forecasting import predict_next_year, predict_next_year_many
+from .gapfill import fill_gaps, yearly_rows
+from .geo import CityLocationIndex
+from .rankings import CityRankings
+from .screening import CityTrends
+from .models import City, PopulationObservation
+from .resampling import GRANULARITY_PERIODS, annual_series, lttb, merge, resample, to_months
+from .routers import use_primary
+from .search import CitySearchIndex
+from .similarity import similarity_index
+
+VERSION_CACHE_KEY = 'analytics:dataset_version'
+
+
+def bump_version():
+    """Marks the snapshot in every process as stale."""
+    cache.set(VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def current_version():
+    """The dataset version, starting a new one if the cache has none (after a restart or a cull)."""
+    version = cache.get(VERSION_CACHE_KEY)
+    if version is None:
+        # add, so workers starting together agree on one version
+        cache.add(VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(VERSION_CACHE_KEY)
+    return version
+
+
+class CityRecord:
+    __slots__ = ('index', 'id', 'name', 'region')
+
+    def __init__(self, index, city_id, name, region):
+        self.index = index
+        self.id = city_id
+        self.name = name
+        self.region = region
+
+
+class DatasetSnapshot:
+    def __init__(self, version, cities, row_ids, city_index, years, populations, source_ids, sources,
+                 offsets=None, growth=None, forecasts=None, latitudes=None, longitudes=None, observations=None,
+                 imputed=None):
+        self.version = version
+        self.built_at = time.monotonic()
+        # Wall-clock time a mapped snapshot's file was written (None for in-process builds)
+        self.written_at = None
+        self.cities = cities
+        self.by_id = {record.id: record for record in cities}
+
+        self.row_ids = row_ids
+        self.city_index = city_index
+        self.years = years
+        self.populations = populations
+        self.source_ids = source_ids
+        self.sources = sources
+
+        # CSR offsets: rows of city i are offsets[i]:offsets[i + 1]
+        if offsets is None:
+            counts = np.bincount(city_index, minlength=len(cities))
+            offsets = np.zeros(len(cities) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+        self.offsets = offsets
+
+        # Year-over-year growth, NaN where there is no previous row or it is not > 0
+        if growth is None:
+            growth = np.full(len(years), np.nan)
+            if len(years) > 1:
+                previous = populations[:-1]
+                valid = (city_index[1:] == city_index[:-1]) & (previous > 0)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    ratio = (populations[1:] - previous) / previous * 100
+                growth[1:] = np.where(valid, ratio, np.nan)
+        self.growth = growth
+
+        # Per-city coordinates, NaN where a city has no location
+        self.latitudes = latitudes if latitudes is not None else np.full(len(cities), np.nan)
+        self.longitudes = longitudes if longitudes is not None else np.full(len(cities), np.nan)
+
+        # Sub-annual observations as (offsets, months, populations, source_ids), CSR like the rows
+        if observations is None:
+            observations = (
+                np.zeros(len(cities) + 1, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32),
+            )
+        (self.observation_offsets, self.observation_months,
+         self.observation_populations, self.observation_source_ids) = observations
+
+        # Set on gap-filled snapshots (see filled()): which rows were interpolated
+        self.imputed = imputed
+
+        # Optional precomputed (base_year, predicted_years, predicted_populations); -1 means no prediction
+        self._precomputed = forecasts
+        # (base_year, predicted_years, predicted_populations) fitted for every city, see forecast_arrays()
+        self._fitted = None
+        self._forecasts = {}
+        self._forecast_year = None
+        self._search_index = None
+        self._location_index = None
+        self._trends = None
+        self._rankings = None
+        self._similarity = None
+        self._filled = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, version=None):
+        """
+        Builds a snapshot from one values_list query (cities LEFT JOIN population rows), plus
+        one for the sub-annual observations.
+        Reads the replica once it has caught up with the primary's change log, and the primary
+        while it lags: builds follow writes, and a snapshot built from a lagging replica would
+        be shared with (and hide the change from) the writer.
+        """
+        with use_primary(not replica_is_current()):
+            rows = list(City.objects.order_by('id', 'populationdata__year', 'populationdata__id').values_list(
+                'id', 'city_name', 'region', 'latitude', 'longitude',
+                'populationdata__id', 'populationdata__year',
+                'populationdata__population_count', 'populationdata__source',
+            ))
+            observation_rows = list(PopulationObservation.objects.values_list(
+                'city_id', 'year', 'granularity', 'period', 'population_count', 'source',
+            ))
+
+        cities = []
+        source_lookup = {}
+        latitudes, longitudes = [], []
+        row_ids, city_index, years, populations, source_ids = [], [], [], [], []
+        for city_id, name, region, latitude, longitude, row_id, year, population, source in rows:
+            if not cities or cities[-1].id != city_id:
+                cities.append(CityRecord(len(cities), city_id, name, region))
+                latitudes.append(latitude)
+                longitudes.append(longitude)
+            if row_id is None:
+                continue
+            row_ids.append(row_id)
+            city_index.append(cities[-1].index)
+            years.append(year)
+            populations.append(population)
+            source_ids.append(source_lookup.setdefault(source, len(source_lookup)))
+
+        index_of = {record.id: record.index for record in cities}
+        observation_index = np.array([index_of[row[0]] for row in observation_rows], dtype=np.int64)
+        months = to_months(
+            [row[1] for row in observation_rows],
+            [row[3] for row in observation_rows],
+            [GRANULARITY_PERIODS[row[2]] for row in observation_rows],
+        )
+        order = np.lexsort((months, observation_index))
+        observation_offsets = np.zeros(len(cities) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(observation_index, minlength=len(cities)), out=observation_offsets[1:])
+        observations = (
+            observation_offsets,
+            months[order],
+            np.array([row[4] for row in observation_rows], dtype=np.int64)[order],
+            np.array(
+                [source_lookup.setdefault(row[5], len(source_lookup)) for row in observation_rows], dtype=np.int32
+            )[order],
+        )
+
+        return cls(
+            version,
+            cities,
+            np.array(row_ids, dtype=np.int64),
+            np.array(city_index, dtype=np.int32),
+            np.array(years, dtype=np.int64),
+            np.array(populations, dtype=np.int64),
+            np.array(source_ids, dtype=np.int32),
+            list(source_lookup),
+            latitudes=np.array(latitudes, dtype=np.float64),
+            longitudes=np.array(longitudes, dtype=np.float64),
+            observations=observations,
+        )
+
+    def is_fresh(self, version):
+        max_age = getattr(settings, 'ANALYTICS_SNAPSHOT_MAX_AGE', 60)
+        return self.version == version and time.monotonic() - self.built_at < max_age
+
+    def get_city(self, city_id):
+        return self.by_id.get(city_id)
+
+    def rows(self, record):
+        return slice(self.offsets[record.index], self.offsets[record.index + 1])
+
+    def series(self, record):
+        """Returns the (years, populations) arrays of a city, ordered by year."""
+        rows = self.rows(record)
+        return self.years[rows], self.populations[rows]
+
+    def observation_rows(self, record):
+        return slice(self.observation_offsets[record.index], self.observation_offsets[record.index + 1])
+
+    def annual_series(self, record):
+        """The yearly (years, populations) a forecast is fitted on: the rows, plus year-end observations."""
+        observations = self.observation_rows(record)
+        return annual_series(
+            *self.series(record),
+            self.observation_months[observations], self.observation_populations[observations],
+        )
+
+    def resampled(self, record, frequency):
+        """
+        The city's rows and observations resampled to 'annual', 'quarterly' or 'monthly'.
+        Returns (buckets, populations, source_ids, is_row), see resampling.resample.
+        """
+        rows, observations = self.rows(record), self.observation_rows(record)
+        months, is_row, order = merge(self.years[rows], self.observation_months[observations])
+        populations = np.concatenate([self.populations[rows], self.observation_populations[observations]])[order]
+        source_ids = np.concatenate([self.source_ids[rows], self.observation_source_ids[observations]])[order]
+        buckets, populations, positions = resample(months, populations, frequency)
+        return buckets, populations, source_ids[positions], is_row[positions]
+
+    def latest_population(self, record):
+        rows = self.rows(record)
+        return int(self.populations[rows][-1]) if rows.stop > rows.start else None
+
+    def average_growth(self, record):
+        growth = self.growth[self.rows(record)]
+        growth = growth[~np.isnan(growth)]
+        return float(growth.mean()) if len(growth) else 0
+
+    def history_rows(self, record, max_points=None):
+        """Row positions of the city's history, LTTB-downsampled to max_points if given."""
+        rows = self.rows(record)
+        if max_points is None or rows.stop - rows.start <= max_points:
+            return rows
+        return rows.start + lttb(self.years[rows], self.populations[rows], max_points)
+
+    def history(self, record, max_points=None):
+        """Returns the city's history in the API shape, growth rounded to 2 decimals by round()."""
+        rows = self.history_rows(record, max_points)
+        sources = self.sources
+        history = [
+            {
+                'Historyid': row_id,
+                'year': year,
+                'population': population,
+                'source': sources[source_id],
+                'growth': None if growth != growth else round(growth, 2)
+            }
+            for row_id, year, population, source_id, growth in zip(
+                self.row_ids[rows].tolist(), self.years[rows].tolist(), self.populations[rows].tolist(),
+                self.source_ids[rows].tolist(), self.growth[rows].tolist(),
+            )
+        ]
+        if self.imputed is not None:
+            for entry, imputed in zip(history, self.imputed[rows].tolist()):
+                entry['imputed'] = imputed
+                if entry['Historyid'] < 0:
+                    entry['Historyid'] = None
+        return history
+
+    def forecast(self, record):
+        """
+        Returns (predicted_year, predicted_population) of one city, from the all-city arrays
+        when they are already there for the current year, or else fitted for this city alone
+        and memoized for the current year.
+        """
+        current_year = datetime.now().year
+        table = self._forecast_table(current_year)
+        if table is not None:
+            _, predicted_years, predicted_populations = table
+            predicted_year = int(predicted_years[record.index])
+            return (predicted_year if predicted_year >= 0 else None), int(predicted_populations[record.index])
+
+        with self._lock:
+            if self._forecast_year != current_year:
+                self._forecasts = {}
+                self._forecast_year = current_year
+            cached = self._forecasts.get(record.index)
+        if cached is None:
+            cached = predict_next_year(*self.annual_series(record))
+            with self._lock:
+                self._forecasts[record.index] = cached
+        return cached
+
+    def filled(self, method):
+        """
+        This dataset with the missing years of every city interpolated ('linear' or 'log'),
+        as a snapshot whose rows carry an imputed flag; built on first use per method.
+        Histories, growth and forecasts read from it use the filled series.
+        """
+        with self._lock:
+            snapshot = self._filled.get(method)
+        if snapshot is None:
+            city_index, years, populations, row_ids, source_ids = yearly_rows(self)
+            source, years, populations, imputed = fill_gaps(city_index, years, populations, method)
+            # Imputed points get a source of their own and no row id
+            sources = [*self.sources, f'Imputed ({method})']
+            snapshot = DatasetSnapshot(
+                self.version,
+                self.cities,
+                np.where(imputed, -1, row_ids[source]),
+                city_index[source].astype(np.int32),
+                years,
+                populations,
+                np.where(imputed, len(sources) - 1, source_ids[source]).astype(np.int32),
+                sources,
+                latitudes=self.latitudes,
+                longitudes=self.longitudes,
+                imputed=imputed,
+            )
+            with self._lock:
+                snapshot = self._filled.setdefault(method, snapshot)
+        return snapshot
+
+    def search_index(self):
+        """City name prefix/token index, built on first use for this snapshot."""
+        if self._search_index is None:
+            self._search_index = CitySearchIndex(self.cities)
+        return self._search_index
+
+    def location(self, record):
+        """Returns the city's (latitude, longitude), or None if it has no location."""
+        latitude, longitude = float(self.latitudes[record.index]), float(self.longitudes[record.index])
+        return None if latitude != latitude or longitude != longitude else (latitude, longitude)
+
+    def location_index(self):
+        """KD-tree over the city coordinates, built on first use for this snapshot."""
+        if self._location_index is None:
+            self._location_index = CityLocationIndex(self.cities, self.latitudes, self.longitudes)
+        return self._location_index
+
+    def city_trends(self):
+        """Per-city trend and growth statistics for ingestion screening, built on first use."""
+        if self._trends is None:
+            self._trends = CityTrends(self)
+        return self._trends
+
+    def rankings(self):
+        """Ranking metrics of every city for /api/rankings/, rebuilt with the forecasts each year."""
+        rankings = self._rankings
+        if rankings is None or not rankings.is_fresh():
+            rankings = self._rankings = CityRankings(self)
+        return rankings
+
+    def similarity(self):
+        """
+        Nearest cities by growth trajectory and growth clusters, cached on disk per dataset
+        version. While this version's is computed in the background, the previous one's.
+        """
+        similarity = self._similarity
+        if similarity is None or similarity.stale:
+            similarity = self._similarity = similarity_index(self)
+        return similarity
+
+    def _forecast_table(self, current_year):
+        if self._precomputed is not None and self._precomputed[0] == current_year:
+            return self._precomputed
+        fitted = self._fitted
+        return fitted if fitted is not None and fitted[0] == current_year else None
+
+    def forecast_many(self, records):
+        """Returns the forecasts of several cities, read from forecast_arrays()."""
+        _, predicted_years, predicted_populations = self.forecast_arrays()
+        return [
+            (int(predicted_years[record.index]) if predicted_years[record.index] >= 0 else None,
+             int(predicted_populations[record.index]))
+            for record in records
+        ]
+
+    def forecast_arrays(self):
+        """
+        Returns (base_year, predicted_years, predicted_populations) for every city, for storing.
+        All cities are fitted at once (forecasting.predict_next_year_many), once per snapshot
+        and year, unless the snapshot file already holds this year's.
+        """
+        current_year = datetime.now().year
+        table = self._forecast_table(current_year)
+        if table is None:
+            # Every city's annual_series at once: its rows plus year-end observations
+            city_index, years, populations, _, _ = yearly_rows(self)
+            table = (current_year, *predict_next_year_many(
+                city_index, years, populations, len(self.cities), next_year=current_year + 1,
+            ))
+            self._fitted = table
+        return table
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def get_snapshot():
+    """Returns the current snapshot, rebuilding it if the dataset version changed."""
+    global _snapshot
+    path = getattr(settings, 'ANALYTICS_SNAPSHOT_FILE', None)
+    if path:
+        # Shared across workers: map the on-disk snapshot instead of building a private copy
+        from .snapshot_file import get_mapped_snapshot, request_refresh
+        version = current_version()
+        mapped = get_mapped_snapshot(path)
+        # Rewritten after every commit; one nothing has rewritten within the max age (its
+        # writer gave up, or the version was lost from the cache) is rewritten by one reader
+        max_age = getattr(settings, 'ANALYTICS_SNAPSHOT_MAX_AGE', 60)
+        if time.time() - mapped.written_at >= max_age:
+            request_refresh(path, mapped.written_at)
+        if mapped.version == version:
+            return mapped
+        # Until the post-commit rewrite has caught up with the dataset version, serve an
+        # in-process build
+    else:
+        version = cache.get(VERSION_CACHE_KEY)
+
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.is_fresh(version):
+        return snapshot
+
+    with _snapshot_lock:
+        if _snapshot is None or not _snapshot.is_fresh(version):
+            _snapshot = DatasetSnapshot.build(version)
+        return _snapshot
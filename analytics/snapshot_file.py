@@ -0,0 +1,296 @@
+# analytics/snapshot_file.py
+"""
+Versioned on-disk format for the dataset snapshot, shared across gunicorn workers.
+
+Layout (little-endian):
+    MAGIC (8 bytes) | format version (uint32) | header length (uint32) | JSON header
+    | arrays, each aligned to ALIGNMENT bytes
+
+The JSON header holds the dataset version, the year the stored forecasts were made for,
+city names/regions, source strings and the (dtype, offset, length) of every array, with
+offsets relative to the first aligned byte after the header.
+Workers mmap the file and wrap the arrays with np.frombuffer, so the pages are shared
+through the OS page cache instead of being copied into each process. Writers build a
+new file next to the old one and swap it in with os.replace(); readers notice the new
+inode on their next request and remap, while in-flight requests keep the old mapping.
+
+The header version is the dataset version (VERSION_CACHE_KEY) the file was built for.
+get_snapshot() only serves the file while that is still the current version, and builds
+in-process while the file is behind: a client reading back its own write never gets the
+file from before it. The file is rewritten once every write commits, once across workers
+per dataset version; failed writes are logged and retried. A file nothing has rewritten
+within ANALYTICS_SNAPSHOT_MAX_AGE (its writer gave up, or the version was lost from the
+cache) is rewritten by one reader, which bounds how long any worker can serve it.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+from django.core.cache import cache
+from django.db import connections, transaction
+
+from .snapshot import CityRecord, DatasetSnapshot, current_version
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'PGSNAP\x00\x00'
+FORMAT_VERSION = 3
+ALIGNMENT = 64
+PREAMBLE = struct.Struct('<8sII')
+
+# Seconds between the attempts of a failed rewrite
+WRITE_RETRY_DELAYS = (1, 5, 30)
+# A rewrite of a version (or a refresh of a file) is asked for once across workers within this many seconds
+REWRITE_KEY = 'analytics:snapshot_file_rewrite'
+REWRITE_GUARD_SECONDS = 120
+
+ARRAY_FIELDS = (
+    ('city_ids', np.int64),
+    ('offsets', np.int64),
+    ('row_ids', np.int64),
+    ('city_index', np.int32),
+    ('years', np.int64),
+    ('populations', np.int64),
+    ('source_ids', np.int32),
+    ('growth', np.float64),
+    ('predicted_years', np.int64),
+    ('predicted_populations', np.int64),
+    ('latitudes', np.float64),
+    ('longitudes', np.float64),
+    ('observation_offsets', np.int64),
+    ('observation_months', np.int64),
+    ('observation_populations', np.int64),
+    ('observation_source_ids', np.int32),
+)
+
+
+def _aligned(position):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_snapshot_file(snapshot, path):
+    """
+    Writes the snapshot (with precomputed forecasts) to path atomically, under the
+    snapshot's dataset version (a new one if it has none). Returns the version.
+    """
+    forecast_year, predicted_years, predicted_populations = snapshot.forecast_arrays()
+    arrays = {
+        'city_ids': np.array([record.id for record in snapshot.cities], dtype=np.int64),
+        'offsets': snapshot.offsets,
+        'row_ids': snapshot.row_ids,
+        'city_index': snapshot.city_index,
+        'years': snapshot.years,
+        'populations': snapshot.populations,
+        'source_ids': snapshot.source_ids,
+        'growth': snapshot.growth,
+        'predicted_years': predicted_years,
+        'predicted_populations': predicted_populations,
+        'latitudes': snapshot.latitudes,
+        'longitudes': snapshot.longitudes,
+        'observation_offsets': snapshot.observation_offsets,
+        'observation_months': snapshot.observation_months,
+        'observation_populations': snapshot.observation_populations,
+        'observation_source_ids': snapshot.observation_source_ids,
+    }
+    version = snapshot.version or uuid.uuid4().hex
+    header = {
+        'version': version,
+        'forecast_year': forecast_year,
+        'cities': [[record.name, record.region] for record in snapshot.cities],
+        'sources': snapshot.sources,
+        'arrays': {},
+    }
+
+    # Array offsets are relative to the first aligned byte after the header
+    position = 0
+    for name, dtype in ARRAY_FIELDS:
+        header['arrays'][name] = [np.dtype(dtype).str, position, len(arrays[name])]
+        position = _aligned(position + np.dtype(dtype).itemsize * len(arrays[name]))
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _aligned(PREAMBLE.size + len(header_bytes))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.snapshot-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as handle:
+            handle.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+            handle.write(header_bytes)
+            for name, dtype in ARRAY_FIELDS:
+                handle.seek(data_start + header['arrays'][name][1])
+                handle.write(np.ascontiguousarray(arrays[name], dtype=dtype).tobytes())
+            # Pad to the end of the last array so empty trailing arrays still map in bounds
+            handle.truncate(data_start + position)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return version
+
+
+def write_current_snapshot(path):
+    """Builds the snapshot of the current dataset version and writes it to path."""
+    # Read before the build: a write landing during it leaves the file behind, not mislabelled
+    version = current_version()
+    return write_snapshot_file(DatasetSnapshot.build(version), path)
+
+
+def open_snapshot_file(path):
+    """Maps a snapshot file read-only and returns a DatasetSnapshot whose arrays view the mapping."""
+    with open(path, 'rb') as handle:
+        mapping = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        written_at = os.fstat(handle.fileno()).st_mtime
+
+    magic, format_version, header_length = PREAMBLE.unpack_from(mapping, 0)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        mapping.close()
+        raise ValueError(f'{path} is not a version {FORMAT_VERSION} snapshot file')
+    header = json.loads(bytes(mapping[PREAMBLE.size:PREAMBLE.size + header_length]))
+    data_start = _aligned(PREAMBLE.size + header_length)
+
+    arrays = {
+        name: np.frombuffer(mapping, dtype=np.dtype(dtype), count=length, offset=data_start + offset)
+        for name, (dtype, offset, length) in header['arrays'].items()
+    }
+    cities = [
+        CityRecord(index, city_id, name, region)
+        for index, (city_id, (name, region)) in enumerate(zip(arrays['city_ids'].tolist(), header['cities']))
+    ]
+    snapshot = DatasetSnapshot(
+        header['version'],
+        cities,
+        arrays['row_ids'],
+        arrays['city_index'],
+        arrays['years'],
+        arrays['populations'],
+        arrays['source_ids'],
+        header['sources'],
+        offsets=arrays['offsets'],
+        growth=arrays['growth'],
+        forecasts=(header['forecast_year'], arrays['predicted_years'], arrays['predicted_populations']),
+        latitudes=arrays['latitudes'],
+        longitudes=arrays['longitudes'],
+        observations=(
+            arrays['observation_offsets'], arrays['observation_months'],
+            arrays['observation_populations'], arrays['observation_source_ids'],
+        ),
+    )
+    snapshot.written_at = written_at
+    return snapshot
+
+
+# ------------------ Reader ------------------
+
+_mapped = None
+_mapped_key = None
+_mapped_lock = threading.Lock()
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def get_mapped_snapshot(path):
+    """Returns the mapped snapshot, remapping when the file has been swapped for a new version."""
+    global _mapped, _mapped_key
+    try:
+        key = _file_key(path)
+    except FileNotFoundError:
+        key = None
+    if _mapped is not None and key == _mapped_key:
+        return _mapped
+
+    with _mapped_lock:
+        if key is None:
+            # First worker up writes the initial file
+            write_current_snapshot(path)
+            key = _file_key(path)
+        if _mapped is None or key != _mapped_key:
+            try:
+                _mapped = open_snapshot_file(path)
+            except ValueError:
+                # Written by an older format version; replace it
+                write_current_snapshot(path)
+                key = _file_key(path)
+                _mapped = open_snapshot_file(path)
+            _mapped_key = key
+        return _mapped
+
+
+# ------------------ On-change writer ------------------
+
+_writer_lock = threading.Lock()
+_writer_thread = None
+_writer_pending = False
+
+
+def schedule_snapshot_write(path):
+    """Rewrites the snapshot file in the background once the current transaction commits."""
+    # The version is read after the commit, once the write has bumped it
+    transaction.on_commit(lambda: request_rewrite(path, current_version()))
+
+
+def request_rewrite(path, version):
+    """Starts a rewrite for a dataset version the file does not have yet, unless a worker already did."""
+    if cache.add(f'{REWRITE_KEY}:{version}', True, timeout=REWRITE_GUARD_SECONDS):
+        _start_writer(path)
+
+
+def request_refresh(path, written_at):
+    """Starts a rewrite of a file written at written_at and found too old, unless a worker already did."""
+    if cache.add(f'{REWRITE_KEY}:written:{written_at}', True, timeout=REWRITE_GUARD_SECONDS):
+        _start_writer(path)
+
+
+def _start_writer(path):
+    global _writer_thread, _writer_pending
+    with _writer_lock:
+        # Writes that land while a rewrite is running are coalesced into one more pass
+        _writer_pending = True
+        if _writer_thread is not None:
+            return
+        _writer_thread = threading.Thread(target=_run_writer, args=(path,), daemon=True)
+        _writer_thread.start()
+
+
+def _run_writer(path):
+    global _writer_thread, _writer_pending
+    try:
+        while True:
+            with _writer_lock:
+                if not _writer_pending:
+                    _writer_thread = None
+                    return
+                _writer_pending = False
+            _write_with_retries(path)
+    except BaseException:
+        with _writer_lock:
+            _writer_thread = None
+        raise
+    finally:
+        connections.close_all()
+
+
+def _write_with_retries(path):
+    for attempt, delay in enumerate((0, *WRITE_RETRY_DELAYS), start=1):
+        time.sleep(delay)
+        try:
+            write_current_snapshot(path)
+            return
+        except Exception:
+            logger.exception('Writing the snapshot file %s failed (attempt %d)', path, attempt)
+            # A failed attempt may have left the connection unusable
+            connections.close_all()
+    # Readers keep building in-process until the next write or a later stale read asks again
+    cache.delete(f'{REWRITE_KEY}:{current_version()}')
@@ -0,0 +1,109 @@
+# analytics/streaming.py
+"""
+Streaming JSON output for whole-dataset responses: the cities listing and the per-city
+bands of /api/simulate/.
+
+The body is produced city by city and flushed in CHUNK_SIZE pieces, so time-to-first-byte
+and peak memory do not grow with the number of cities. The bytes are the same as DRF's
+JSONRenderer output (compact separators, UTF-8, \\u2028/\\u2029 escaped), so clients
+parse exactly the same document.
+
+Views whose response does not grow with the dataset (the summary report, stats,
+rankings) are not streamed: they are computed from snapshot arrays and their whole
+body is a few hundred bytes.
+"""
+import json
+
+from django.http import StreamingHttpResponse
+
+CHUNK_SIZE = 64 * 1024
+
+_encoder = json.JSONEncoder(ensure_ascii=False, allow_nan=False, separators=(',', ':'))
+
+
+def encode(value):
+    """Encodes a value the way DRF's JSONRenderer does."""
+    return _encoder.encode(value).replace('\u2028', '\\u2028').replace('\u2029', '\\u2029')
+
+
+def wants_stream(request):
+    """Streams unless the client asked for ?stream=false, a non-JSON format or indented JSON."""
+    if request.query_params.get('stream', 'true').lower() in ('0', 'false', 'no'):
+        return False
+    renderer = getattr(request, 'accepted_renderer', None)
+    if renderer is None or renderer.format != 'json':
+        return False
+    return 'indent' not in (getattr(request, 'accepted_media_type', '') or '')
+
+
+def encode_history(snapshot, record, encoded_sources, max_points=None):
+    """
+    Fast path for the numeric-heavy history array: ints and rounded growth values are
+    formatted directly and source strings are encoded once per response, instead of
+    building a dict per row and running it through the generic encoder.
+    """
+    rows = snapshot.history_rows(record, max_points)
+    # Gap-filled snapshots flag every point; interpolated ones have no row id (-1)
+    imputed = snapshot.imputed[rows].tolist() if snapshot.imputed is not None else None
+    parts = []
+    for position, (row_id, year, population, source_id, growth) in enumerate(zip(
+        snapshot.row_ids[rows].tolist(), snapshot.years[rows].tolist(), snapshot.populations[rows].tolist(),
+        snapshot.source_ids[rows].tolist(), snapshot.growth[rows].tolist(),
+    )):
+        growth = 'null' if growth != growth else repr(round(growth, 2))
+        flag = '' if imputed is None else f',"imputed":{"true" if imputed[position] else "false"}'
+        parts.append(
+            f'{{"Historyid":{row_id if row_id >= 0 else "null"},"year":{year},"population":{population},'
+            f'"source":{encoded_sources[source_id]},"growth":{growth}{flag}}}'
+        )
+    return '[' + ','.join(parts) + ']'
+
+
+def _chunked(parts):
+    """Joins encoded parts into UTF-8 chunks of about CHUNK_SIZE."""
+    buffer, size = [], 0
+    for part in parts:
+        buffer.append(part)
+        size += len(part)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buffer).encode()
+            buffer, size = [], 0
+    yield ''.join(buffer).encode()
+
+
+def iter_cities_json(snapshot, max_points=None):
+    """Yields the get_cities_with_population body as UTF-8 chunks, one city at a time."""
+    encoded_sources = [encode(source) for source in snapshot.sources]
+
+    def parts():
+        yield '['
+        for position, record in enumerate(snapshot.cities):
+            predicted_year, predicted_population = snapshot.forecast(record)
+            yield (
+                f'{"," if position else ""}'
+                f'{{"id":{record.id},"name":{encode(record.name)},"region":{encode(record.region)},'
+                f'"predicted_year":{encode(predicted_year)},"predicted_population":{predicted_population},'
+                f'"history":{encode_history(snapshot, record, encoded_sources, max_points)}}}'
+            )
+        yield ']'
+
+    return _chunked(parts())
+
+
+def iter_object_json(head, key, items, tail):
+    """
+    Yields {**head, key: [*items], **tail()} as UTF-8 chunks, the list one item at a time
+    as items produces them; tail is called once items is exhausted.
+    """
+    def parts():
+        yield encode(head)[:-1] + (',' if head else '') + encode(key) + ':['
+        for position, item in enumerate(items):
+            yield (',' if position else '') + encode(item)
+        rest = encode(tail())[1:]
+        yield ']' + (',' + rest if rest != '}' else '}')
+
+    return _chunked(parts())
+
+
+def streaming_json_response(chunks, status=200):
+    return StreamingHttpResponse(chunks, status=status, content_type='application/json')
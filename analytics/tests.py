@@ -1,3 +1,1639 @@
-from django.test import TestCase
+import json
+import math
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+import numpy as np
+import pyarrow as pa
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.client import MULTIPART_CONTENT
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, reverse
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from . import urls
+from .api_views import MAX_SEARCH_RESULTS
+from .areas import apply_changes, create_area, move_area
+from .changes import changes_since, latest_token, record_change, record_changes, replica_is_current
+from .events import ChangeBroadcaster, Subscriber, format_event
+from .city_cache import VERSION_CACHE_KEY as CITY_VERSION_CACHE_KEY, bump_city_version
+from .forecast_archive import archive_forecasts, record_actuals
+from .forecasting import predict_next_year
+from .gapfill import fill_gaps
+from .management.commands.loadtest import Command as LoadTestCommand
+from .middleware import ReadYourWritesMiddleware
+from .models import (
+    Area, AreaPopulation, ChangeLog, City, ForecastArchive, PopulationData, PopulationObservation, QuarantinedPopulation,
+    User,
+)
+from .rankings import METRICS
+from .renderers import cities_table, to_table
+from .resampling import lttb
+from .routers import REPLICA, PrimaryReplicaRouter, primary_pinned, use_primary
+from .screening import FLAG, PASS, QUARANTINE, REJECT, screen
+from .search import CitySearchIndex
+from . import city_cache, similarity
+from .similarity import MIN_OVERLAP, STORED_NEIGHBOURS, WINDOW_YEARS, SimilarityIndex, build_similarity_index
+from .simulation import ARRAYS_PER_CHUNK, PERCENTILES, Simulation, simulate
+from .snapshot import CityRecord, DatasetSnapshot, bump_version, current_version, get_snapshot
+from .streaming import iter_object_json
+from .snapshot_file import (
+    FORMAT_VERSION, MAGIC, PREAMBLE, REWRITE_KEY, _write_with_retries, open_snapshot_file, request_rewrite,
+    write_current_snapshot,
+)
+from .throttles import CostTokenBucketThrottle
+
+
+# ------------------ Query-count regression harness ------------------
+#
+# Every route in analytics/urls.py (the api/ paths and their non-prefixed aliases) is requested
+# against a small and a large dataset. An endpoint must issue the same number of queries for
+# both, unless its ENDPOINTS entry declares a bound in terms of the dataset size. Failures
+# print the repeated SQL, which is what an N+1 regression looks like.
+
+class DatasetSize:
+    def __init__(self, cities, years):
+        self.cities = cities
+        self.years = years
+
+    @property
+    def rows(self):
+        return self.cities * self.years
+
+    def __repr__(self):
+        return f'{self.cities} cities x {self.years} years'
+
+
+SIZES = (DatasetSize(cities=3, years=3), DatasetSize(cities=15, years=8))
+
+
+class Endpoint:
+    """
+    How to call one route. kwargs / data / query are callables taking the Fixture.
+    bound(size) is the most queries allowed for a dataset of that size; without one the
+    count must not change between the dataset sizes. status is the expected response code.
+    """
+
+    def __init__(self, method='get', kwargs=None, data=None, query=None, path=None, bound=None, status=200):
+        self.method = method
+        self.kwargs = kwargs or (lambda fixture: {})
+        self.data = data or (lambda fixture: None)
+        self.query = query or (lambda fixture: '')
+        self.path = path
+        self.bound = bound
+        self.status = status
+
+
+def all_ids(fixture):
+    return ','.join(str(city.id) for city in fixture.cities)
+
+
+ENDPOINTS = {
+    'cities-list': Endpoint(),
+    'cities-batch': Endpoint(query=lambda fixture: f'?ids={all_ids(fixture)}&fill=log'),
+    'cities-search': Endpoint(query=lambda fixture: '?q=city'),
+    'cities-nearby': Endpoint(query=lambda fixture: '?lat=14.6&lon=121.0&limit=5&radius_km=500'),
+    'cities-clusters': Endpoint(query=lambda fixture: '?cluster=0'),
+    'bulk_update_city_locations': Endpoint(
+        'put',
+        data=lambda fixture: {
+            'items': [{'id': city.id, 'latitude': 10.0, 'longitude': 123.0} for city in fixture.cities],
+        },
+    ),
+    'city-detail': Endpoint(kwargs=lambda fixture: {'city_id': fixture.cities[0].id}, query=lambda fixture: '?max_points=3'),
+    'city-series': Endpoint(
+        kwargs=lambda fixture: {'city_id': fixture.cities[0].id},
+        query=lambda fixture: '?frequency=quarterly&max_points=5',
+    ),
+    'city-similar': Endpoint(kwargs=lambda fixture: {'city_id': fixture.cities[0].id}, query=lambda fixture: '?limit=5'),
+    'export_city_csv_api': Endpoint(kwargs=lambda fixture: {'city_id': fixture.cities[0].id}),
+    'stats_api': Endpoint(),
+    'api_login': Endpoint('post', data=lambda fixture: {'username': 'superadmin', 'password': 'SuperSecret123!'}),
+    'create_admin': Endpoint(
+        'post',
+        data=lambda fixture: {'username': 'newadmin', 'password': 'Secret123!'},
+        status=201,
+    ),
+    'add_city': Endpoint('post', data=lambda fixture: {'city_name': 'New City', 'region': 'NCR'}, status=201),
+    # The cascade deletes population rows one post_delete signal (and change-log row) at a time;
+    # each change-log row takes a token from the sequence first (update and read)
+    'delete_city': Endpoint(
+        'delete',
+        kwargs=lambda fixture: {'city_id': fixture.cities[0].id},
+        bound=lambda size: 20 + 3 * size.years,
+    ),
+    'add_population_data': Endpoint(
+        'post',
+        data=lambda fixture: {'city_id': fixture.cities[0].id, 'year': 2010, 'population_count': 15000},
+        status=201,
+    ),
+    'update_population_data': Endpoint(
+        'put',
+        kwargs=lambda fixture: {'population_id': fixture.rows[0].id},
+        data=lambda fixture: {'population_count': 10050},
+    ),
+    'delete_population_data': Endpoint('delete', kwargs=lambda fixture: {'population_id': fixture.rows[0].id}),
+    'bulk_update_population_data': Endpoint(
+        'put',
+        data=lambda fixture: {'filter': {'year_from': 2000}, 'changes': {'source': 'PSA'}},
+    ),
+    # Django deletes rows that have delete receivers in batches of 100
+    'bulk_delete_population_data': Endpoint(
+        'post',
+        data=lambda fixture: {'ids': [row.id for row in fixture.rows]},
+        bound=lambda size: 20 + math.ceil(size.rows / 100),
+    ),
+    'add_population_observations': Endpoint(
+        'post',
+        data=lambda fixture: {'observations': [
+            {'city_id': city.id, 'year': 2030, 'month': month, 'population_count': 20000 + month}
+            for city in fixture.cities
+            for month in (1, 2)
+        ] + [
+            {'city_id': observation.city_id, 'year': observation.year, 'quarter': observation.period,
+             'population_count': observation.population_count + 1}
+            for observation in fixture.observations
+        ]},
+    ),
+    'population-quarantine': Endpoint(query=lambda fixture: '?limit=1000'),
+    'review_quarantine': Endpoint(
+        'post',
+        data=lambda fixture: {'release': [entry.id for entry in fixture.quarantined[::2]],
+                              'discard': [entry.id for entry in fixture.quarantined[1::2]]},
+    ),
+    'get_admins': Endpoint(),
+    'delete_admin': Endpoint('delete', kwargs=lambda fixture: {'admin_id': fixture.admin.id}),
+    'update_city': Endpoint(
+        'put',
+        kwargs=lambda fixture: {'city_id': fixture.cities[0].id},
+        data=lambda fixture: {'region': 'Region X'},
+    ),
+    'overall-summary': Endpoint(),
+    'changes': Endpoint(query=lambda fixture: f'?since={fixture.change_token}'),
+    # The test client is WSGI; the stream itself needs ASGI
+    'forecast-events': Endpoint(status=501),
+    'simulate': Endpoint(
+        'post',
+        data=lambda fixture: {'horizon': 5, 'paths': 200, 'shocks': {'Region 1': -1}, 'seed': 1},
+    ),
+    'rankings': Endpoint(query=lambda fixture: '?metric=predicted_growth&k=5&region=Region 1'),
+    'add_area': Endpoint(
+        'post',
+        data=lambda fixture: {'name': 'Cebu', 'level': 'province', 'parent_id': fixture.regions[0].id},
+        status=201,
+    ),
+    'reparent_area': Endpoint(
+        'put',
+        kwargs=lambda fixture: {'area_id': fixture.city_areas[0].id},
+        data=lambda fixture: {'parent_id': fixture.regions[1].id},
+    ),
+    'area-population': Endpoint(kwargs=lambda fixture: {'area_id': fixture.country.id}, query=lambda fixture: '?year=2000'),
+    'forecast-accuracy': Endpoint(query=lambda fixture: '?group_by=region,engine,city'),
+    'frontend': Endpoint(path='/dashboard/'),
+}
+
+# Django admin pages and actions (posted as forms): changelists must not query once per row
+ADMIN_PAGES = {
+    'admin:analytics_populationdata_changelist': Endpoint(query=lambda fixture: '?region=Region 1&year=2001'),
+    'admin:analytics_populationdata_change': Endpoint(kwargs=lambda fixture: {'object_id': fixture.rows[0].id}),
+    'admin:analytics_city_changelist': Endpoint(query=lambda fixture: '?region=Region 2'),
+    'admin:analytics_user_changelist': Endpoint(),
+    # As bulk_delete_population_data (batches of 100); action posts also build the changelist filters twice
+    'admin:analytics_populationdata_changelist-delete_rows': Endpoint(
+        'post',
+        data=lambda fixture: {'action': 'delete_rows', '_selected_action': [row.id for row in fixture.rows]},
+        bound=lambda size: 25 + math.ceil(size.rows / 100),
+        status=302,
+    ),
+    'admin:analytics_populationdata_changelist-clear_anomaly_scores': Endpoint(
+        'post',
+        data=lambda fixture: {'action': 'clear_anomaly_scores', '_selected_action': [row.id for row in fixture.rows]},
+        status=302,
+    ),
+    'admin:analytics_city_changelist-clear_locations': Endpoint(
+        'post',
+        data=lambda fixture: {'action': 'clear_locations', '_selected_action': [city.id for city in fixture.cities]},
+        status=302,
+    ),
+}
+
+# Aliases another urlconf matches first: 'admin/create/' is handled by the Django admin
+SHADOWED_ROUTES = {'create_admin-noapi': 404}
+
+
+class Fixture:
+    """A dataset of the given size, replacing whatever the seed migration created."""
+
+    def __init__(self, size):
+        self.superadmin = User.objects.get(username='superadmin')
+        self.admin = User.objects.create_user(username='queryadmin', password='Secret123!', role='admin')
+        self.country = create_area('Philippines', 'country')
+        self.regions = [create_area(f'Region {index}', 'region', self.country) for index in range(4)]
+        self.city_areas = [
+            create_area(f'City {index}', 'city', self.regions[index % 4]) for index in range(size.cities)
+        ]
+        self.cities = City.objects.bulk_create(
+            City(
+                city_name=f'City {index}',
+                region=f'Region {index % 4}',
+                area=self.city_areas[index],
+                latitude=14.0 + index / 10,
+                longitude=121.0 - index / 10,
+            )
+            for index in range(size.cities)
+        )
+        self.rows = PopulationData.objects.bulk_create(
+            PopulationData(
+                city=city,
+                year=2000 + year,
+                population_count=10000 + 500 * year + index,
+                source='Census',
+                created_by=self.superadmin,
+                area=city.area,
+            )
+            for index, city in enumerate(self.cities)
+            for year in range(size.years)
+        )
+        apply_changes(added=[(row.area_id, row.year, row.population_count) for row in self.rows])
+        # A held-back new row and a held-back change for every city
+        self.quarantined = QuarantinedPopulation.objects.bulk_create(
+            QuarantinedPopulation(
+                city=city, population=population, year=2020 if population is None else population.year,
+                population_count=999999, score=50, reason='Anomaly score 50', created_by=self.superadmin,
+            )
+            for index, city in enumerate(self.cities)
+            for population in (None, self.rows[index * size.years])
+        )
+        # Quarterly counts for the year after the yearly rows
+        self.observations = PopulationObservation.objects.bulk_create(
+            PopulationObservation(
+                city=city, year=2000 + size.years, granularity='quarter', period=quarter,
+                population_count=10000 + 500 * size.years + quarter * 100, created_by=self.superadmin,
+            )
+            for city in self.cities
+            for quarter in range(1, 5)
+        )
+        # A forecast of the last stored year (already evaluated) and of the next one, per city
+        ForecastArchive.objects.bulk_create(
+            ForecastArchive(
+                city=city, engine=ForecastArchive.ENGINE_LINEAR, target_year=2000 + year,
+                base_year=2000 + year - 1, basis=year, predicted_population=10000 + 500 * year,
+            )
+            for city in self.cities
+            for year in (size.years - 1, size.years)
+        )
+        record_actuals((city.id, 2000 + size.years - 1) for city in self.cities)
+        self.change_token = 0
+        # bulk_create sends no signals, so invalidate the in-process snapshot and city lookup here
+        bump_version()
+        bump_city_version()
+
+
+def normalize_sql(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+\b', '?', sql)
+    return re.sub(r'\(\?(?:, \?)+\)', '(...)', sql)
+
+
+def duplicated_sql_report(captured):
+    counts = Counter(normalize_sql(query['sql']) for query in captured)
+    lines = [f'{count}x {sql}' for sql, count in counts.most_common() if count > 1]
+    return '\n'.join(lines) or '(no repeated statements)'
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    ANALYTICS_COST_THROTTLE={
+        'anon': {'capacity': 10 ** 9, 'refill_rate': 10 ** 9},
+        'user': {'capacity': 10 ** 9, 'refill_rate': 10 ** 9},
+    },
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+)
+class QueryCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        City.objects.all().delete()
+        User.objects.exclude(username='superadmin').delete()
+        superadmin = User.objects.get(username='superadmin')
+        superadmin.set_password('SuperSecret123!')
+        superadmin.save()
+
+    def measure(self, pattern, endpoint, size):
+        def url(fixture):
+            if pattern.pattern.regex.pattern.startswith('^(?!api/)'):
+                return endpoint.path
+            return reverse(pattern.name, kwargs=endpoint.kwargs(fixture))
+        return self.request(url, endpoint, size)
+
+    def request(self, url, endpoint, size, content_type='application/json'):
+        with transaction.atomic():
+            fixture = Fixture(size)
+            url = url(fixture) + endpoint.query(fixture)
+            data = endpoint.data(fixture)
+
+            self.client.force_login(fixture.superadmin)
+            request = getattr(self.client, endpoint.method)
+            with CaptureQueriesContext(connection) as captured:
+                if data is None:
+                    response = request(url)
+                else:
+                    response = request(url, data, content_type=content_type)
+            transaction.set_rollback(True)
+        return response, captured.captured_queries
+
+    def check_counts(self, name, endpoint, results):
+        counts = ', '.join(f'{len(captured)} queries for {size}' for size, _, captured in results)
+        (_, _, small), (large_size, _, large) = results
+        if endpoint.bound is None:
+            failed = len(large) != len(small)
+            expected = 'the same count for every dataset size'
+        else:
+            failed = any(len(captured) > endpoint.bound(size) for size, _, captured in results)
+            expected = f'at most {endpoint.bound(large_size)} queries for {large_size}'
+        if failed:
+            self.fail(
+                f'{name}: {counts}; expected {expected}.\n'
+                f'Repeated SQL for {large_size}:\n{duplicated_sql_report(large)}'
+            )
+
+    def test_every_route_is_covered(self):
+        names = {pattern.name.removesuffix('-noapi') for pattern in urls.urlpatterns}
+        self.assertEqual(names - set(ENDPOINTS), set(), 'Declare how to call these routes in ENDPOINTS')
+
+    def test_query_counts_do_not_grow_with_the_dataset(self):
+        for pattern in urls.urlpatterns:
+            if not isinstance(pattern, URLPattern):
+                continue
+            endpoint = ENDPOINTS.get(pattern.name.removesuffix('-noapi'))
+            if endpoint is None:
+                continue
+            with self.subTest(route=str(pattern.pattern), name=pattern.name):
+                results = [(size, *self.measure(pattern, endpoint, size)) for size in SIZES]
+                for size, response, captured in results:
+                    self.assertEqual(
+                        response.status_code, SHADOWED_ROUTES.get(pattern.name, endpoint.status),
+                        f'{pattern.name} returned {response.status_code} for {size}'
+                    )
+
+                self.check_counts(f'{pattern.name} ({pattern.pattern})', endpoint, results)
+
+    def test_admin_pages_do_not_grow_with_the_dataset(self):
+        # The change form's first lookup of a content type would otherwise count against the first size
+        ContentType.objects.get_for_models(City, PopulationData, User)
+        for name, endpoint in ADMIN_PAGES.items():
+            # Actions post to their changelist; the suffix only tells them apart
+            url_name = name.partition('-')[0]
+            with self.subTest(page=name):
+                results = [
+                    (size, *self.request(
+                        lambda fixture: reverse(url_name, kwargs=endpoint.kwargs(fixture)), endpoint, size,
+                        content_type=MULTIPART_CONTENT,
+                    ))
+                    for size in SIZES
+                ]
+                for size, response, captured in results:
+                    self.assertEqual(response.status_code, endpoint.status, f'{name} returned {response.status_code} for {size}')
+                self.check_counts(name, endpoint, results)
+
+
+# ------------------ Behaviour tests ------------------
+
+def legacy_growth(populations):
+    """Year-over-year growth as the original per-row Python loop computed it."""
+    growth = []
+    previous = None
+    for population in populations:
+        growth.append(
+            round((population - previous) / previous * 100, 2) if previous is not None and previous > 0 else None
+        )
+        previous = population
+    return growth
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class GrowthTests(TestCase):
+    def test_growth_matches_the_python_loop(self):
+        superadmin = User.objects.get(username='superadmin')
+        city = City.objects.create(city_name='Growth City', region='Region 1')
+        generator = random.Random(26)
+        # Zero and tiny previous counts, exact .xx5 ratios and large counts, then random ones
+        counts = [0, 1000, 1001, 0, 8, 1, 200, 201, 333, 2 ** 40 + 1, 7, 7, 1000, 999] + [
+            generator.randint(1, 10 ** generator.randint(1, 9)) for _ in range(300)
+        ]
+        PopulationData.objects.bulk_create(
+            PopulationData(city=city, year=1700 + index, population_count=count, created_by=superadmin)
+            for index, count in enumerate(counts)
+        )
+        expected = legacy_growth(counts)
+
+        snapshot = DatasetSnapshot.build()
+        history = snapshot.history(snapshot.get_city(city.id))
+        self.assertEqual([entry['growth'] for entry in history], expected)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SnapshotVersionTests(TestCase):
+    def test_a_reader_during_a_write_cannot_cache_it_under_the_new_version(self):
+        superadmin = User.objects.get(username='superadmin')
+        city = City.objects.create(city_name='Versioned City', region='Region 1')
+        row = PopulationData.objects.create(city=city, year=2020, population_count=2091409, created_by=superadmin)
+        bump_version()
+        before, city_before = current_version(), cache.get(CITY_VERSION_CACHE_KEY)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            row.population_count = 123
+            row.save()
+            city.region = 'Region 2'
+            city.save()
+            # A reader before the commit still sees the old versions, so whatever it builds is
+            # labelled with them
+            self.assertEqual((current_version(), cache.get(CITY_VERSION_CACHE_KEY)), (before, city_before))
+            during = get_snapshot()
+            self.assertEqual(during.version, before)
+
+        self.assertNotEqual(current_version(), before)
+        self.assertNotEqual(cache.get(CITY_VERSION_CACHE_KEY), city_before)
+        self.assertFalse(during.is_fresh(current_version()))
+        snapshot = get_snapshot()
+        self.assertEqual(snapshot.series(snapshot.get_city(city.id))[1].tolist(), [123])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SnapshotFileTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'snapshot.bin')
+        overridden = override_settings(ANALYTICS_SNAPSHOT_FILE=self.path, ANALYTICS_SNAPSHOT_MAX_AGE=60)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        # Rewrites are checked for, not run on a background thread
+        writer = mock.patch('analytics.snapshot_file._start_writer')
+        self.start_writer = writer.start()
+        self.addCleanup(writer.stop)
+
+        city = City.objects.create(city_name='Mapped City', region='Region 1')
+        self.row = PopulationData.objects.create(
+            city=city, year=2020, population_count=2091409, created_by=User.objects.get(username='superadmin'),
+        )
+        self.city_id = city.id
+
+    def populations(self, snapshot):
+        return snapshot.series(snapshot.get_city(self.city_id))[1].tolist()
+
+    def test_a_file_behind_the_version_is_built_around_and_rewritten_by_the_writer(self):
+        mapped = get_snapshot()
+        self.assertIsNotNone(mapped.written_at)
+        self.assertEqual(self.populations(mapped), [2091409])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.row.population_count = 123
+            self.row.save()
+            self.assertIs(get_snapshot(), mapped)
+        # The writer asks for the rewrite under the version it bumped
+        self.start_writer.assert_called_once_with(self.path)
+        self.assertTrue(cache.get(f'{REWRITE_KEY}:{current_version()}'))
+
+        # Readers build in-process meanwhile, and never claim a rewrite themselves
+        bump_version()
+        built = get_snapshot()
+        self.assertIsNone(built.written_at)
+        self.assertEqual(self.populations(built), [123])
+        self.start_writer.assert_called_once()
+        self.assertIsNone(cache.get(f'{REWRITE_KEY}:{current_version()}'))
+
+        write_current_snapshot(self.path)
+        rewritten = get_snapshot()
+        self.assertEqual((rewritten.version, self.populations(rewritten)), (current_version(), [123]))
+        self.assertIsNotNone(rewritten.written_at)
+
+    def test_a_file_older_than_the_max_age_is_refreshed_once(self):
+        get_snapshot()
+        self.start_writer.assert_not_called()
+
+        written_at = time.time() - 3600
+        os.utime(self.path, (written_at, written_at))
+        mapped = get_snapshot()
+        self.assertAlmostEqual(mapped.written_at, written_at, places=3)
+        self.start_writer.assert_called_once_with(self.path)
+        # Across workers too: the refresh of that file is claimed once
+        self.assertIs(get_snapshot(), mapped)
+        self.start_writer.assert_called_once()
+
+    def test_a_file_of_another_format_version_is_replaced(self):
+        with open(self.path, 'wb') as handle:
+            handle.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION - 1, 2) + b'{}')
+        with self.assertRaisesMessage(ValueError, f'not a version {FORMAT_VERSION} snapshot file'):
+            open_snapshot_file(self.path)
+
+        mapped = get_snapshot()
+        self.assertEqual((mapped.version, self.populations(mapped)), (current_version(), [2091409]))
+        with open(self.path, 'rb') as handle:
+            self.assertEqual(PREAMBLE.unpack(handle.read(PREAMBLE.size))[:2], (MAGIC, FORMAT_VERSION))
+
+    def test_a_failed_rewrite_releases_its_claim(self):
+        request_rewrite(self.path, current_version())
+        self.assertTrue(cache.get(f'{REWRITE_KEY}:{current_version()}'))
+        with mock.patch('analytics.snapshot_file.write_current_snapshot', side_effect=OSError('disk full')), \
+                mock.patch('analytics.snapshot_file.time.sleep'), self.assertLogs('analytics.snapshot_file', 'ERROR'):
+            _write_with_retries(self.path)
+        # The next stale reader or write can ask again
+        self.assertIsNone(cache.get(f'{REWRITE_KEY}:{current_version()}'))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CommitInvalidationTests(TestCase):
+    def setUp(self):
+        self.superadmin = User.objects.get(username='superadmin')
+        self.city = City.objects.create(city_name='Bulk City', region='Region 1')
+        self.rows = [
+            PopulationData.objects.create(city=self.city, year=2000 + offset, population_count=1000, created_by=self.superadmin)
+            for offset in range(3)
+        ]
+        self.client.force_login(self.superadmin)
+
+    def assertInvalidatedOnCommit(self, write, cities=False):
+        """Runs write(); the dataset (and with cities, the city) version moves only once it commits."""
+        bump_version()
+        bump_city_version()
+        before = (current_version(), cache.get(CITY_VERSION_CACHE_KEY))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = write()
+            self.assertLess(response.status_code, 400, response.content)
+            self.assertEqual((current_version(), cache.get(CITY_VERSION_CACHE_KEY)), before)
+        self.assertNotEqual(current_version(), before[0])
+        if cities:
+            self.assertNotEqual(cache.get(CITY_VERSION_CACHE_KEY), before[1])
+        return get_snapshot()
+
+    def test_bulk_population_writes(self):
+        snapshot = self.assertInvalidatedOnCommit(lambda: self.client.put(
+            reverse('bulk_update_population_data'),
+            {'filter': {'city_id': self.city.id}, 'changes': {'source': 'PSA'}}, content_type='application/json',
+        ))
+        record = snapshot.get_city(self.city.id)
+        self.assertEqual({snapshot.sources[source] for source in snapshot.source_ids[snapshot.rows(record)]}, {'PSA'})
+
+        snapshot = self.assertInvalidatedOnCommit(lambda: self.client.post(
+            reverse('bulk_delete_population_data'), {'ids': [self.rows[0].id]}, content_type='application/json',
+        ))
+        self.assertEqual(snapshot.series(snapshot.get_city(self.city.id))[0].tolist(), [2001, 2002])
+
+    def test_bulk_city_locations(self):
+        snapshot = self.assertInvalidatedOnCommit(lambda: self.client.put(
+            reverse('bulk_update_city_locations'),
+            {'items': [{'id': self.city.id, 'latitude': 14.5, 'longitude': 121.0}]}, content_type='application/json',
+        ), cities=True)
+        record = snapshot.get_city(self.city.id)
+        self.assertEqual((snapshot.latitudes[record.index], snapshot.longitudes[record.index]), (14.5, 121.0))
+
+    def test_quarantine_release(self):
+        entry = QuarantinedPopulation.objects.create(
+            city=self.city, year=2003, population_count=5000, score=9.0, reason='Test', created_by=self.superadmin,
+        )
+        snapshot = self.assertInvalidatedOnCommit(lambda: self.client.post(
+            reverse('review_quarantine'), {'release': [entry.id]}, content_type='application/json',
+        ))
+        self.assertEqual(snapshot.series(snapshot.get_city(self.city.id))[1].tolist(), [1000, 1000, 1000, 5000])
+
+    def test_admin_actions(self):
+        self.assertInvalidatedOnCommit(lambda: self.client.post(
+            reverse('admin:analytics_city_changelist'), {'action': 'clear_locations', '_selected_action': [self.city.id]},
+        ), cities=True)
+
+        snapshot = self.assertInvalidatedOnCommit(lambda: self.client.post(
+            reverse('admin:analytics_populationdata_changelist'),
+            {'action': 'delete_rows', '_selected_action': [self.rows[0].id]},
+        ))
+        self.assertEqual(snapshot.series(snapshot.get_city(self.city.id))[0].tolist(), [2001, 2002])
+
+    def test_observations(self):
+        snapshot = self.assertInvalidatedOnCommit(lambda: self.client.post(
+            reverse('add_population_observations'),
+            {'observations': [{'city_id': self.city.id, 'year': 2003, 'month': 6, 'population_count': 1100}]},
+            content_type='application/json',
+        ))
+        record = snapshot.get_city(self.city.id)
+        self.assertEqual(snapshot.observation_populations[snapshot.observation_rows(record)].tolist(), [1100])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CityCacheTests(TestCase):
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.city = City.objects.create(city_name='Cached City', region='Region 1')
+
+    def test_lookups_return_copies_and_miss_on_bad_ids(self):
+        for city_id in ('abc', None, '', 10 ** 9):
+            self.assertIsNone(city_cache.get_city(city_id))
+        self.assertIsNone(city_cache.get_city_by_name('Uncached City'))
+
+        city = city_cache.get_city(str(self.city.id))
+        self.assertEqual(city_cache.get_city_by_name('CACHED city').id, city.id)
+        city.city_name = 'Mutated'
+        self.assertEqual(city_cache.get_city(self.city.id).city_name, 'Cached City')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.city.city_name = 'Renamed City'
+            self.city.save()
+        self.assertIsNone(city_cache.get_city_by_name('cached city'))
+        self.assertEqual(city_cache.get_city_by_name('renamed city').id, self.city.id)
+
+    def test_a_duplicate_name_in_another_case_is_rejected(self):
+        self.client.force_login(User.objects.get(username='superadmin'))
+        response = self.client.post(reverse('add_city'), {'city_name': 'CACHED CITY'}, content_type='application/json')
+        self.assertEqual((response.status_code, response.json()), (400, {'error': 'City already exists.'}))
+
+        # A rename the cache never heard of (update() sends no signals) is still caught by the query
+        City.objects.filter(pk=self.city.pk).update(city_name='Quiet Rename')
+        self.assertIsNone(city_cache.get_city_by_name('quiet rename'))
+        response = self.client.post(reverse('add_city'), {'city_name': 'QUIET rename'}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(City.objects.filter(city_name__iexact='quiet rename').count(), 1)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SearchTests(TestCase):
+    def setUp(self):
+        names = [
+            ('Cagayan de Oro', 'Region X'), ('Oroquieta', 'Region X'), ('Orani', 'Region III'),
+            ('San Fernando', 'Region III'), ('San Fernando-La Union', 'Region I'),
+        ]
+        self.index = CitySearchIndex([
+            CityRecord(index, 100 + index, name, region) for index, (name, region) in enumerate(names)
+        ])
+
+    def names(self, *args, **kwargs):
+        return [record.name for record in self.index.search(*args, **kwargs)]
+
+    def test_prefixes_come_before_later_words_and_each_city_once(self):
+        self.assertEqual(self.names('oro'), ['Oroquieta', 'Cagayan de Oro'])
+        self.assertEqual(self.names('  SAN f '), ['San Fernando', 'San Fernando-La Union'])
+        # Later words, split on hyphens too
+        self.assertEqual(self.names('union'), ['San Fernando-La Union'])
+        self.assertEqual(self.names('fernando'), ['San Fernando', 'San Fernando-La Union'])
+        self.assertEqual(self.names('o', limit=2), ['Orani', 'Oroquieta'])
+
+    def test_blank_queries_and_unknown_regions_match_nothing(self):
+        self.assertEqual(self.names(''), [])
+        self.assertEqual(self.names('   '), [])
+        self.assertEqual(self.names('zz'), [])
+        self.assertEqual(self.names('oro', region='Region XIII'), [])
+        self.assertEqual(self.names('o', region='region iii'), ['Orani'])
+
+    def test_the_endpoint_validates_and_bounds_the_limit(self):
+        response = self.client.get(reverse('cities-search'), {'q': 'a', 'limit': 'ten'})
+        self.assertEqual((response.status_code, response.json()), (400, {'error': 'limit must be an integer.'}))
+        self.assertEqual(self.client.get(reverse('cities-search')).json(), [])
+
+        City.objects.bulk_create(City(city_name=f'Bounded City {number}', region='Region 1') for number in range(60))
+        bump_version()
+        for limit, expected in ((0, 1), (-5, 1), (20, 20), (10 ** 6, MAX_SEARCH_RESULTS)):
+            response = self.client.get(reverse('cities-search'), {'q': 'bounded', 'limit': limit})
+            self.assertEqual(len(response.json()), expected)
+
+
+class LoadTestCommandTests(TestCase):
+    def test_mix_parsing(self):
+        command = LoadTestCommand()
+        self.assertEqual(command.parse_mix('cities-list:2, city-detail'), {'cities-list': 2.0, 'city-detail': 1.0})
+        self.assertEqual(command.parse_mix('changes:0,cities-search:0.5'), {'changes': 0.0, 'cities-search': 0.5})
+        for spec, message in (
+            ('', "Unsupported endpoint in --mix: ''"),
+            ('city-add:1', "Unsupported endpoint in --mix: 'city-add'"),
+            ('cities-list:x', "Invalid weight in --mix: 'cities-list:x'"),
+            ('cities-list:-1', "Invalid weight in --mix: 'cities-list:-1'"),
+            ('cities-list:nan', "Invalid weight in --mix: 'cities-list:nan'"),
+            ('cities-list:0,changes:0', 'At least one --mix weight must be positive.'),
+        ):
+            with self.subTest(spec=spec), self.assertRaisesMessage(CommandError, message):
+                command.parse_mix(spec)
+
+    def test_setup_errors_stop_before_a_server_starts(self):
+        with mock.patch.object(LoadTestCommand, 'start_server') as start_server:
+            with self.assertRaisesMessage(CommandError, "User 'nobody' not found"):
+                call_command('loadtest', user='nobody')
+            City.objects.all().delete()
+            with self.assertRaisesMessage(CommandError, 'No cities in the database'):
+                call_command('loadtest')
+        start_server.assert_not_called()
+
+    def test_summaries_count_failures_as_errors(self):
+        rows = [('changes', False, 200, 0.001 * latency) for latency in range(1, 101)]
+        rows += [('changes', True, 503, 0.2), ('changes', True, None, 0.3)]
+        summary = LoadTestCommand.summarize(rows, 2.0)
+        self.assertEqual((summary['requests'], summary['errors'], summary['throughput']), (102, 2, 51.0))
+        self.assertEqual(summary['statuses'], {'200': 100, '503': 1, 'None': 1})
+        self.assertEqual(summary['latency_ms']['max'], 300.0)
+        self.assertEqual(LoadTestCommand.summarize([], 1.0)['latency_ms'], dict.fromkeys(('p50', 'p95', 'p99', 'mean', 'max'), 0))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ForecastArchiveTests(TestCase):
+    def setUp(self):
+        self.superadmin = User.objects.get(username='superadmin')
+        self.city = City.objects.create(city_name='Archived City', region='Region 1')
+        self.unobserved = City.objects.create(city_name='Unobserved City', region='Region 1')
+        PopulationData.objects.bulk_create(
+            PopulationData(city=self.city, year=year, population_count=1000 * year, created_by=self.superadmin)
+            for year in range(2018, 2024)
+        )
+
+    def archive(self):
+        bump_version()
+        return [row.city_id for row in archive_forecasts(DatasetSnapshot.build())]
+
+    def test_only_changed_histories_are_archived_again(self):
+        first = self.archive()
+        self.assertIn(self.city.id, first)
+        self.assertNotIn(self.unobserved.id, first)
+        self.assertEqual(self.archive(), [])
+
+        PopulationData.objects.create(city=self.city, year=2024, population_count=1, created_by=self.superadmin)
+        self.assertEqual(self.archive(), [self.city.id])
+        self.assertEqual(ForecastArchive.objects.filter(city=self.city).values('basis').distinct().count(), 2)
+
+    def test_errors_follow_the_actual_figure(self):
+        forecast = ForecastArchive.objects.create(
+            city=self.city, engine=ForecastArchive.ENGINE_LINEAR, target_year=2030, base_year=2023, basis=0,
+            predicted_population=1000,
+        )
+
+        def errors():
+            forecast.refresh_from_db()
+            return forecast.actual_population, forecast.error, forecast.abs_pct_error
+
+        row = PopulationData.objects.create(city=self.city, year=2030, population_count=800, created_by=self.superadmin)
+        self.assertEqual(errors(), (800, 200, 25.0))
+        # No percentage error against a zero actual
+        row.population_count = 0
+        row.save()
+        self.assertEqual(errors(), (0, 1000, None))
+        row.delete()
+        self.assertEqual(errors(), (None, None, None))
+
+    def test_accuracy_rejects_unknown_filters(self):
+        url = reverse('forecast-accuracy')
+        for params, message in (
+            ({'group_by': 'country'}, 'group_by must list any of'),
+            ({'group_by': ','}, 'group_by must list any of'),
+            ({'engine': 'prophet'}, 'engine must be one of linear'),
+            ({'target_year': 'next'}, 'city_id and target_year must be integers.'),
+        ):
+            with self.subTest(params=params):
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(message, response.json()['error'])
+
+        self.archive()
+        results = self.client.get(url, {'group_by': 'city,city', 'city_id': self.city.id}).json()
+        self.assertEqual(results['group_by'], ['city'])
+        self.assertEqual([(row['city'], row['forecasts'], row['evaluated'], row['mae']) for row in results['results']],
+                         [('Archived City', 1, 0, None)])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RendererTests(TestCase):
+    MSGPACK = 'application/msgpack'
+    ARROW = 'application/vnd.apache.arrow.stream'
+
+    def setUp(self):
+        superadmin = User.objects.get(username='superadmin')
+        self.city = City.objects.create(city_name='Packed City', region='Region 1')
+        self.empty = City.objects.create(city_name='Unpacked City', region='Region 1')
+        PopulationData.objects.bulk_create(
+            PopulationData(city=self.city, year=year, population_count=1000 * year, created_by=superadmin)
+            for year in (2000, 2001, 2004)
+        )
+        bump_version()
+
+    def test_binary_formats_carry_the_json_rows(self):
+        for city in (self.city, self.empty):
+            url = reverse('city-detail', kwargs={'city_id': city.id})
+            expected = self.client.get(url, {'stream': 'false'}).json()
+            packed = self.client.get(url, HTTP_ACCEPT=self.MSGPACK)
+            self.assertEqual(packed['Content-Type'], self.MSGPACK)
+            self.assertEqual(msgpack.unpackb(packed.content), expected)
+
+            table = pa.ipc.open_stream(self.client.get(url, HTTP_ACCEPT=self.ARROW).content).read_all()
+            row = table.to_pylist()[0]
+            self.assertEqual({key: row[key] for key in ('id', 'name', 'predicted_year')},
+                             {key: expected[key] for key in ('id', 'name', 'predicted_year')})
+            self.assertEqual(row['history']['year'], [entry['year'] for entry in expected['history']])
+            self.assertEqual(row['history']['growth'], [entry['growth'] for entry in expected['history']])
+
+    def test_unsupported_formats_and_errors(self):
+        url = reverse('city-detail', kwargs={'city_id': self.city.id})
+        response = self.client.get(url, HTTP_ACCEPT='application/xml')
+        self.assertEqual(response.status_code, 406)
+        self.assertEqual(self.client.get(url, {'format': 'xml'}).status_code, 404)
+
+        # Errors keep the client's format
+        missing = reverse('city-detail', kwargs={'city_id': 10 ** 9})
+        response = self.client.get(missing, HTTP_ACCEPT=self.MSGPACK)
+        self.assertEqual((response.status_code, msgpack.unpackb(response.content)), (404, {'error': 'City not found'}))
+        response = self.client.get(url, {'max_points': 'x'}, HTTP_ACCEPT=self.ARROW)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(pa.ipc.open_stream(response.content).read_all().to_pylist(),
+                         [{'error': 'max_points must be an integer.'}])
+
+    def test_an_empty_arrow_history_and_response_metadata(self):
+        snapshot = get_snapshot()
+        table = cities_table(snapshot, [snapshot.get_city(self.empty.id), snapshot.get_city(self.city.id)])
+        self.assertEqual([len(history['year']) for history in table.column('history').to_pylist()], [0, 3])
+        self.assertEqual(cities_table(snapshot, []).num_rows, 0)
+
+        table = to_table({'cities': [{'id': 1, 'history': []}], 'missing': [7]})
+        self.assertEqual(json.loads(table.schema.metadata[b'missing']), [7])
+        self.assertEqual(to_table(5).to_pylist(), [{'value': 5}])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class StreamingTests(TestCase):
+    def test_the_stream_matches_the_buffered_body(self):
+        superadmin = User.objects.get(username='superadmin')
+        # Separators JSON allows raw but DRF escapes, a non-ASCII name and a city without rows
+        city = City.objects.create(city_name='Line\u2028Para\u2029São', region='Região 1')
+        City.objects.create(city_name='Empty City', region='Region 2')
+        PopulationData.objects.bulk_create(
+            PopulationData(city=city, year=year, population_count=1000 + year, created_by=superadmin)
+            for year in (2000, 2001, 2005)
+        )
+        bump_version()
+
+        buffered = self.client.get(reverse('cities-list'), {'stream': 'false'})
+        self.assertFalse(buffered.streaming)
+        # Small chunks, so cities are split across them
+        with mock.patch('analytics.streaming.CHUNK_SIZE', 16):
+            streamed = self.client.get(reverse('cities-list'))
+            self.assertTrue(streamed.streaming)
+            chunks = list(streamed.streaming_content)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b''.join(chunks), buffered.content)
+        self.assertIn(b'\\u2028', buffered.content)
+        self.assertEqual(
+            [entry['history'] for entry in buffered.json() if entry['id'] == city.id][0][0]['growth'], None,
+        )
+
+    def test_errors_and_indented_json_are_not_streamed(self):
+        response = self.client.get(reverse('cities-list'), {'max_points': 1})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.streaming)
+        self.assertIn('max_points', response.json()['error'])
+
+        response = self.client.get(reverse('cities-list'), HTTP_ACCEPT='application/json; indent=2')
+        self.assertFalse(response.streaming)
+        self.assertIn(b'\n  ', response.content)
+
+    def test_an_empty_object_stream(self):
+        self.assertEqual(b''.join(iter_object_json({}, 'cities', iter([]), dict)), b'{"cities":[]}')
+        self.assertEqual(
+            b''.join(iter_object_json({'a': 1}, 'cities', iter([{'b': 2}]), lambda: {'c': None})),
+            b'{"a":1,"cities":[{"b":2}],"c":null}',
+        )
+
+
+def synthetic_snapshot(seed, size=200):
+    """A snapshot of `size` cities with random yearly rows and sub-annual observations."""
+    generator = np.random.default_rng(seed)
+    cities = [CityRecord(index, index + 1, f'City {index}', f'Region {index % 5}') for index in range(size)]
+    city_index, years, populations = [], [], []
+    observation_index, months, observed = [], [], []
+    for index in range(size):
+        # Cities without rows, with one row, with every row in the same year, and longer ones
+        count = [0, 1, 3][index] if index < 3 else int(generator.integers(2, 40))
+        row_years = np.full(count, 2000) if index == 2 else np.sort(generator.choice(np.arange(1950, 2025), count))
+        city_index += [index] * count
+        years += row_years.tolist()
+        populations += generator.integers(0, 10 ** 7, count).tolist()
+        # Monthly counts, some in years that have a yearly row; none for the first city
+        observed_count = int(generator.integers(0, 30)) if index else 0
+        observation_months = np.sort(generator.choice(np.arange(1990 * 12, 2030 * 12), observed_count))
+        observation_index += [index] * len(observation_months)
+        months += observation_months.tolist()
+        observed += generator.integers(0, 10 ** 7, len(observation_months)).tolist()
+
+    observation_offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(observation_index, minlength=size), out=observation_offsets[1:])
+    return DatasetSnapshot(
+        None, cities, np.arange(len(years), dtype=np.int64), np.array(city_index, dtype=np.int32),
+        np.array(years, dtype=np.int64), np.array(populations, dtype=np.int64),
+        np.zeros(len(years), dtype=np.int32), ['Seeded Data'],
+        observations=(
+            observation_offsets, np.array(months, dtype=np.int64), np.array(observed, dtype=np.int64),
+            np.zeros(len(months), dtype=np.int32),
+        ),
+    )
+
+
+class ForecastTests(TestCase):
+    def test_all_city_fit_matches_the_per_city_fit(self):
+        snapshot = synthetic_snapshot(33)
+        expected = [predict_next_year(*snapshot.annual_series(record)) for record in snapshot.cities]
+
+        self.assertEqual(snapshot.forecast_many(snapshot.cities), expected)
+        _, predicted_years, predicted_populations = snapshot.forecast_arrays()
+        self.assertEqual(predicted_years[0], -1)
+        self.assertEqual(
+            [(year if year >= 0 else None, population) for year, population in
+             zip(predicted_years.tolist(), predicted_populations.tolist())],
+            expected,
+        )
+        # Single-city forecasts agree once the arrays exist, and before
+        self.assertEqual([snapshot.forecast(record) for record in snapshot.cities], expected)
+        self.assertEqual([synthetic_snapshot(33).forecast(record) for record in snapshot.cities[:20]], expected[:20])
+
+
+class SimulationTests(TestCase):
+    def test_bands_are_ordered_and_cover_the_horizon(self):
+        snapshot = synthetic_snapshot(40, size=30)
+        result = simulate(snapshot, horizon=5, paths=200, seed=1)
+
+        bands = [city['bands'] for city in result['cities']] + [region['bands'] for region in result['regions']]
+        self.assertEqual(len(result['regions']), 5)
+        for city in result['cities']:
+            self.assertEqual(city['years'], list(range(city['latest_year'] + 1, city['latest_year'] + 6)))
+        for band in bands:
+            self.assertEqual(list(band), [f'p{q}' for q in PERCENTILES])
+            values = np.array(list(band.values()))
+            self.assertEqual(values.shape, (len(PERCENTILES), 5))
+            self.assertTrue((np.diff(values, axis=0) >= 0).all())
+            self.assertTrue((values >= 0).all())
+
+    def test_a_seed_gives_the_same_bands(self):
+        snapshot = synthetic_snapshot(40, size=30)
+        first = simulate(snapshot, horizon=5, paths=200, seed=7)
+        self.assertEqual(simulate(snapshot, horizon=5, paths=200, seed=7), first)
+        self.assertNotEqual(simulate(snapshot, horizon=5, paths=200, seed=8), first)
+
+    def test_growth_across_a_gap_is_annualized(self):
+        # Doubling over ten years is 7.18% a year, not 100% in one
+        snapshot = DatasetSnapshot(
+            None, [CityRecord(0, 1, 'Gap City', 'Region 1')], np.array([1, 2]), np.array([0, 0], dtype=np.int32),
+            np.array([2000, 2010]), np.array([1000000, 2000000]), np.zeros(2, dtype=np.int32), ['Census'],
+        )
+        city = simulate(snapshot, horizon=2, paths=100, seed=1)['cities'][0]
+        for q in PERCENTILES:
+            self.assertAlmostEqual(city['bands'][f'p{q}'][0] / 2000000, 2 ** 0.1, places=4)
+            self.assertAlmostEqual(city['bands'][f'p{q}'][1] / 2000000, 2 ** 0.2, places=4)
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        ANALYTICS_SIMULATION_MEMORY_MB=1,
+    )
+    def test_runs_stay_within_the_memory_budget(self):
+        snapshot = synthetic_snapshot(40, size=30)
+        budget = 1024 * 1024
+        # 5 regions x 10 years x 2000 paths of float32 totals (400 KB), and their sorted copy
+        simulation = Simulation(snapshot, horizon=10, paths=2000, seed=1)
+        self.assertEqual(simulation.totals.dtype, np.float32)
+        self.assertLessEqual(simulation.totals.nbytes + simulation.chunk_size * 10 * 2000 * 4 * ARRAYS_PER_CHUNK, budget)
+        self.assertLessEqual(2 * simulation.totals.nbytes, budget)
+        self.assertLess(simulation.chunk_size, len(simulation.records))
+        self.assertEqual(len(simulation.result()['regions']), 5)
+
+        # The totals alone would fit (650 KB), not with their sorted copy
+        with self.assertRaises(ValueError):
+            Simulation(snapshot, horizon=13, paths=2500)
+        # One region's totals and their sorted copy would fit (480 KB), not one city's 960 KB besides them
+        single = DatasetSnapshot(
+            None, [CityRecord(0, 1, 'Only City', 'Region 1')], np.array([1, 2]), np.array([0, 0], dtype=np.int32),
+            np.array([2000, 2001]), np.array([1000, 1100]), np.zeros(2, dtype=np.int32), ['Census'],
+        )
+        with self.assertRaises(ValueError):
+            Simulation(single, horizon=10, paths=6000)
+        self.assertEqual(Simulation(single, horizon=10, paths=4000).chunk_size, 1)
+
+        response = self.client.get(reverse('simulate'), {'horizon': 50, 'paths': 10000})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ANALYTICS_SIMULATION_MEMORY_MB', response.json()['error'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AreaRollupTests(TestCase):
+    def assertRollupsMatchRows(self):
+        """Every stored total against the rows of the area's subtree, summed from scratch."""
+        expected = Counter()
+        rows = PopulationData.objects.exclude(area=None).values_list('area__path', 'year', 'population_count')
+        areas = list(Area.objects.values_list('id', 'path'))
+        for path, year, population in rows:
+            for area_id, area_path in areas:
+                if path.startswith(area_path):
+                    expected[(area_id, year)] += population
+        stored = {(area_id, year): total for area_id, year, total in
+                  AreaPopulation.objects.exclude(total=0).values_list('area_id', 'year', 'total')}
+        self.assertEqual(stored, {key: total for key, total in expected.items() if total})
+
+    def test_rollups_follow_every_write(self):
+        superadmin = User.objects.get(username='superadmin')
+        country = create_area('Philippines', 'country')
+        luzon = create_area('Region I', 'region', country)
+        visayas = create_area('Region VII', 'region', country)
+        province = create_area('Pangasinan', 'province', luzon)
+        city = City.objects.create(city_name='Rollup City', region='Region I', area=province)
+        other = City.objects.create(city_name='Other City', region='Region I', area=luzon)
+
+        # Create: city rows, and a row attached to an area directly
+        rows = [
+            PopulationData.objects.create(city=city, year=year, population_count=1000 + year, created_by=superadmin)
+            for year in (2019, 2020, 2021)
+        ]
+        PopulationData.objects.create(city=other, year=2020, population_count=500, created_by=superadmin)
+        PopulationData.objects.create(area=visayas, year=2020, population_count=70, created_by=superadmin)
+        self.assertRollupsMatchRows()
+        self.assertEqual(AreaPopulation.objects.get(area=country, year=2020).total, 3020 + 500 + 70)
+
+        # Update: the count, then the year
+        rows[0].population_count = 5
+        rows[0].save()
+        rows[1].year = 2022
+        rows[1].save()
+        self.assertRollupsMatchRows()
+
+        # A city moved to another area carries its rows along, as does a moved subtree
+        city.area = visayas
+        city.save()
+        self.assertRollupsMatchRows()
+        move_area(province, visayas)
+        other.area = province
+        other.save()
+        self.assertRollupsMatchRows()
+
+        # Delete: one row (loaded again, as the views do, since the move updated its area), then
+        # a city with its rows (the cascade)
+        PopulationData.objects.get(pk=rows[2].pk).delete()
+        self.assertRollupsMatchRows()
+        city.delete()
+        self.assertRollupsMatchRows()
+        self.assertEqual(AreaPopulation.objects.get(area=country, year=2020).total, 500 + 70)
+
+
+SCREENING_POLICY = {'flag': 4.0, 'quarantine': 8.0, 'reject': None}
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    ANALYTICS_SCREENING_POLICY=SCREENING_POLICY,
+)
+class ScreeningTests(TestCase):
+    def trends(self):
+        # A steady city, and one with too short a history to screen
+        years = list(range(2000, 2010)) + [2000, 2001]
+        populations = [100000 + 1000 * offset + (offset % 3) * 50 for offset in range(10)] + [500, 900]
+        snapshot = DatasetSnapshot(
+            None, [CityRecord(0, 1, 'Steady City', 'Region 1'), CityRecord(1, 2, 'New City', 'Region 1')],
+            np.arange(12), np.array([0] * 10 + [1] * 2, dtype=np.int32), np.array(years),
+            np.array(populations), np.zeros(12, dtype=np.int32), ['Census'],
+        )
+        return snapshot.city_trends()
+
+    def test_actions_start_at_the_policy_thresholds(self):
+        trends = self.trends()
+        candidates = [110000, 112000, 116000, 125000]
+        scores = screen(trends, [1] * 4, [2010] * 4, candidates, {'flag': None, 'quarantine': None}).score
+        self.assertTrue((np.diff(scores) > 0).all())
+
+        def actions(policy):
+            return screen(trends, [1] * 4, [2010] * 4, candidates, policy).actions.tolist()
+
+        # A score equal to a threshold takes that threshold's action, one just below does not
+        policy = {'flag': scores[1], 'quarantine': scores[2], 'reject': scores[3]}
+        self.assertEqual(actions(policy), [PASS, FLAG, QUARANTINE, REJECT])
+        self.assertEqual(actions({**policy, 'reject': None}), [PASS, FLAG, QUARANTINE, QUARANTINE])
+        self.assertEqual(actions({**policy, 'flag': np.nextafter(scores[1], np.inf)})[:2], [PASS, PASS])
+
+        # Short histories and unknown cities are never screened
+        unscreened = screen(trends, [2, 3, None], [2002, 2002, 2002], [10 ** 9] * 3, {'flag': 0.0})
+        self.assertEqual(unscreened.actions.tolist(), [PASS] * 3)
+        self.assertTrue(np.isnan(unscreened.score).all())
+
+    def test_a_quarantined_write_is_held_until_released(self):
+        superadmin = User.objects.get(username='superadmin')
+        city = City.objects.create(city_name='Screened City', region='Region 1')
+        PopulationData.objects.bulk_create(
+            PopulationData(city=city, year=2000 + offset, population_count=100000 + 1000 * offset, created_by=superadmin)
+            for offset in range(10)
+        )
+        bump_version()
+        self.client.force_login(superadmin)
+
+        response = self.client.post(
+            reverse('add_population_data'), {'city_id': city.id, 'year': 2010, 'population_count': 400000},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 202)
+        entry = QuarantinedPopulation.objects.get(pk=response.json()['quarantine_id'])
+        self.assertGreaterEqual(entry.score, SCREENING_POLICY['quarantine'])
+        self.assertFalse(PopulationData.objects.filter(city=city, year=2010).exists())
+
+        since = changes_since(None)['token']
+        response = self.client.post(reverse('review_quarantine'), {'release': [entry.id]}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        row = PopulationData.objects.get(city=city, year=2010)
+        self.assertEqual((row.population_count, row.anomaly_score), (400000, entry.score))
+        self.assertEqual(response.json()['population_ids'], [row.id])
+        entry.refresh_from_db()
+        self.assertEqual((entry.status, entry.reviewed_by_id), ('released', superadmin.id))
+        self.assertEqual([item['Historyid'] for item in changes_since(since)['population']], [row.id])
+
+        # Reviewing it again changes nothing
+        response = self.client.post(reverse('review_quarantine'), {'release': [entry.id]}, content_type='application/json')
+        self.assertEqual(response.json()['population_ids'], [])
+        self.assertEqual(PopulationData.objects.filter(city=city, year=2010).count(), 1)
+
+    def test_one_row_is_released_once(self):
+        superadmin = User.objects.get(username='superadmin')
+        area = create_area('Screened Province', 'province')
+        city = City.objects.create(city_name='Twice City', region='Region 1', area=area)
+        row = PopulationData.objects.create(city=city, year=2010, population_count=1000, created_by=superadmin)
+        entries = [
+            QuarantinedPopulation.objects.create(
+                city=city, population=row, year=2010, population_count=count, score=9.0, reason='Test', created_by=superadmin,
+            )
+            for count in (5000, 7000)
+        ]
+        self.client.force_login(superadmin)
+
+        # The same entry listed twice is released once
+        response = self.client.post(
+            reverse('review_quarantine'), {'release': [entries[0].id, entries[0].id]}, content_type='application/json',
+        )
+        self.assertEqual(response.json()['population_ids'], [row.id])
+        self.assertEqual(AreaPopulation.objects.get(area=area, year=2010).total, 5000)
+
+        # Two held changes of one row cannot be released together
+        entries[0].status = 'pending'
+        entries[0].save()
+        response = self.client.post(
+            reverse('review_quarantine'), {'release': [entry.id for entry in entries]}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['population_ids'], [row.id])
+        self.assertEqual(AreaPopulation.objects.get(area=area, year=2010).total, 5000)
+        self.assertEqual(QuarantinedPopulation.objects.filter(status='pending').count(), 2)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ResamplingTests(TestCase):
+    def test_yearly_only_series_are_unchanged(self):
+        superadmin = User.objects.get(username='superadmin')
+        city = City.objects.create(city_name='Yearly City', region='Region 1')
+        counts = [100000 + 2500 * offset - (offset % 4) * 900 for offset in range(12)]
+        PopulationData.objects.bulk_create(
+            PopulationData(city=city, year=1990 + 2 * offset, population_count=count, source='Census', created_by=superadmin)
+            for offset, count in enumerate(counts)
+        )
+        bump_version()
+        snapshot = DatasetSnapshot.build()
+        record = snapshot.get_city(city.id)
+        history = snapshot.history(record)
+
+        years, populations = snapshot.annual_series(record)
+        self.assertEqual((years.tolist(), populations.tolist()), ([1990 + 2 * offset for offset in range(12)], counts))
+        self.assertEqual(snapshot.forecast(record), predict_next_year(years, populations))
+        for frequency, period in (('annual', None), ('quarterly', 4), ('monthly', 12)):
+            points = self.client.get(
+                reverse('city-series', kwargs={'city_id': city.id}), {'frequency': frequency},
+            ).json()['points']
+            self.assertEqual(
+                [(point['year'], point['period'], point['population'], point['growth'], point['kind']) for point in points],
+                [(entry['year'], period, entry['population'], entry['growth'], 'yearly') for entry in history],
+            )
+
+    def test_lttb_keeps_the_endpoints_within_max_points(self):
+        generator = np.random.default_rng(46)
+        for size in (1, 2, 3, 4, 10, 57, 500):
+            x = np.cumsum(generator.integers(1, 4, size))
+            y = generator.normal(0, 1000, size).cumsum()
+            for threshold in range(0, min(size + 3, 60)):
+                kept = lttb(x, y, threshold)
+                self.assertEqual(len(kept), min(max(threshold, 0), size))
+                self.assertTrue((np.diff(kept) > 0).all())
+                if threshold >= 2:
+                    self.assertEqual((kept[0], kept[-1]), (0, size - 1))
+
+    def test_history_endpoints_downsample_to_max_points(self):
+        superadmin = User.objects.get(username='superadmin')
+        city = City.objects.create(city_name='Long City', region='Region 1')
+        generator = random.Random(46)
+        PopulationData.objects.bulk_create(
+            PopulationData(city=city, year=1700 + offset, population_count=generator.randint(1000, 10 ** 6),
+                           created_by=superadmin)
+            for offset in range(300)
+        )
+        bump_version()
+        snapshot = DatasetSnapshot.build()
+        record = snapshot.get_city(city.id)
+        full = {entry['year']: entry for entry in snapshot.history(record)}
+        for max_points in (3, 10, 299, 300, 1000):
+            history = snapshot.history(record, max_points)
+            points = self.client.get(
+                reverse('city-series', kwargs={'city_id': city.id}), {'max_points': max_points},
+            ).json()['points']
+            for kept in (history, points):
+                self.assertEqual(len(kept), min(max_points, 300))
+                self.assertEqual((kept[0]['year'], kept[-1]['year']), (1700, 1999))
+                # Growth is computed before downsampling, so kept points keep their full-history growth
+                self.assertEqual([entry['growth'] for entry in kept], [full[entry['year']]['growth'] for entry in kept])
+            self.assertEqual(history, [full[entry['year']] for entry in history])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class GapFillTests(TestCase):
+    def test_missing_years_are_interpolated_within_each_city(self):
+        # A three-year gap, a single row, and a gap starting at 0 (log falls back to linear)
+        city_index = np.array([0, 0, 0, 1, 2, 2])
+        years = np.array([2000, 2003, 2004, 1990, 2000, 2002])
+        populations = np.array([1000, 8000, 9000, 50, 0, 90])
+        expected = {
+            'linear': [1000, 3333, 5667, 8000, 9000, 50, 0, 45, 90],
+            'log': [1000, 2000, 4000, 8000, 9000, 50, 0, 45, 90],
+        }
+        for method, values in expected.items():
+            source, filled_years, filled, imputed = fill_gaps(city_index, years, populations, method)
+            self.assertEqual(city_index[source].tolist(), [0, 0, 0, 0, 0, 1, 2, 2, 2])
+            self.assertEqual(filled_years.tolist(), [2000, 2001, 2002, 2003, 2004, 1990, 2000, 2001, 2002])
+            self.assertEqual(filled.tolist(), values)
+            self.assertEqual(imputed.tolist(), [False, True, True, False, False, False, False, True, False])
+
+    def test_filled_histories_flag_imputed_years_and_write_nothing(self):
+        superadmin = User.objects.get(username='superadmin')
+        city = City.objects.create(city_name='Gappy City', region='Region 1')
+        PopulationData.objects.bulk_create(
+            PopulationData(city=city, year=year, population_count=count, source='Census', created_by=superadmin)
+            for year, count in ((2000, 1000), (2003, 8000), (2004, 9000))
+        )
+        bump_version()
+        stored = list(PopulationData.objects.order_by('id').values_list('id', 'city_id', 'year', 'population_count'))
+
+        for method, imputed_counts in (('linear', [3333, 5667]), ('log', [2000, 4000])):
+            history = self.client.get(
+                reverse('city-detail', kwargs={'city_id': city.id}), {'fill': method},
+            ).json()['history']
+            self.assertEqual([entry['year'] for entry in history], [2000, 2001, 2002, 2003, 2004])
+            self.assertEqual([entry['imputed'] for entry in history], [False, True, True, False, False])
+            imputed = [entry for entry in history if entry['imputed']]
+            self.assertEqual([entry['population'] for entry in imputed], imputed_counts)
+            self.assertEqual([entry['Historyid'] for entry in imputed], [None, None])
+            self.assertEqual({entry['source'] for entry in imputed}, {f'Imputed ({method})'})
+            # Growth is per year across the filled gap
+            self.assertEqual(history[1]['growth'], round((imputed_counts[0] - 1000) / 1000 * 100, 2))
+
+        unfilled = self.client.get(reverse('city-detail', kwargs={'city_id': city.id})).json()['history']
+        self.assertEqual([entry['year'] for entry in unfilled], [2000, 2003, 2004])
+        self.assertNotIn('imputed', unfilled[0])
+        self.assertEqual(
+            list(PopulationData.objects.order_by('id').values_list('id', 'city_id', 'year', 'population_count')), stored,
+        )
+
+
+class RankingTests(TestCase):
+    def test_top_matches_a_full_sort(self):
+        # Few distinct counts, so most metrics tie; some cities have no rows at all
+        generator = np.random.default_rng(48)
+        size = 80
+        cities = [CityRecord(index, 10 + 7 * index, f'City {index}', f'Region {index % 3}') for index in range(size)]
+        counts = generator.integers(0, 4, size)
+        city_index = np.repeat(np.arange(size), counts).astype(np.int32)
+        years = np.concatenate([np.arange(2000, 2000 + count) for count in counts]).astype(np.int64)
+        populations = generator.choice([0, 100, 200, 300], len(years)).astype(np.int64)
+        snapshot = DatasetSnapshot(None, cities, np.arange(len(years)), city_index, years, populations,
+                                   np.zeros(len(years), dtype=np.int32), ['Census'])
+        rankings = snapshot.rankings()
+
+        ids = np.array([record.id for record in cities])
+        with_data = [index for index in range(size) if counts[index]]
+        latest = {index: populations[city_index == index][-1] for index in with_data}
+        first = {index: populations[city_index == index][0] for index in with_data}
+        self.assertEqual(
+            rankings.metrics['absolute_change'][with_data].tolist(), [latest[i] - first[i] for i in with_data],
+        )
+        self.assertEqual(
+            rankings.metrics['predicted_population'][with_data].tolist(),
+            [snapshot.forecast(cities[index])[1] for index in with_data],
+        )
+
+        for metric in METRICS:
+            values = rankings.metrics[metric]
+            for region in (None, 'Region 1', 'Region 7'):
+                candidates = [index for index in with_data if region is None or cities[index].region == region]
+                for ascending in (False, True):
+                    ordered = sorted(
+                        candidates, key=lambda index: (values[index] if ascending else -values[index], ids[index]),
+                    )
+                    for k in (0, 1, 5, 20, len(candidates) - 1, len(candidates), len(candidates) + 5):
+                        self.assertEqual(
+                            rankings.top(metric, k, region, ascending).tolist(), ordered[:max(k, 0)],
+                            f'{metric} k={k} region={region} ascending={ascending}',
+                        )
+
+
+class SimilarityTests(TestCase):
+    def brute_force(self, snapshot):
+        """Each city's (distance, id, index, shared years) to every other city, nearest first."""
+        filled = snapshot.filled('log')
+        last_year = int(filled.years.max())
+        growth = [{} for _ in snapshot.cities]
+        for position in range(1, len(filled.years)):
+            city, year = int(filled.city_index[position]), int(filled.years[position])
+            previous, current = int(filled.populations[position - 1]), int(filled.populations[position])
+            if (filled.city_index[position - 1] == city and filled.years[position - 1] == year - 1
+                    and previous > 0 and current > 0 and year > last_year - WINDOW_YEARS):
+                growth[city][year] = 100 * math.log(current / previous)
+
+        neighbours = []
+        for record in snapshot.cities:
+            found = []
+            for other in snapshot.cities:
+                shared = growth[record.index].keys() & growth[other.index].keys()
+                if other is record or len(shared) < MIN_OVERLAP:
+                    continue
+                squared = sum((growth[record.index][year] - growth[other.index][year]) ** 2 for year in shared)
+                found.append((math.sqrt(squared / len(shared)), other.id, other.index, len(shared)))
+            neighbours.append(sorted(found)[:STORED_NEIGHBOURS])
+        return neighbours
+
+    def assertMatchesBruteForce(self, index, expected):
+        for city, nearest in enumerate(expected):
+            found = index.similar(city, STORED_NEIGHBOURS)
+            self.assertEqual([neighbour for neighbour, _, _ in found], [entry[2] for entry in nearest])
+            self.assertEqual([shared for _, _, shared in found], [entry[3] for entry in nearest])
+            np.testing.assert_allclose([distance for _, distance, _ in found], [entry[0] for entry in nearest],
+                                       rtol=1e-6, atol=1e-9)
+
+    def test_exact_search_matches_brute_force(self):
+        snapshot = synthetic_snapshot(49, size=120)
+        self.assertMatchesBruteForce(SimilarityIndex.compute(snapshot), self.brute_force(snapshot))
+
+    def test_probing_every_cluster_matches_brute_force(self):
+        snapshot = synthetic_snapshot(49, size=120)
+        # The approximate search, probing every cluster, must find what the exact one does
+        with mock.patch('analytics.similarity.EXACT_LIMIT', 0), mock.patch('analytics.similarity.PROBE_CLUSTERS', 10 ** 6):
+            index = SimilarityIndex.compute(snapshot)
+        self.assertGreater(len(index.centroids), 1)
+        self.assertMatchesBruteForce(index, self.brute_force(snapshot))
+
+    def test_a_new_version_is_served_the_previous_index_until_its_own_is_built(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with override_settings(ANALYTICS_SIMILARITY_CACHE_DIR=directory), \
+                mock.patch.multiple(similarity, _latest=None, _carried=None):
+            first = synthetic_snapshot(49, size=121)
+            first.version = 'first'
+            previous = first.similarity()
+            self.assertFalse(previous.stale)
+
+            # City 121 is gone: the previous neighbours are served without it, while the new
+            # index is computed in the background
+            second = synthetic_snapshot(49, size=120)
+            second.version = 'second'
+            with mock.patch.object(similarity, '_start_builder') as start_builder:
+                carried = second.similarity()
+            start_builder.assert_called_once_with(second)
+            self.assertTrue(carried.stale)
+            for city in range(120):
+                expected = [(neighbour, distance, shared) for neighbour, distance, shared
+                            in previous.similar(city, STORED_NEIGHBOURS) if neighbour != 120]
+                self.assertEqual(carried.similar(city, STORED_NEIGHBOURS), expected[:carried.neighbours.shape[1]])
+            self.assertTrue((previous.neighbours[:120] == 120).any())
+            self.assertEqual(carried.labels.tolist(), previous.labels[:120].tolist())
+
+            build_similarity_index(second)
+            built = second.similarity()
+            self.assertFalse(built.stale)
+            np.testing.assert_array_equal(built.neighbours, SimilarityIndex.compute(second).neighbours)
+
+            # City 122 is new: it has no neighbours or cluster until the builder thread is done
+            third = synthetic_snapshot(49, size=122)
+            third.version = 'third'
+            carried = third.similarity()
+            self.assertTrue(carried.stale)
+            self.assertEqual((carried.similar(121, STORED_NEIGHBOURS), int(carried.labels[121])), ([], -1))
+            builder = similarity._builder_thread
+            if builder is not None:
+                builder.join(30)
+            self.assertFalse(third.similarity().stale)
+            self.assertTrue(os.path.exists(similarity.cache_path('third')))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ChangeTokenAllocationTests(TestCase):
+    def test_tokens_are_taken_in_the_logging_transaction(self):
+        record_change('city', 1, 1, 'upsert')
+        with CaptureQueriesContext(connection) as captured:
+            with transaction.atomic():
+                record_change('city', 1, 1, 'upsert')
+        statements = [query['sql'].upper() for query in captured]
+        update = next(position for position, sql in enumerate(statements)
+                      if sql.startswith('UPDATE') and 'CHANGESEQUENCE' in sql)
+        insert = next(position for position, sql in enumerate(statements)
+                      if sql.startswith('INSERT') and 'CHANGELOG' in sql)
+        # The sequence row is locked before the entry is written, until the transaction ends
+        self.assertLess(update, insert)
+
+        # A rolled back transaction gives its token back: none is skipped, or seen before its commit
+        try:
+            with transaction.atomic():
+                rolled_back = record_change('city', 1, 1, 'upsert').token
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(record_change('city', 1, 1, 'upsert').token, rolled_back)
+
+        # A bulk write takes one block of tokens
+        before = latest_token()
+        record_changes('population', [(1, 1), (2, 1), (3, 1)], 'upsert')
+        self.assertEqual(
+            list(ChangeLog.objects.filter(token__gt=before).order_by('id').values_list('token', flat=True)),
+            [before + 1, before + 2, before + 3],
+        )
+
+    def test_polls_follow_tokens_not_ids(self):
+        slow, fast = City.objects.bulk_create([City(city_name='Slow', region='R'), City(city_name='Fast', region='R')])
+        token = latest_token()
+        ChangeLog.objects.create(token=token + 2, entity='city', object_id=fast.id, city_id=fast.id, action='upsert')
+        # Written after, with a higher id, by a transaction that took its token first
+        ChangeLog.objects.create(token=token + 1, entity='city', object_id=slow.id, city_id=slow.id, action='upsert')
+
+        polled = changes_since(token)
+        self.assertEqual(({city['name'] for city in polled['cities']}, polled['token']), ({'Slow', 'Fast'}, token + 2))
+        self.assertEqual([city['name'] for city in changes_since(token + 1)['cities']], ['Fast'])
+
+
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ChangeTokenTests(TransactionTestCase):
+    """
+    Database integration test of the commit order of tokens across real concurrent
+    transactions. It needs a test database that takes a second connection (SQL Server,
+    PostgreSQL, file-backed SQLite) and is skipped on in-memory SQLite, where
+    ChangeTokenAllocationTests covers the parts that make the order hold.
+    """
+
+    def test_a_slow_transaction_is_not_skipped(self):
+        City.objects.create(city_name='Before', region='R')
+        since = changes_since(None)['token']
+        slow_written, slow_release = threading.Event(), threading.Event()
+        errors = []
+
+        def write(name, hold=False):
+            try:
+                with transaction.atomic():
+                    City.objects.create(city_name=name, region='R')
+                    if hold:
+                        slow_written.set()
+                        slow_release.wait(5)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                slow_written.set()
+                connection.close()
+
+        slow = threading.Thread(target=write, args=('Slow', True))
+        slow.start()
+        slow_written.wait(5)
+        # Starts after the slow transaction logged its change, and would commit first
+        fast = threading.Thread(target=write, args=('Fast',))
+        fast.start()
+        fast.join(0.5)
+        polled = changes_since(since)
+        slow_release.set()
+        slow.join()
+        fast.join()
+
+        self.assertEqual(errors, [])
+        delivered = {city['name'] for city in polled['cities']}
+        delivered |= {city['name'] for city in changes_since(polled['token'])['cities']}
+        self.assertEqual(delivered, {'Slow', 'Fast'})
+
+
+class SubscriberTests(TestCase):
+    def test_overflow_resync_keeps_the_last_delivered_token(self):
+        subscriber = Subscriber(maxsize=2, token=10)
+        for token in (11, 12, 13):
+            subscriber.offer(token, format_event('changes', {'token': token}, token))
+
+        self.assertEqual(subscriber.queue.qsize(), 1)
+        token, message = subscriber.queue.get_nowait()
+        # Delivering the hint must not move Last-Event-ID past the dropped changes
+        self.assertEqual(token, 10)
+        self.assertNotIn('id:', message)
+        self.assertIn('event: resync', message)
+        self.assertIn('"since":10', message)
+
+    def test_a_subscriber_after_the_tailer_stopped_starts_at_the_latest_token(self):
+        broadcaster = ChangeBroadcaster()
+
+        async def connect():
+            subscriber = await broadcaster.subscribe()
+            broadcaster.unsubscribe(subscriber)
+            # With no subscribers left the tailer stops
+            await broadcaster._tailer
+            return subscriber.token
+
+        first = async_to_sync(connect)()
+        City.objects.create(city_name='Later City', region='Region 1')
+        latest = changes_since(None)['token']
+        self.assertGreater(latest, first)
+        self.assertEqual(async_to_sync(connect)(), latest)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RoutingTests(TestCase):
+    def test_reads_stay_on_the_primary_without_a_replica(self):
+        self.assertNotIn(REPLICA, settings.DATABASES)
+        self.assertEqual(PrimaryReplicaRouter().db_for_read(City), 'default')
+        self.assertFalse(replica_is_current())
+
+    def test_auth_writes_and_pinned_reads_never_go_to_the_replica(self):
+        router = PrimaryReplicaRouter()
+        with mock.patch.dict(settings.DATABASES, {REPLICA: settings.DATABASES['default']}):
+            self.assertEqual(router.db_for_read(City), REPLICA)
+            self.assertEqual(router.db_for_read(User), 'default')
+            self.assertEqual(router.db_for_read(ContentType), 'default')
+            self.assertEqual(router.db_for_write(City), 'default')
+            self.assertFalse(router.allow_migrate(REPLICA, 'analytics'))
+            with use_primary():
+                self.assertEqual(router.db_for_read(City), 'default')
+            self.assertEqual(router.db_for_read(City), REPLICA)
+
+            # A replica behind the primary's latest change token is not current
+            tokens = {'default': 5, REPLICA: 4}
+            with mock.patch('analytics.changes.latest_token', side_effect=tokens.get):
+                self.assertFalse(replica_is_current())
+                tokens[REPLICA] = 5
+                self.assertTrue(replica_is_current())
+
+    def test_only_successful_writes_pin_the_token_to_the_primary(self):
+        factory = APIRequestFactory()
+        pinned = []
+
+        def respond(status):
+            def get_response(request):
+                pinned.append(primary_pinned())
+                return HttpResponse(status=status)
+            return ReadYourWritesMiddleware(get_response)
+
+        headers = {'HTTP_AUTHORIZATION': 'Token abc'}
+        respond(200)(factory.get('/', **headers))
+        respond(400)(factory.post('/', **headers))
+        respond(200)(factory.get('/', **headers))
+        respond(201)(factory.post('/', **headers))
+        respond(200)(factory.get('/', **headers))
+        # Another token's reads are not pinned
+        respond(200)(factory.get('/', HTTP_AUTHORIZATION='Token other'))
+        self.assertEqual(pinned, [False, True, False, True, True, False])
+        self.assertFalse(primary_pinned())
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    ANALYTICS_COST_THROTTLE={'anon': {'capacity': 20, 'refill_rate': 0.001}},
+)
+class ThrottleTests(TestCase):
+    def test_concurrent_requests_share_one_budget(self):
+        factory = APIRequestFactory()
+        results = []
+        start = threading.Barrier(8)
+
+        def charge():
+            start.wait()
+            for _ in range(10):
+                request = Request(factory.get('/', REMOTE_ADDR='203.0.113.7'))
+                request.user = AnonymousUser()
+                results.append(CostTokenBucketThrottle().allow_request(request, None))
+
+        # A slow cache read widens the window between reading and writing a bucket
+        read = LocMemCache.get
+
+        def slow_read(cache, *args, **kwargs):
+            value = read(cache, *args, **kwargs)
+            time.sleep(0.001)
+            return value
+
+        threads = [threading.Thread(target=charge) for _ in range(8)]
+        with mock.patch.object(LocMemCache, 'get', slow_read):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(results.count(True), 20)
@@ -0,0 +1,160 @@
+# analytics/throttles.py
+"""
+Cost-aware token-bucket throttling for the expensive public endpoints.
+
+Each caller has a bucket of ANALYTICS_COST_THROTTLE[scope]['capacity'] tokens that refills
+at 'refill_rate' tokens per second; a request is charged its estimated cost (roughly the
+number of cities it touches) instead of 1. Anonymous callers (by IP) and authenticated
+users (by id) have separate budgets. State lives in the 'throttle' cache (the default
+one if there is none), which is file-based so all workers on the host share it.
+
+A file cache has no atomic increment, so each bucket is read, charged and written back
+under an exclusive file lock shared by the host's workers and threads. Buckets hash onto
+LOCK_STRIPES lock files, so the lock files do not grow with the number of callers.
+"""
+import os
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files import locks
+from rest_framework.throttling import BaseThrottle
+
+from .snapshot import get_snapshot
+
+DEFAULT_BUDGETS = {
+    'anon': {'capacity': 2000, 'refill_rate': 50},
+    'user': {'capacity': 20000, 'refill_rate': 500},
+}
+
+
+LOCK_STRIPES = 64
+
+
+def bucket_cache():
+    return caches['throttle' if 'throttle' in settings.CACHES else 'default']
+
+
+@contextmanager
+def bucket_lock(key):
+    """Holds the exclusive lock of the bucket's stripe, across the workers and threads of the host."""
+    directory = getattr(settings, 'ANALYTICS_THROTTLE_LOCK_DIR', None) \
+        or os.path.join(tempfile.gettempdir(), 'population_site_throttle_locks')
+    os.makedirs(directory, exist_ok=True)
+    stripe = zlib.crc32(key.encode()) % LOCK_STRIPES
+    # Opened per use: the lock belongs to the open file, so threads of one worker exclude each other too
+    with open(os.path.join(directory, f'stripe-{stripe}.lock'), 'ab') as handle:
+        locks.lock(handle, locks.LOCK_EX)
+        try:
+            yield
+        finally:
+            locks.unlock(handle)
+
+
+class CostTokenBucketThrottle(BaseThrottle):
+    def cost(self, request, view):
+        return 1
+
+    def allow_request(self, request, view):
+        if request.user and request.user.is_authenticated:
+            scope, ident = 'user', request.user.pk
+        else:
+            scope, ident = 'anon', self.get_ident(request)
+        budget = getattr(settings, 'ANALYTICS_COST_THROTTLE', DEFAULT_BUDGETS)[scope]
+        capacity, refill_rate = budget['capacity'], budget['refill_rate']
+
+        # Charges above the capacity could never pass; cap them so they wait for a full bucket
+        cost = min(max(self.cost(request, view), 1), capacity)
+        key = f'analytics:bucket:{scope}:{ident}'
+        cache = bucket_cache()
+        with bucket_lock(key):
+            now = time.time()
+            tokens, updated_at = cache.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * refill_rate)
+
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+                self._wait = None
+            else:
+                self._wait = (cost - tokens) / refill_rate
+            # Idle buckets refill completely, so they can expire once full
+            cache.set(key, (tokens, now), timeout=int((capacity - tokens) / refill_rate) + 1)
+
+        # Picked up by ThrottleHeadersMiddleware
+        request._request.throttle_budget = {'limit': capacity, 'remaining': int(tokens), 'cost': cost}
+        return allowed
+
+    def wait(self):
+        return self._wait
+
+    @classmethod
+    def charging(cls, cost):
+        """Returns a throttle class charging cost(request, view) tokens per request."""
+        return type(cls.__name__, (cls,), {'cost': staticmethod(cost)})
+
+
+def all_cities_cost(request, view):
+    """Listings and reports touch every city."""
+    return len(get_snapshot().cities)
+
+
+def single_city_cost(request, view):
+    return 1
+
+
+def batch_cost(request, view):
+    """One token per requested id."""
+    if request.method == 'POST':
+        ids = request.data.get('ids', [])
+        return len(ids) if isinstance(ids, list) else 1
+    return request.query_params.get('ids', '').count(',') + 1
+
+
+def simulation_cost(request, view):
+    """Every city, times each 10k simulated paths x years (the defaults cost one listing)."""
+    params = request.data if request.method == 'POST' else request.query_params
+    try:
+        work = int(params.get('paths', 1000)) * int(params.get('horizon', 10))
+    except (TypeError, ValueError):
+        return 1
+    return len(get_snapshot().cities) * max(1, work // 10000)
+
+
+def nearby_cost(request, view):
+    """One token per neighbour asked for."""
+    try:
+        return int(request.query_params.get('limit', 10))
+    except ValueError:
+        return 1
+
+
+def rankings_cost(request, view):
+    """One token per ranked city asked for."""
+    try:
+        return int(request.query_params.get('k', 10))
+    except ValueError:
+        return 1
+
+
+def clusters_cost(request, view):
+    """One token per cluster listed, or per member of the one cluster asked for."""
+    similarity = get_snapshot().similarity()
+    try:
+        cluster = int(request.query_params['cluster'])
+    except (KeyError, ValueError):
+        return max(len(similarity.sizes), 1)
+    return int(similarity.sizes[cluster]) if 0 <= cluster < len(similarity.sizes) else 1
+
+
+AllCitiesThrottle = CostTokenBucketThrottle.charging(all_cities_cost)
+SingleCityThrottle = CostTokenBucketThrottle.charging(single_city_cost)
+BatchThrottle = CostTokenBucketThrottle.charging(batch_cost)
+SimulationThrottle = CostTokenBucketThrottle.charging(simulation_cost)
+NearbyThrottle = CostTokenBucketThrottle.charging(nearby_cost)
+RankingsThrottle = CostTokenBucketThrottle.charging(rankings_cost)
+SimilarThrottle = CostTokenBucketThrottle.charging(nearby_cost)
+ClustersThrottle = CostTokenBucketThrottle.charging(clusters_cost)
@@ -8,7 +8,14 @@ urlpatterns = [
 
     # ---------------- API Endpoints ----------------
     path('api/cities/', api_views.get_cities_with_population, name='cities-list'),
+    path('api/cities/batch/', api_views.get_cities_batch, name='cities-batch'),
+    path('api/cities/search/', api_views.search_cities, name='cities-search'),
+    path('api/cities/nearby/', api_views.get_nearby_cities, name='cities-nearby'),
+    path('api/cities/clusters/', api_views.get_city_clusters, name='cities-clusters'),
+    path('api/cities/locations/', api_views.bulk_update_city_locations, name='bulk_update_city_locations'),
     path('api/cities/<int:city_id>/', api_views.get_city_by_id, name='city-detail'),
+    path('api/cities/<int:city_id>/series/', api_views.get_city_series, name='city-series'),
+    path('api/cities/<int:city_id>/similar/', api_views.get_similar_cities, name='city-similar'),
     # path('api/add_population/', api_views.add_population_api, name='add_population_api'),
     path('api/export_city/<int:city_id>/', api_views.export_city_csv_api, name='export_city_csv_api'),
     path('api/stats/', api_views.stats_api, name='stats_api'),
@@ -19,19 +26,52 @@ urlpatterns = [
     path('api/population/add/', api_views.add_population_data, name='add_population_data'),
     path('api/population/update/<int:population_id>/', api_views.update_population_data, name='update_population_data'),
     path('api/population/delete/<int:population_id>/', api_views.delete_population_data, name='delete_population_data'),
+    path('api/population/bulk_update/', api_views.bulk_update_population_data, name='bulk_update_population_data'),
+    path('api/population/bulk_delete/', api_views.bulk_delete_population_data, name='bulk_delete_population_data'),
+    path('api/population/observations/', api_views.add_population_observations, name='add_population_observations'),
+    path('api/population/quarantine/', api_views.get_quarantined_population, name='population-quarantine'),
+    path('api/population/quarantine/review/', api_views.review_quarantined_population, name='review_quarantine'),
     path('api/admins/', api_views.get_admins, name='get_admins'),
     path('api/admins/delete/<int:admin_id>/', api_views.delete_admin, name='delete_admin'),
     path('api/city/update/<int:city_id>/', api_views.update_city, name='update_city'),
     path('api/overall_summary/', api_views.generate_ml_summary_report, name='overall-summary'),
+    path('api/changes/', api_views.get_changes, name='changes'),
+    path('api/events/', api_views.forecast_events, name='forecast-events'),
+    path('api/simulate/', api_views.simulate_population, name='simulate'),
+    path('api/rankings/', api_views.get_rankings, name='rankings'),
+    path('api/areas/add/', api_views.add_area, name='add_area'),
+    path('api/areas/<int:area_id>/move/', api_views.reparent_area, name='reparent_area'),
+    path('api/areas/<int:area_id>/population/', api_views.get_area_population, name='area-population'),
+    path('api/forecast/accuracy/', api_views.get_forecast_accuracy, name='forecast-accuracy'),
     # Also accept requests without the /api prefix (some builds call endpoints like `/cities`)
     path('cities/', api_views.get_cities_with_population, name='cities-list-noapi'),
+    path('cities/batch/', api_views.get_cities_batch, name='cities-batch-noapi'),
+    path('cities/search/', api_views.search_cities, name='cities-search-noapi'),
+    path('cities/nearby/', api_views.get_nearby_cities, name='cities-nearby-noapi'),
+    path('cities/clusters/', api_views.get_city_clusters, name='cities-clusters-noapi'),
+    path('cities/locations/', api_views.bulk_update_city_locations, name='bulk_update_city_locations-noapi'),
     path('cities/<int:city_id>/', api_views.get_city_by_id, name='city-detail-noapi'),
+    path('cities/<int:city_id>/series/', api_views.get_city_series, name='city-series-noapi'),
+    path('cities/<int:city_id>/similar/', api_views.get_similar_cities, name='city-similar-noapi'),
+    path('changes/', api_views.get_changes, name='changes-noapi'),
+    path('events/', api_views.forecast_events, name='forecast-events-noapi'),
+    path('simulate/', api_views.simulate_population, name='simulate-noapi'),
+    path('rankings/', api_views.get_rankings, name='rankings-noapi'),
+    path('areas/add/', api_views.add_area, name='add_area-noapi'),
+    path('areas/<int:area_id>/move/', api_views.reparent_area, name='reparent_area-noapi'),
+    path('areas/<int:area_id>/population/', api_views.get_area_population, name='area-population-noapi'),
+    path('forecast/accuracy/', api_views.get_forecast_accuracy, name='forecast-accuracy-noapi'),
     path('city/add/', api_views.add_city, name='add_city-noapi'),
     path('city/delete/<int:city_id>/', api_views.delete_city, name='delete_city-noapi'),
     path('city/update/<int:city_id>/', api_views.update_city, name='update_city-noapi'),
     path('population/add/', api_views.add_population_data, name='add_population_data-noapi'),
     path('population/update/<int:population_id>/', api_views.update_population_data, name='update_population_data-noapi'),
     path('population/delete/<int:population_id>/', api_views.delete_population_data, name='delete_population_data-noapi'),
+    path('population/bulk_update/', api_views.bulk_update_population_data, name='bulk_update_population_data-noapi'),
+    path('population/bulk_delete/', api_views.bulk_delete_population_data, name='bulk_delete_population_data-noapi'),
+    path('population/observations/', api_views.add_population_observations, name='add_population_observations-noapi'),
+    path('population/quarantine/', api_views.get_quarantined_population, name='population-quarantine-noapi'),
+    path('population/quarantine/review/', api_views.review_quarantined_population, name='review_quarantine-noapi'),
     path('admins/', api_views.get_admins, name='get_admins-noapi'),
     path('admins/delete/<int:admin_id>/', api_views.delete_admin, name='delete_admin-noapi'),
     path('admin/create/', api_views.create_admin, name='create_admin-noapi'),
@@ -2,6 +2,7 @@
 Django settings for population_site project.
 """
 import os
+import tempfile
 from pathlib import Path
 from dotenv import load_dotenv
 import dj_database_url  # add this
@@ -59,6 +60,8 @@ MIDDLEWARE = [
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'analytics.middleware.ReadYourWritesMiddleware',
+    'analytics.middleware.ThrottleHeadersMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -99,9 +102,44 @@ DATABASES = {
             'driver': 'ODBC Driver 17 for SQL Server',
             'trusted_connection': 'yes',  # enables Windows Authentication
         },
+        'CONN_MAX_AGE': int(os.environ.get("DB_CONN_MAX_AGE", "60")),  # persistent connections
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Optional read replica, e.g. DATABASE_REPLICA_URL=postgres://... or sqlite:///replica.sqlite3
+# Public read endpoints, exports and the summary report read from it (see analytics/routers.py)
+if os.environ.get("DATABASE_REPLICA_URL"):
+    DATABASES['replica'] = dj_database_url.parse(
+        os.environ["DATABASE_REPLICA_URL"],
+        conn_max_age=int(os.environ.get("DB_CONN_MAX_AGE", "60")),
+        conn_health_checks=True,
+    )
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+
+DATABASE_ROUTERS = ['analytics.routers.PrimaryReplicaRouter']
+
+# Writers read from the primary for this long after a write (by session or API token)
+ANALYTICS_PRIMARY_PIN_SECONDS = int(os.environ.get("ANALYTICS_PRIMARY_PIN_SECONDS", "10"))
+
+# File-based so every worker on the host shares dataset versions, primary pins and throttle buckets.
+# A full file cache deletes a third of its entries at random (CULL_FREQUENCY), so MAX_ENTRIES stays
+# far above the handful of version keys and pins in 'default'. Throttle buckets, one per caller,
+# get their own cache: culling them refills a bucket early but never drops a dataset version.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get("DJANGO_CACHE_DIR", os.path.join(tempfile.gettempdir(), 'population_site_cache')),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    'throttle': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get(
+            "DJANGO_THROTTLE_CACHE_DIR", os.path.join(tempfile.gettempdir(), 'population_site_throttle_cache')),
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    },
+}
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
@@ -127,6 +165,62 @@ STATICFILES_DIRS = [
 
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
+# In-memory dataset snapshot (analytics/snapshot.py): rebuilt on writes, and at least this often (seconds)
+ANALYTICS_SNAPSHOT_MAX_AGE = int(os.environ.get("ANALYTICS_SNAPSHOT_MAX_AGE", "60"))
+# Set to a file path to share one memory-mapped snapshot between all gunicorn workers
+# (written by `manage.py write_snapshot` and rewritten on every data change)
+ANALYTICS_SNAPSHOT_FILE = os.environ.get("ANALYTICS_SNAPSHOT_FILE") or None
+
+# Delta sync (/api/changes/): how long change-log entries and tombstones are kept
+ANALYTICS_CHANGELOG_RETENTION_DAYS = int(os.environ.get("ANALYTICS_CHANGELOG_RETENTION_DAYS", "7"))
+
+# Server-Sent Events (/api/events/, ASGI only): per-client buffered events, change-log poll
+# interval for writes made by other workers, and keep-alive interval (seconds)
+ANALYTICS_SSE_CLIENT_BUFFER = int(os.environ.get("ANALYTICS_SSE_CLIENT_BUFFER", "32"))
+ANALYTICS_SSE_POLL_INTERVAL = float(os.environ.get("ANALYTICS_SSE_POLL_INTERVAL", "2"))
+ANALYTICS_SSE_HEARTBEAT = float(os.environ.get("ANALYTICS_SSE_HEARTBEAT", "15"))
+
+# Monte Carlo simulation (/api/simulate/): memory budget per request for the path arrays (MB)
+ANALYTICS_SIMULATION_MEMORY_MB = int(os.environ.get("ANALYTICS_SIMULATION_MEMORY_MB", "256"))
+
+# Ingestion screening (analytics/screening.py): anomaly score at which a population write is
+# flagged, quarantined for review or rejected; an empty value turns that action off
+ANALYTICS_SCREENING_POLICY = {
+    action: float(value) if value else None
+    for action, value in (
+        ('flag', os.environ.get("ANALYTICS_SCREENING_FLAG", "4")),
+        ('quarantine', os.environ.get("ANALYTICS_SCREENING_QUARANTINE", "8")),
+        ('reject', os.environ.get("ANALYTICS_SCREENING_REJECT", "")),
+    )
+}
+
+# Forecast archive (analytics/forecast_archive.py): set to 1 to store changed forecasts on a
+# background thread after every data change, instead of from a scheduled
+# `manage.py archive_forecasts` (the thread needs a database that allows concurrent writers)
+ANALYTICS_FORECAST_ARCHIVE = os.environ.get("ANALYTICS_FORECAST_ARCHIVE") == "1"
+
+# Growth similarity (analytics/similarity.py): directory of the per-dataset-version cache files,
+# and the number of k-means growth clusters (0 picks sqrt(cities / 2))
+ANALYTICS_SIMILARITY_CACHE_DIR = os.environ.get(
+    "ANALYTICS_SIMILARITY_CACHE_DIR", os.path.join(tempfile.gettempdir(), 'population_site_similarity'))
+ANALYTICS_SIMILARITY_CLUSTERS = int(os.environ.get("ANALYTICS_SIMILARITY_CLUSTERS", "0"))
+
+# Cost-aware throttling of the list, detail, batch, summary and simulation endpoints (analytics/throttles.py):
+# bucket size and refill rate per second, in cities touched, for anonymous and logged-in callers,
+# and the directory of the lock files that make charging a bucket atomic across workers
+ANALYTICS_THROTTLE_LOCK_DIR = os.environ.get(
+    "ANALYTICS_THROTTLE_LOCK_DIR", os.path.join(tempfile.gettempdir(), 'population_site_throttle_locks'))
+ANALYTICS_COST_THROTTLE = {
+    'anon': {
+        'capacity': int(os.environ.get("ANALYTICS_THROTTLE_ANON_CAPACITY", "2000")),
+        'refill_rate': float(os.environ.get("ANALYTICS_THROTTLE_ANON_RATE", "50")),
+    },
+    'user': {
+        'capacity': int(os.environ.get("ANALYTICS_THROTTLE_USER_CAPACITY", "20000")),
+        'refill_rate': float(os.environ.get("ANALYTICS_THROTTLE_USER_RATE", "500")),
+    },
+}
+
 # Default primary key field
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 